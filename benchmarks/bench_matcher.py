@@ -0,0 +1,59 @@
+"""Micro-benchmark of TelomereMatcher against ProgramTelomemore.number_telomere, and of exact against
+one-mismatch matching, read by read and in the batches the read loops classify.
+
+Run from the repository root with `python -m benchmarks.bench_matcher`.
+"""
+
+import random
+import timeit
+
+from telomemore.matcher import MismatchMatcher, TelomereMatcher, reverse_comp
+from telomemore.programs_copy import NobarcodeProgramTelomemore_copy
+
+
+def make_reads(n_reads: int = 100000, telomeric: float = 0.01, seed: int = 0) -> list:
+    '''Random reads of 50-150 bp, a fraction of them starting with telomeric repeats.'''
+    rng = random.Random(seed)
+    reads = []
+    for _ in range(n_reads):
+        length = rng.randrange(50, 151)
+        seq = ''.join(rng.choices('ACGT', k=length))
+        if rng.random() < telomeric:
+            seq = (rng.choice(['CCCTAA', 'TTAGGG']) * 25 + seq)[:length]
+        reads.append(seq)
+    return reads
+
+
+def main(pattern: str = 'CCCTAA', cutoff: int = 3, max_mismatches: int = 1, repeat: int = 3) -> None:
+    reads = make_reads()
+    program = NobarcodeProgramTelomemore_copy()
+    rev_comp = reverse_comp(pattern)
+    matcher = TelomereMatcher(pattern, cutoff, both_strands=True)
+    mismatches = MismatchMatcher(pattern, cutoff, both_strands=True, max_mismatches=max_mismatches)
+
+    def number_telomere():
+        return sum(1 for seq in reads
+                   if program.number_telomere(pattern, seq) >= cutoff or program.number_telomere(rev_comp, seq) >= cutoff)
+
+    def telomere_matcher():
+        return sum(1 for seq in reads if matcher.is_telomeric(seq))
+
+    def mismatch_matcher():
+        return sum(1 for seq in reads if mismatches.is_telomeric(seq))
+
+    def mismatch_batches():
+        return sum(1 for _, _, telomeric in mismatches.classified((None, seq) for seq in reads) if telomeric)
+
+    assert number_telomere() == telomere_matcher() <= mismatch_matcher() == mismatch_batches()
+    speed = {}
+    for name, func in [('number_telomere', number_telomere), ('TelomereMatcher', telomere_matcher),
+                       (f'{max_mismatches} mismatch', mismatch_matcher), (f'{max_mismatches} mismatch batch', mismatch_batches)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+        speed[name] = len(reads) / seconds / 1e6
+        print(f'{name:>22}: {speed[name]:.2f} M reads/s')
+    # Batched matching with mismatches should keep up with exact matching, the bam reading is the slower part.
+    assert speed[f'{max_mismatches} mismatch batch'] >= speed['TelomereMatcher'] / 2
+
+
+if __name__ == '__main__':
+    main()
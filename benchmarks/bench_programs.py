@@ -0,0 +1,129 @@
+"""Reads/s and peak memory of the counting programs on a synthetic scATAC-like bam file.
+
+Run from the repository root with `python -m benchmarks.bench_programs`. Every program is timed in a fresh
+process so the peak RSS belongs to that program alone. The results are written as JSON, and a previous
+result file given with --baseline is compared against to spot regressions, e.g.
+
+    python -m benchmarks.bench_programs --reads 1000000 --output after.json --baseline before.json
+
+With --io-threads or --prefetch every program is also run with that many decompression threads and reads of
+read-ahead, and both reads/s are reported.
+"""
+
+import argparse
+import json
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+
+import pysam
+
+import telomemore
+from benchmarks.synthetic import write_bam, write_barcodes
+from telomemore.programs import NobarcodeProgramTelomemore, BarcodeProgramTelomemore
+from telomemore.programs_copy import NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy
+
+PROGRAMS = [NobarcodeProgramTelomemore, BarcodeProgramTelomemore,
+            NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy]
+
+
+def measure(program_class: type, bam: Path, barcodes: Path, cutoff: int, pattern: str,
+            io_threads: int = 1, prefetch: int = 0) -> dict:
+    '''Counts the bam file once and returns the wall time and the peak RSS of this process.'''
+    program = program_class(io_threads=io_threads, prefetch=prefetch)
+    start = time.perf_counter()
+    if program_class.__name__.startswith('Barcode'):
+        program.telomere_count(bam, barcodes, cutoff, pattern)
+    else:
+        program.telomere_count(bam, cutoff, pattern)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def run(settings: dict, folder: Path, repeat: int = 1, readings: tuple = ((1, 0),)) -> list:
+    bam = write_bam(folder / 'bench.bam', n_reads=settings['reads'], read_length=settings['read_length'],
+                    n_barcodes=settings['barcodes'], telomeric=settings['telomeric'], dropout=settings['dropout'],
+                    seed=settings['seed'])
+    barcodes = write_barcodes(folder / 'barcodes.tsv', bam, fraction=settings['whitelist'], seed=settings['seed'])
+
+    results = []
+    for program_class in PROGRAMS:
+        for io_threads, prefetch in readings:
+            runs = []
+            for _ in range(repeat):
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+                    runs.append(pool.submit(measure, program_class, bam, barcodes, settings['cutoff'],
+                                            settings['pattern'], io_threads, prefetch).result())
+            best = min(runs, key=lambda result: result['seconds'])
+            result = {'program': program_class.__name__, 'io_threads': io_threads,
+                      'prefetch': prefetch, 'seconds': best['seconds'],
+                      'reads_per_second': settings['reads'] / best['seconds'],
+                      'peak_rss_mb': max(result['peak_rss_mb'] for result in runs)}
+            print(f"{result['program']:>32} {label(result):>16}: "
+                  f"{result['reads_per_second'] / 1e6:6.2f} M reads/s {result['peak_rss_mb']:8.1f} MB")
+            results.append(result)
+    return results
+
+
+def label(result: dict) -> str:
+    '''The reading settings of a result, results of before they were benchmarked read with the defaults.'''
+    return f"io {result.get('io_threads', 1)} ahead {result.get('prefetch', 0)}"
+
+
+def key(result: dict) -> tuple:
+    return result['program'], result.get('io_threads', 1), result.get('prefetch', 0)
+
+
+def compare(results: list, settings: dict, baseline: dict) -> None:
+    '''Prints the speed of every program relative to a previous result file.'''
+    if baseline['settings'] != settings:
+        print(f"the baseline was run with other settings: {baseline['settings']}")
+    before = {key(result): result for result in baseline['results']}
+    print(f"relative to {baseline['version']} ({baseline['date']}):")
+    for result in results:
+        old = before.get(key(result))
+        if old is not None:
+            print(f"{result['program']:>32} {label(result):>16}: "
+                  f"{result['reads_per_second'] / old['reads_per_second']:6.2f}x reads/s "
+                  f"{result['peak_rss_mb'] - old['peak_rss_mb']:+8.1f} MB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reads', type=int, default=500000, help='number of reads in the bam file')
+    parser.add_argument('--read-length', type=int, default=50, help='length of every read')
+    parser.add_argument('--barcodes', type=int, default=5000, help='number of distinct CB tags')
+    parser.add_argument('--whitelist', type=float, default=0.5, help='fraction of the barcodes in the whitelist')
+    parser.add_argument('--telomeric', type=float, default=0.001, help='fraction of telomeric reads')
+    parser.add_argument('--dropout', type=float, default=0.05, help='fraction of reads without a CB tag')
+    parser.add_argument('--pattern', default='CCCTAA')
+    parser.add_argument('--cutoff', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--io-threads', type=int, default=1, help='also run with this many decompression threads')
+    parser.add_argument('--prefetch', type=int, default=0, help='also run with this many reads of read-ahead')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per program, the fastest is reported')
+    parser.add_argument('--output', type=Path, default=Path('benchmark.json'), help='JSON file for the results')
+    parser.add_argument('--baseline', type=Path, default=None, help='earlier JSON result to compare against')
+    args = parser.parse_args()
+
+    settings = {name: getattr(args, name) for name in ['reads', 'read_length', 'barcodes', 'whitelist', 'telomeric',
+                                                        'dropout', 'pattern', 'cutoff', 'seed']}
+    with tempfile.TemporaryDirectory() as folder:
+        readings = list(dict.fromkeys([(1, 0), (args.io_threads, args.prefetch)]))
+        results = run(settings, Path(folder), args.repeat, readings)
+
+    report = {'version': telomemore.__version__, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(), 'pysam': pysam.__version__, 'machine': platform.machine(),
+              'settings': settings, 'results': results}
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f'results written to {args.output}')
+    if args.baseline is not None:
+        compare(results, settings, json.loads(args.baseline.read_text()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Start-up time of the telomemore command line, checked against a budget.
+
+Run from the repository root with `python -m benchmarks.bench_startup`. An array job of thousands of small
+samples starts the command once per sample, so everything imported before a command runs is paid on every
+task. Every command is started in a fresh process repeat times and the fastest is reported, with the time
+of the bare interpreter subtracted. The run fails if the command line takes longer than --budget ms to
+start or imports a module of HEAVY before a command needs it, e.g.
+
+    python -m benchmarks.bench_startup --budget 150 --output startup.json
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import telomemore
+
+HEAVY = ['numpy', 'pandas', 'pyarrow', 'pysam']
+REPORT = 'import sys; print(*[name for name in {heavy} if name in sys.modules], sep=",")'
+COMMANDS = {
+    'import': 'from telomemore.cli import cli',
+    'help': 'from telomemore.cli import cli; cli(["--help"], standalone_mode=False)',
+    'count --help': 'from telomemore.cli import cli; cli(["count", "--help"], standalone_mode=False)',
+    'count-copy --help': 'from telomemore.cli import cli; cli(["count-copy", "--help"], standalone_mode=False)',
+}
+# Imported by the counting itself, shown to put the start-up in proportion.
+COUNTING = {'count stack': 'import telomemore.telomemore', 'count-copy stack': 'import telomemore.telomemore_copy'}
+
+
+def start(code: str, repeat: int) -> float:
+    '''Fastest wall time in seconds of a fresh interpreter running code.'''
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def imported(code: str) -> list:
+    '''The HEAVY modules loaded after running code.'''
+    result = subprocess.run([sys.executable, '-c', f'{code}; {REPORT.format(heavy=HEAVY)}'], check=True,
+                            capture_output=True, text=True)
+    return [name for name in result.stdout.splitlines()[-1].split(',') if name]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=10, help='starts per command, the fastest is reported')
+    parser.add_argument('--budget', type=float, default=150, help='ms a command may take on top of the bare interpreter')
+    parser.add_argument('--output', type=Path, default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    interpreter = start('pass', args.repeat)
+    print(f'{"python":>20}: {interpreter * 1000:7.1f} ms')
+    results, failures = [], []
+    for name, code in {**COMMANDS, **COUNTING}.items():
+        elapsed = start(code, args.repeat) - interpreter
+        modules = imported(code)
+        results.append({'command': name, 'ms': round(elapsed * 1000, 1), 'imports': modules})
+        print(f'{name:>20}: {elapsed * 1000:+7.1f} ms {",".join(modules)}')
+        if name in COMMANDS:
+            if elapsed * 1000 > args.budget:
+                failures.append(f'{name} takes {elapsed * 1000:.0f} ms, over the budget of {args.budget:.0f} ms')
+            if modules:
+                failures.append(f'{name} imports {", ".join(modules)}')
+
+    if args.output is not None:
+        report = {'version': telomemore.__version__, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  'python': platform.python_version(), 'machine': platform.machine(),
+                  'interpreter_ms': round(interpreter * 1000, 1), 'budget_ms': args.budget, 'results': results}
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f'results written to {args.output}')
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+"""Synthetic scATAC-like bam files for the benchmarks."""
+
+import random
+from pathlib import Path
+
+import pysam
+
+TELOMERE_REPEATS = ['CCCTAA', 'TTAGGG']
+
+
+def write_bam(path: Path, n_reads: int = 1000000, read_length: int = 50, n_barcodes: int = 5000,
+              telomeric: float = 0.001, dropout: float = 0.05, seed: int = 0, index: bool = True) -> Path:
+    '''Writes a coordinate sorted bam file with n_reads reads spread over n_barcodes CB tags. A fraction
+    telomeric of the reads are telomeric repeats and a fraction dropout of the reads have no CB tag.'''
+    rng = random.Random(seed)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': f'chr{i}', 'LN': 50_000_000} for i in range(1, 5)]}
+    barcodes = [barcode(rng) for _ in range(n_barcodes)]
+    quality = pysam.qualitystring_to_array('I' * read_length)
+    bases = ''.join(rng.choices('ACGT', k=read_length + 1000))
+
+    unsorted = path.with_suffix('.unsorted.bam')
+    with pysam.AlignmentFile(unsorted, 'wb', header=header) as out:
+        for i in range(n_reads):
+            read = pysam.AlignedSegment(out.header)
+            read.query_name = f'read{i}'
+            if rng.random() < telomeric:
+                seq = rng.choice(TELOMERE_REPEATS) * (read_length // 6 + 1)
+            else:
+                start = rng.randrange(1000)
+                seq = bases[start:start + read_length]
+            read.query_sequence = seq[:read_length]
+            read.query_qualities = quality
+            read.reference_id = rng.randrange(4)
+            read.reference_start = rng.randrange(50_000_000 - read_length)
+            read.cigartuples = [(0, read_length)]
+            if rng.random() >= dropout:
+                read.set_tag('CB', rng.choice(barcodes))
+            out.write(read)
+
+    pysam.sort('-o', str(path), str(unsorted))
+    unsorted.unlink()
+    if index:
+        pysam.index(str(path))
+    return path
+
+
+def write_barcodes(path: Path, bam: Path, fraction: float = 0.5, seed: int = 0) -> Path:
+    '''Writes a barcodes.tsv whitelist with a fraction of the barcodes found in the bam file.'''
+    rng = random.Random(seed)
+    with pysam.AlignmentFile(bam, 'rb') as sam_file:
+        found = sorted({read.get_tag('CB') for read in sam_file if read.has_tag('CB')})
+    path = Path(path)
+    path.write_text(''.join(f'{cb}\n' for cb in found if rng.random() < fraction))
+    return path
+
+
+def barcode(rng: random.Random) -> str:
+    return ''.join(rng.choices('ACGT', k=16)) + '-1'
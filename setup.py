@@ -46,6 +46,7 @@ setup(
         ],
     },
     install_requires=install_requires,
+    extras_require={'parquet': ['pyarrow']},
     dependency_links=dependency_links,
     license="MIT license",
     long_description=readme,
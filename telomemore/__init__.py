@@ -3,3 +3,13 @@
 __author__ = """William Rosenbaum"""
 __email__ = 'william.rosenbaum88@gmail.com'
 __version__ = '0.0.1'
+
+__all__ = ['count_bam', 'count_reads', 'add_to_obs']
+
+
+def __getattr__(name):
+    '''The API is imported when it is first used, so the command line does not import pandas with the package.'''
+    if name in __all__:
+        from telomemore import api
+        return getattr(api, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
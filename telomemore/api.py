@@ -0,0 +1,112 @@
+import os
+from contextlib import contextmanager, redirect_stdout
+from dataclasses import asdict
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Tuple, Union
+import pandas as pd
+from telomemore.counts import BarcodeCounts, ReadStats
+from telomemore.matcher import MismatchMatcher, TelomereMatcher
+from telomemore.barcodes import read_whitelist
+from telomemore.programs_copy import NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy
+
+Whitelist = Union[str, Path, Iterable[str]]
+
+
+def to_table(counts: BarcodeCounts, stats: ReadStats) -> pd.DataFrame:
+    '''Count, total and fraction columns indexed by barcode, with the read stats in the attrs.'''
+    frame = counts.to_frame().set_index('bc')
+    frame['fraction'] = frame['count'] / frame['total']
+    frame.attrs['read_stats'] = asdict(stats)
+    return frame
+
+
+@contextmanager
+def progress(verbose: bool) -> Iterator[None]:
+    '''Lets the counting programs print their progress messages only if verbose.'''
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+
+def count_bam(path: Union[str, Path], pattern: str = 'CCCTAA', cutoff: int = 3, barcodes: Optional[Whitelist] = None,
+              threads: int = 1, both_strands: bool = True, reference: Optional[str] = None,
+              adata=None, io_threads: int = 1, prefetch: int = 0, max_mismatches: int = 0,
+              reads_file: Optional[Union[str, Path]] = None, verbose: bool = False) -> pd.DataFrame:
+    '''Telomeric and total reads per barcode of a bam, cram or sam file, without writing any files.
+
+    barcodes is a barcodes.tsv(.gz) file or the barcodes themselves, only those are counted and in that order.
+    With an AnnData object as adata its obs_names are the barcodes unless others are given, and the counts are
+    added to adata.obs as telomere_count, telomere_total and telomere_fraction. Returns a DataFrame with the
+    count, total and fraction columns indexed by barcode and the read stats in frame.attrs['read_stats'].
+    io_threads, prefetch and max_mismatches are those of the count command. With a reads_file the telomeric reads
+    are also written there as a sorted and indexed bam file, like count --emit-reads. Both strands are counted
+    like count-copy does unless both_strands is False. The progress messages of the count are only printed
+    with verbose.'''
+    if adata is not None and barcodes is None:
+        barcodes = list(adata.obs_names)
+
+    with progress(verbose):
+        if barcodes is None:
+            program = NobarcodeProgramTelomemore_copy(threads=threads, reference=reference, io_threads=io_threads, prefetch=prefetch,
+                                                       max_mismatches=max_mismatches)
+            program.both_strands = both_strands
+            counts = program.telomere_count(path, cutoff, pattern, reads_file)
+        else:
+            program = BarcodeProgramTelomemore_copy(threads=threads, reference=reference, io_threads=io_threads, prefetch=prefetch,
+                                                     max_mismatches=max_mismatches)
+            program.both_strands = both_strands
+            counts = program.telomere_count(path, barcodes, cutoff, pattern, reads_file)
+
+    frame = to_table(counts, program.read_stats)
+    if adata is not None:
+        add_to_obs(adata, frame)
+    return frame
+
+
+def count_reads(reads: Iterable[Tuple[Optional[str], Optional[str]]], pattern: str = 'CCCTAA', cutoff: int = 3,
+                barcodes: Optional[Whitelist] = None, both_strands: bool = True, max_mismatches: int = 0) -> pd.DataFrame:
+    '''Telomeric and total reads per barcode of (barcode, sequence) pairs already in memory, counted like a bam
+    file: pairs without a barcode or sequence are missing and, with barcodes, other barcodes are left out.
+    Returns the same table as count_bam.'''
+    if max_mismatches:
+        matcher = MismatchMatcher(pattern, cutoff, both_strands=both_strands, max_mismatches=max_mismatches)
+    else:
+        matcher = TelomereMatcher(pattern, cutoff, both_strands=both_strands)
+    whitelist = None if barcodes is None else read_whitelist(barcodes)
+    counts = BarcodeCounts(whitelist)
+    index, telomere, total = counts.index, counts.telomere, counts.total
+    stats = ReadStats()
+
+    def sequences() -> Iterator[Tuple[int, str]]:
+        for cb, seq in reads:
+            if cb is None:
+                stats.missing += 1
+                continue
+            i = index.get(cb)
+            if i is None and whitelist is not None:
+                stats.off_whitelist += 1
+                continue
+            if seq is None:
+                stats.missing += 1
+                continue
+            if i is None:
+                i = counts.intern(cb)
+            total[i] += 1
+            yield i, seq
+
+    for i, _, telomeric in matcher.classified(sequences()):
+        if telomeric:
+            telomere[i] += 1
+
+    return to_table(counts, stats)
+
+
+def add_to_obs(adata, frame: pd.DataFrame, prefix: str = 'telomere_') -> None:
+    '''Adds the columns of a count table to adata.obs, matched on the obs names. Cells without reads get a count
+    and total of 0.'''
+    aligned = frame.reindex(adata.obs_names)
+    for column in frame.columns:
+        values = aligned[column]
+        adata.obs[f'{prefix}{column}'] = values.values if column == 'fraction' else values.fillna(0).astype('int64').values
@@ -1,15 +1,47 @@
+import gzip
 from pathlib import Path
-from typing import List
+from typing import Iterable, List, Tuple, Union
+from telomemore.samples import find_files, is_sample_sheet, pair_barcodes, read_sample_sheet
+
+
+def read_whitelist(path: Union[Path, Iterable[str]]) -> List[str]:
+    '''Barcodes in the first column of a barcodes.tsv(.gz) file, in file order and without duplicates. Barcodes
+    given as a list or other iterable are only deduplicated.'''
+    if not isinstance(path, (str, Path)):
+        return list(dict.fromkeys(path))
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as handle:
+        barcodes = (line.split('\t', 1)[0].rstrip('\r\n') for line in handle)
+        return list(dict.fromkeys(cb for cb in barcodes if cb))
 
 class Barcodes:
-    '''Returns list of one file or list of all barcodes.tsv files is input is a folder.'''
-    def __init__(self, path: str):
-        self.files = self.init_barcodes(path)
+    '''Returns list of one file, the barcode files of a sample sheet, or list of all barcodes.tsv files is input is a folder.'''
+    def __init__(self, path: str, rescan: bool = False):
+        self.sheet = None
+        self.single = False
+        self.files = self.init_barcodes(path, rescan)
         
-    def init_barcodes(self, path: str) -> List[Path]:
+    def init_barcodes(self, path: str, rescan: bool = False) -> List[Path]:
+        if is_sample_sheet(path):
+            self.sheet = {sample.bam: sample.barcodes for sample in read_sample_sheet(path)}
+            return [bc for bc in self.sheet.values() if bc is not None]
         if Path(path).is_file():
+            self.single = True
             return [Path(path)]
         
-        return sorted([bc for bc in Path(path).rglob('*outs/filtered_peak_bc_matrix/barcodes.tsv')])
+        return find_files(path, rescan).barcodes
+    
+    def pair(self, bams: List[Path]) -> List[Tuple[Path, Path]]:
+        '''The barcode file of every bam file: the one of its sample in a sample sheet, the only barcode file if
+        one was given, or else the barcode file in the sample folder of the bam file. Raises ValueError for bam
+        files without a barcode file.'''
+        if self.sheet is not None:
+            unpaired = [str(bam) for bam in bams if self.sheet.get(bam) is None]
+            if unpaired:
+                raise ValueError(f'no barcode file in the sample sheet for: {", ".join(unpaired)}')
+            return [(bam, self.sheet[bam]) for bam in bams]
+        if self.single:
+            return [(bam, self.files[0]) for bam in bams]
+        return pair_barcodes(bams, self.files)
     
 #WORKS
@@ -0,0 +1,76 @@
+import os
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, List, Optional
+
+MANIFEST = 'telomemore_manifest.json'
+
+
+@contextmanager
+def atomic_open(path: Path, mode: str = 'w') -> Iterator[IO]:
+    '''Opens a temporary file next to path which replaces path once it is closed without errors, so a
+    crash never leaves a half written file behind.'''
+    path = Path(path)
+    temporary = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(temporary, mode) as handle:
+            yield handle
+        os.replace(temporary, path)
+    finally:
+        if temporary.exists():
+            temporary.unlink()
+
+
+def cache_folder() -> Path:
+    '''The telomemore folder of the user's cache, for files that cannot be kept next to their inputs.'''
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'telomemore'
+
+
+def file_state(path: Optional[Path]) -> Optional[dict]:
+    '''Path, size and modification time of a file, which change when the file is replaced or edited.'''
+    if path is None:
+        return None
+    stat = Path(path).stat()
+    return {'path': str(Path(path).resolve()), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def fingerprint(bam: Path, barcode: Optional[Path] = None, **settings) -> dict:
+    '''Everything a sample's output depends on: the bam file, the barcode file and the settings.'''
+    return {'bam': file_state(bam), 'barcode': file_state(barcode), **settings}
+
+
+class Manifest:
+    '''Remembers which samples have been counted. Every output folder gets a telomemore_manifest.json
+    holding the fingerprint each output file was made from, so a rerun skips samples whose fingerprint
+    is unchanged and whose outputs still exist, and recounts the rest. Entries are kept by output file and
+    the bam file counted into it, so a sample is never taken as done from the entry of another sample.'''
+
+    def __init__(self):
+        self.folders = {}
+
+    def entries(self, folder: Path) -> dict:
+        if folder not in self.folders:
+            manifest = folder / MANIFEST
+            self.folders[folder] = json.loads(manifest.read_text()) if manifest.exists() else {}
+        return self.folders[folder]
+
+    @staticmethod
+    def entry(output: Path, bam: Path) -> str:
+        return f'{Path(output).name} {Path(bam).resolve()}'
+
+    def is_done(self, bam: Path, outputs: List[Path], key: Optional[dict]) -> bool:
+        if key is None:
+            return False
+        outputs = [Path(output) for output in outputs]
+        entries = self.entries(outputs[0].parent)
+        return entries.get(self.entry(outputs[0], bam)) == key and all(output.exists() for output in outputs)
+
+    def record(self, bam: Path, outputs: List[Path], key: Optional[dict]) -> None:
+        if key is None:
+            return
+        folder = Path(outputs[0]).parent
+        entries = self.entries(folder)
+        entries[self.entry(outputs[0], bam)] = key
+        with atomic_open(folder / MANIFEST) as manifest:
+            json.dump(entries, manifest, indent=2)
@@ -0,0 +1,126 @@
+from array import array
+from bisect import bisect_right
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+import pysam
+
+CELL_COLUMNS = ['fragments', 'mapped', 'unmapped', 'gc', 'subtelomeric']
+# Reads that do not start a unique fragment: unmapped, secondary, failing qc, duplicate or supplementary.
+NOT_FRAGMENT = 0x4 | 0x100 | 0x200 | 0x400 | 0x800
+
+
+class Subtelomeres:
+    '''Regions of a bed file, merged where they overlap and kept sorted per contig.'''
+
+    def __init__(self, path: Path):
+        regions = defaultdict(list)
+        with open(path) as bed:
+            for line in bed:
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                contig, start, end = line.split()[:3]
+                regions[contig].append((int(start), int(end)))
+
+        self.starts, self.ends = {}, {}
+        for contig, spans in regions.items():
+            starts, ends = [], []
+            for start, end in sorted(spans):
+                if ends and start <= ends[-1]:
+                    ends[-1] = max(ends[-1], end)
+                else:
+                    starts.append(start)
+                    ends.append(end)
+            self.starts[contig], self.ends[contig] = starts, ends
+
+    def overlaps(self, contig: str, start: int, end: int) -> bool:
+        '''True if the half open span start-end of the contig overlaps a region.'''
+        starts = self.starts.get(contig)
+        if starts is None:
+            return False
+        i = bisect_right(starts, end - 1) - 1
+        return i >= 0 and self.ends[contig][i] > start
+
+
+class CellStats:
+    '''Per barcode accumulators for normalizing the telomere counts, filled in the same pass over the reads:
+    unique fragments, mapped and unmapped reads, GC content and, with a bed file of chromosome ends, reads
+    overlapping the subtelomeres.
+
+    A unique fragment is a primary mapped read, the first read of a pair, that is neither marked duplicate nor
+    starts at the same position, on the same strand and with the same mate position as an earlier fragment of
+    its barcode. Reads of a sorted bam file starting at the same position come one after another, so only the
+    fragments of the current position are remembered. GC is the fraction of G and C over all bases read.'''
+
+    def __init__(self, subtelomeres: Optional[Subtelomeres] = None):
+        self.subtelomeres = subtelomeres
+        self.index = {}
+        self.fragments = array('q')
+        self.mapped = array('q')
+        self.unmapped = array('q')
+        self.gc_bases = array('q')
+        self.bases = array('q')
+        self.subtelomeric = array('q')
+        self.position = None
+        self.seen = set()
+
+    @property
+    def columns(self) -> List[array]:
+        return [self.fragments, self.mapped, self.unmapped, self.gc_bases, self.bases, self.subtelomeric]
+
+    def intern(self, cb: str) -> int:
+        i = self.index.get(cb)
+        if i is None:
+            i = self.index[cb] = len(self.index)
+            for column in self.columns:
+                column.append(0)
+        return i
+
+    def add(self, cb: str, read: pysam.AlignedSegment, seq: str) -> None:
+        i = self.intern(cb)
+        self.gc_bases[i] += seq.count('G') + seq.count('C')
+        self.bases[i] += len(seq)
+        if read.is_unmapped:
+            self.unmapped[i] += 1
+            return
+        self.mapped[i] += 1
+        if self.subtelomeres is not None and self.subtelomeres.overlaps(read.reference_name, read.reference_start, read.reference_end or read.reference_start + 1):
+            self.subtelomeric[i] += 1
+        if read.flag & NOT_FRAGMENT or (read.is_paired and not read.is_read1):
+            return
+        position = (read.reference_id, read.reference_start)
+        if position != self.position:
+            self.position = position
+            self.seen.clear()
+        fragment = (cb, read.is_reverse, read.next_reference_id, read.next_reference_start)
+        if fragment not in self.seen:
+            self.seen.add(fragment)
+            self.fragments[i] += 1
+
+    def merge(self, other: 'CellStats') -> None:
+        '''Adds the accumulators of another part of the bam file.'''
+        for cb, j in other.index.items():
+            i = self.intern(cb)
+            for column, values in zip(self.columns, other.columns):
+                column[i] += values[j]
+
+    def frame_columns(self, barcodes: Iterable[str]) -> Dict[str, np.ndarray]:
+        '''The CELL_COLUMNS for the barcodes of a count table, zero for barcodes without reads. The subtelomeric
+        column is left out without a bed file.'''
+        ids = np.fromiter((self.index.get(cb, -1) for cb in barcodes), dtype=np.int64)
+        found = ids >= 0
+
+        def column(values: array) -> np.ndarray:
+            aligned = np.zeros(len(ids), dtype=np.int64)
+            aligned[found] = np.frombuffer(values, dtype=np.int64)[ids[found]]
+            return aligned
+
+        bases = column(self.bases)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            gc = column(self.gc_bases) / bases
+        columns = {'fragments': column(self.fragments), 'mapped': column(self.mapped),
+                   'unmapped': column(self.unmapped), 'gc': gc, 'subtelomeric': column(self.subtelomeric)}
+        if self.subtelomeres is None:
+            del columns['subtelomeric']
+        return columns
@@ -1,14 +1,106 @@
 import click
-from telomemore.filehandler import Files
-from telomemore.programs import NobarcodeProgramTelomemore, BarcodeProgramTelomemore, ProgramTelomemore
 from telomemore.barcodes import Barcodes
-from telomemore.telomemore import TeloMemore
+from telomemore.matcher import TelomereMatcher, PrefilterMatcher, MismatchMatcher
+from telomemore.options import FORMATS, JOB_MEMORY
+
+# The programs, and numpy, pysam and pandas with them, are imported by the commands that run them, so --help and
+# the start of every job of an array do not pay for the imports of the other commands.
+
+
+class CutoffRange(click.ParamType):
+    '''A cutoff like 3 or an inclusive range of cutoffs like 1-10.'''
+    name = 'cutoff'
+    
+    def convert(self, value, param, ctx):
+        if isinstance(value, list):
+            return value
+        start, _, stop = str(value).partition('-')
+        try:
+            cutoffs = list(range(int(start), int(stop or start) + 1))
+        except ValueError:
+            self.fail(f'{value!r} is not a cutoff or a range of cutoffs like 1-10', param, ctx)
+        if not cutoffs or cutoffs[0] < 0:
+            self.fail(f'{value!r} is not a cutoff or a range of cutoffs like 1-10', param, ctx)
+        return cutoffs
+
+
+def sweep(inputs, barcodes, patterns, cutoffs, output, threads, io_threads, prefetch, max_mismatches, jobs, job_memory, force, reference, sample_name, profile, output_format, both_strands):
+    '''Counts all patterns and cutoffs in one pass and writes one long table per bam file.'''
+    from telomemore.filehandler_copy import Files_copy
+    from telomemore.telomemore_copy import TeloMemore_copy
+    from telomemore.sweep import NobarcodeSweepProgramTelomemore, BarcodeSweepProgramTelomemore
+    
+    files, barcodes = find_inputs(Files_copy, inputs, barcodes, force)
+    check_inputs(files, sample_name)
+    
+    if barcodes is not None:
+        program = BarcodeSweepProgramTelomemore(both_strands=both_strands, threads=threads, reference=reference, profile=profile,
+                                                io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches)
+        telomemore = TeloMemore_copy(pattern=patterns, files=files, program=program, cutoff=cutoffs, barcode=barcodes, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name, output_format=output_format)
+        run_counts(telomemore)
+    else:
+        program = NobarcodeSweepProgramTelomemore(both_strands=both_strands, threads=threads, reference=reference, profile=profile,
+                                                  io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches)
+        telomemore = TeloMemore_copy(pattern=patterns, files=files, program=program, cutoff=cutoffs, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name, output_format=output_format)
+        run_counts(telomemore)
+    
+
+def find_inputs(files_class, inputs, barcodes, force):
+    '''The bam files and, if a barcode file or folder is given or the inputs are a sample sheet with a barcodes
+    column, the barcode files. Folders are searched once and the found files cached unless force is set. Every
+    bam file must pair with a barcode file of its sample.'''
+    try:
+        files = files_class(inputs, rescan=force)
+        if barcodes is None and any(sample.barcodes for sample in files.samples):
+            barcodes = inputs
+        if barcodes is None:
+            return files, None
+        barcodes = Barcodes(barcodes, rescan=force)
+        barcodes.pair(files.files)
+    except ValueError as error:
+        raise click.UsageError(str(error))
+    return files, barcodes
+
+
+def check_inputs(files, sample_name, index=False):
+    '''Standard input has no file name to name the outputs after, and one sample name only fits one input.
+    An index is written next to its bam file, which standard input does not have.'''
+    from telomemore.regions import is_stdin
+    if index and any(is_stdin(file) for file in files.files):
+        raise click.UsageError('--index needs bam files, standard input (-i -) is not indexed')
+    if sample_name is None and any(is_stdin(file) for file in files.files):
+        raise click.UsageError('reading from standard input (-i -) needs a --sample-name')
+    if sample_name is not None and len(files.files) > 1:
+        raise click.UsageError('--sample-name can only be given for a single input file')
+
+
+def check_mismatches(patterns, max_mismatches, prefilter):
+    if not max_mismatches:
+        return
+    if prefilter:
+        raise click.UsageError('--prefilter counts exact matches, it is not used with --max-mismatches')
+    for pattern in patterns:
+        try:
+            MismatchMatcher(pattern, 1, max_mismatches=max_mismatches)
+        except ValueError as error:
+            raise click.UsageError(str(error))
+
+
+def run_counts(telomemore):
+    from telomemore.scheduler import DuplicateOutputs
+    try:
+        telomemore.run_program()
+    except DuplicateOutputs as error:
+        raise click.UsageError(str(error))
+
+
+def require_pyarrow():
+    from telomemore.output import import_pyarrow
+    try:
+        import_pyarrow()
+    except ImportError as error:
+        raise click.UsageError(str(error))
 
-#COPY
-from telomemore.filehandler_copy import Files_copy
-from telomemore.programs_copy import NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy
-from telomemore.barcodes import Barcodes
-from telomemore.telomemore_copy import TeloMemore_copy
 
 @click.group()
 def cli():
@@ -17,12 +109,28 @@ def cli():
    
     
 @cli.command()
-@click.option('--inputs', '-i', type=str, required=True, help='input folder or file for TeloMeMore')
-@click.option('--pattern', '-p', type=str, required=True, default='CCCTAA', help='pattern for searching the bam files')
+@click.option('--inputs', '-i', type=str, required=True, help='input folder, file or sample sheet for TeloMeMore, - reads sam or bam from standard input')
+@click.option('--pattern', '-p', type=str, required=True, multiple=True, default=['CCCTAA'], help='pattern for searching the bam files, repeat to count several patterns in one pass')
 @click.option('--barcodes', '-bc', type=str, required=False, default=None, help='barcode file or folder is barcode file exists')
-@click.option('--cutoff', '-c', type=int, required=False, default=3, help='cutoff for which telomermore count occurance of pattern as telomere read')
+@click.option('--cutoff', '-c', type=CutoffRange(), required=False, multiple=True, default=['3'], help='cutoff for which telomermore count occurance of pattern as telomere read, repeat or give a range like 1-10 to count several cutoffs in one pass')
 @click.option('--output', '-o', type=str, required=False, default=None, help='specify customize output folder if wanted')
-def count(inputs, barcodes, pattern, cutoff, output):
+@click.option('--threads', '-t', type=int, required=False, default=1, help='number of processes counting regions of an indexed bam file in parallel')
+@click.option('--io-threads', type=click.IntRange(min=1), required=False, default=1, help='threads decompressing the bam file in every process')
+@click.option('--prefetch', type=click.IntRange(min=0), required=False, default=0, help='reads decoded ahead of the counting in a background thread, 0 for none')
+@click.option('--jobs', '-j', type=int, required=False, default=1, help='number of bam files counted at the same time')
+@click.option('--job-memory', type=float, required=False, default=JOB_MEMORY / 1024 ** 3, help='GB of memory one job may use, limits the number of jobs')
+@click.option('--force', '-f', is_flag=True, default=False, help='count every bam file again, also those with up to date results')
+@click.option('--prefilter', is_flag=True, default=False, help='skip the pattern count for reads too short or with too few copies of a seed of the pattern')
+@click.option('--max-mismatches', type=click.IntRange(min=0), required=False, default=0, help='substituted bases a match of the pattern may have, 0 for exact matches')
+@click.option('--reference', '-r', type=str, required=False, default=None, help='reference fasta the cram inputs were compressed against')
+@click.option('--sample-name', '-n', type=str, required=False, default=None, help='name for the output files instead of the input file name, needed for standard input')
+@click.option('--profile', is_flag=True, default=False, help='time the stages of the read loop on a sample of the reads')
+@click.option('--index', is_flag=True, default=False, help='count from a telomere-read index next to every bam file, made by the first run')
+@click.option('--emit-reads', is_flag=True, default=False, help='also write the telomeric reads to a sorted and indexed bam file next to the counts')
+@click.option('--max-memory', type=float, required=False, default=None, help='MB of memory the barcode counts of a job may use, counts beyond it are spilled to disk')
+@click.option('--min-reads', type=int, required=False, default=1, help='with --max-memory, only keep barcodes with at least this many reads')
+@click.option('--top-barcodes', type=int, required=False, default=None, help='with --max-memory, only keep this many barcodes with the most reads')
+def count(inputs, barcodes, pattern, cutoff, output, threads, io_threads, prefetch, jobs, job_memory, force, prefilter, max_mismatches, reference, sample_name, profile, index, emit_reads, max_memory, min_reads, top_barcodes):
     
     '''Count the occurances of telomere read in each cell. The telomere is defined by the user, as a read
     which contains the pattern a number of times above the specified cutoff.
@@ -31,7 +139,10 @@ def count(inputs, barcodes, pattern, cutoff, output):
 
     Required arguments: 
     
-    inputs: a folder or file
+    inputs: a folder or file, or a sample sheet. A folder is searched once for bam and cram files and cell ranger
+        barcode files (outs/filtered_peak_bc_matrix/barcodes.tsv), skipping the cell ranger pipeline folders,
+        and what is found is cached until the folders change. A sample sheet is a .tsv file with the columns
+        sample, bam and optionally barcodes, and skips the search. Its outputs are named after the samples.
     
     pattern: a pattern which TeloMemore searches the bamfile for. 'CCCTAA' as default. 
         
@@ -39,32 +150,135 @@ def count(inputs, barcodes, pattern, cutoff, output):
     
     cutoff: integer for which Telomemore uses as cutoff for counting read as telomere. Default = 3.
     
-    barcodes: file or folder with barcode files.
+    Several patterns and cutoffs (-p CCCTAA -p TTAGGG -c 1-10) are counted in one pass over each bam file
+    and written to one long table with a row per barcode, pattern and cutoff.
+    
+    barcodes: file or folder with barcode files. One file is used for every bam file. From a folder every bam
+        file gets the barcode file of its sample folder, the folder holding outs/, and a bam file without
+        one is an error. Not needed for a sample sheet with a barcodes column.
     
     output: Specify folder to which the count files should be written. Default is the same folder as input. 
     
+    threads: Number of processes. Indexed bam files are split into regions which are counted in parallel,
+        bam files without an index are counted in one process. Default = 1.
+    
+    io_threads: Threads htslib decompresses the bam or cram file with, in every process. Decompression
+        otherwise shares one core with the counting. Default = 1.
+    
+    prefetch: Decode this many reads at a time in a background thread, ahead of the counting, so waiting on
+        slow or network storage overlaps with counting. The reads/s of every sample are in the run log.
+        Default = 0, no read-ahead.
+    
+    jobs: Number of bam files counted at the same time, largest file first. Fewer jobs are started if the
+        available memory does not fit job-memory GB per job. Default = 1.
+    
+    force: Count every bam file again. By default a bam file is skipped when its results were written by an
+        earlier run with the same settings, the bam and barcode files are unchanged and the outputs still exist.
+        Also searches the input folders again instead of using the cached files.
+    
+    prefilter: Reject reads that cannot reach the cutoff, being too short or having too few copies of the
+        longest literal part of the pattern, before counting the pattern. The counts do not change, it
+        speeds up patterns that are regular expressions. Only for one pattern and cutoff per run.
+    
+    max_mismatches: Also count matches of the pattern with up to this many substituted bases or Ns, so variant
+        repeats like TCAGGG and TGAGGG count as TTAGGG with one mismatch. Only for patterns of plain bases and
+        not with prefilter. Default = 0, exact matches.
+    
+    reference: Reference fasta for cram inputs, if it is not found through the cram header.
+    
+    sample_name: Name the output files after this instead of the input file. Needed when reading from
+        standard input, e.g. samtools view -u -q 30 sample.bam | telomemore count -i - -n sample.
+        Standard input is read in one streaming pass and always counted again.
+    
+    Every counted sample adds a line of metrics to telomemore_runs.jsonl in its output folder: reads/s, peak
+    memory, read totals, reads missing a tag or outside the whitelist and telomeric reads.
+    
+    profile: Also time one read in a thousand through the stages of the read loop, bam decoding, tag lookup,
+        sequence decoding and pattern matching, and log the estimated seconds spent in each.
+    
+    index: Write a telomere-read index next to every bam file (sample.bam.<pattern hash>.telomemore.idx), or to
+        ~/.cache/telomemore/index if the folder of the bam file is read-only, with the reads per barcode and,
+        for every read matching the pattern at least once, its barcode, number of matches on each strand and
+        position. Later runs with the same pattern and any cutoff or barcode
+        file count from the index in seconds instead of scanning the bam file. The index is made again when
+        the bam file changes. Only one pattern and cutoff per run.
+    
+    emit_reads: Also write the reads counted as telomeric to sample_telomemore_reads_<pattern>.bam next to the
+        counts, sorted and indexed, with the number of matches of the pattern in the tr tag. The reads are
+        written by a background thread during the count, so re-counting or viewing them later reads megabytes
+        instead of the whole bam file. Only one pattern and cutoff per run and not with --index.
+    
+    max_memory: Count without a barcode file in about this many MB of barcode counts, for unfiltered bam files
+        with millions of barcodes. When a process has filled its share, its counts are written to disk sorted by
+        barcode and merged at the end, and the output is in barcode order. The reads and telomeric reads of
+        dropped barcodes are written to the missed file and the run log. Counted read by read, one pattern and
+        cutoff per run and not with --index.
+    
+    min_reads: With max_memory, only barcodes with at least this many reads are kept. Default = 1.
+    
+    top_barcodes: With max_memory, only this many barcodes with the most reads are kept.
+    
     '''
+    
+    patterns = list(dict.fromkeys(pattern))
+    cutoffs = sorted({value for values in cutoff for value in values})
+    check_mismatches(patterns, max_mismatches, prefilter)
+    if index and (len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--index counts one pattern and cutoff at a time')
+    if prefilter and (len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--prefilter rejects reads below one cutoff, it is not used when several patterns or cutoffs are counted')
+    if emit_reads and (index or max_memory is not None or len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--emit-reads writes the reads of one pattern and cutoff while scanning the bam file, not with --index or --max-memory')
+    if max_memory is None and (min_reads != 1 or top_barcodes is not None):
+        raise click.UsageError('--min-reads and --top-barcodes are only used with --max-memory')
+    if max_memory is not None and (barcodes is not None or index or len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--max-memory counts one pattern and cutoff without a barcode file or --index')
+    if len(patterns) > 1 or len(cutoffs) > 1:
+        return sweep(inputs, barcodes, patterns, cutoffs, output, threads, io_threads, prefetch, max_mismatches, jobs, job_memory, force, reference, sample_name, profile, 'csv', both_strands=False)
+    pattern, cutoff = patterns[0], cutoffs[0]
+    matcher = PrefilterMatcher if prefilter else TelomereMatcher
+    from telomemore.filehandler import Files
+    from telomemore.programs import NobarcodeProgramTelomemore, BarcodeProgramTelomemore
+    from telomemore.telomemore import TeloMemore
 
-    files = Files(inputs)
+    files, barcodes = find_inputs(Files, inputs, barcodes, force)
+    check_inputs(files, sample_name, index)
     
     if barcodes is not None:
-        program = BarcodeProgramTelomemore()
-        barcodes = Barcodes(barcodes)
-        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, barcode=barcodes, output_dir=output)
-        telomemore.run_program()
+        program = BarcodeProgramTelomemore(threads=threads, matcher=matcher, reference=reference, profile=profile, index=index,
+                                           io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches, emit_reads=emit_reads)
+        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, barcode=barcodes, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name)
+        run_counts(telomemore)
     else:
-        program = NobarcodeProgramTelomemore()
-        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, output_dir=output)
-        telomemore.run_program()
+        program = NobarcodeProgramTelomemore(threads=threads, matcher=matcher, reference=reference, profile=profile, index=index,
+                                             io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches, emit_reads=emit_reads, max_memory=max_memory, min_reads=min_reads, top_barcodes=top_barcodes)
+        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name)
+        run_counts(telomemore)
     
     
 @cli.command()
-@click.option('--inputs', '-i', type=str, required=True, help='input folder or file for TeloMeMore')
-@click.option('--pattern', '-p', type=str, required=True, default='CCCTAA', help='pattern for searching the bam files')
+@click.option('--inputs', '-i', type=str, required=True, help='input folder, file or sample sheet for TeloMeMore, - reads sam or bam from standard input')
+@click.option('--pattern', '-p', type=str, required=True, multiple=True, default=['CCCTAA'], help='pattern for searching the bam files, repeat to count several patterns in one pass')
 @click.option('--barcodes', '-bc', type=str, required=False, default=None, help='barcode file or folder is barcode file exists')
-@click.option('--cutoff', '-c', type=int, required=False, default=3, help='cutoff for which telomermore count occurance of pattern as telomere read')
+@click.option('--cutoff', '-c', type=CutoffRange(), required=False, multiple=True, default=['3'], help='cutoff for which telomermore count occurance of pattern as telomere read, repeat or give a range like 1-10 to count several cutoffs in one pass')
 @click.option('--output', '-o', type=str, required=False, default=None, help='specify customize output folder if wanted')
-def count_copy(inputs, barcodes, pattern, cutoff, output):
+@click.option('--threads', '-t', type=int, required=False, default=1, help='number of processes counting regions of an indexed bam file in parallel')
+@click.option('--io-threads', type=click.IntRange(min=1), required=False, default=1, help='threads decompressing the bam file in every process')
+@click.option('--prefetch', type=click.IntRange(min=0), required=False, default=0, help='reads decoded ahead of the counting in a background thread, 0 for none')
+@click.option('--jobs', '-j', type=int, required=False, default=1, help='number of bam files counted at the same time')
+@click.option('--job-memory', type=float, required=False, default=JOB_MEMORY / 1024 ** 3, help='GB of memory one job may use, limits the number of jobs')
+@click.option('--force', '-f', is_flag=True, default=False, help='count every bam file again, also those with up to date results')
+@click.option('--prefilter', is_flag=True, default=False, help='skip the pattern count for reads too short or with too few copies of a seed of the pattern')
+@click.option('--max-mismatches', type=click.IntRange(min=0), required=False, default=0, help='substituted bases a match of the pattern may have, 0 for exact matches')
+@click.option('--reference', '-r', type=str, required=False, default=None, help='reference fasta the cram inputs were compressed against')
+@click.option('--sample-name', '-n', type=str, required=False, default=None, help='name for the output files instead of the input file name, needed for standard input')
+@click.option('--profile', is_flag=True, default=False, help='time the stages of the read loop on a sample of the reads')
+@click.option('--index', is_flag=True, default=False, help='count from a telomere-read index next to every bam file, made by the first run')
+@click.option('--emit-reads', is_flag=True, default=False, help='also write the telomeric reads to a sorted and indexed bam file next to the counts')
+@click.option('--format', 'output_format', type=click.Choice(FORMATS), required=False, default='csv', help='write the count tables as csv or parquet')
+@click.option('--cell-stats', is_flag=True, default=False, help='add unique fragments, mapped and unmapped reads and GC content per barcode to the table')
+@click.option('--subtelomeres', type=click.Path(exists=True, dir_okay=False), required=False, default=None, help='bed file of chromosome ends, adds the reads per barcode overlapping them')
+def count_copy(inputs, barcodes, pattern, cutoff, output, threads, io_threads, prefetch, jobs, job_memory, force, prefilter, max_mismatches, reference, sample_name, profile, index, emit_reads, output_format, cell_stats, subtelomeres):
     
     '''Count the occurances of telomere read in each cell. The telomere is defined by the user, as a read
     which contains the pattern a number of times above the specified cutoff.
@@ -73,7 +287,10 @@ def count_copy(inputs, barcodes, pattern, cutoff, output):
 
     Required arguments: 
     
-    inputs: a folder or file
+    inputs: a folder or file, or a sample sheet. A folder is searched once for bam and cram files and cell ranger
+        barcode files (outs/filtered_peak_bc_matrix/barcodes.tsv), skipping the cell ranger pipeline folders,
+        and what is found is cached until the folders change. A sample sheet is a .tsv file with the columns
+        sample, bam and optionally barcodes, and skips the search. Its outputs are named after the samples.
     
     pattern: a pattern which TeloMemore searches the bamfile for. 'CCCTAA' as default. 
         
@@ -81,25 +298,216 @@ def count_copy(inputs, barcodes, pattern, cutoff, output):
     
     cutoff: integer for which Telomemore uses as cutoff for counting read as telomere. Default = 3.
     
-    barcodes: file or folder with barcode files.
+    Several patterns and cutoffs (-p CCCTAA -p TTAGGG -c 1-10) are counted in one pass over each bam file
+    and written to one long table with a row per barcode, pattern and cutoff.
+    
+    barcodes: file or folder with barcode files. One file is used for every bam file. From a folder every bam
+        file gets the barcode file of its sample folder, the folder holding outs/, and a bam file without
+        one is an error. Not needed for a sample sheet with a barcodes column.
     
     output: Specify folder to which the count files should be written. Default is the same folder as input. 
     
+    threads: Number of processes. Indexed bam files are split into regions which are counted in parallel,
+        bam files without an index are counted in one process. Default = 1.
+    
+    io_threads: Threads htslib decompresses the bam or cram file with, in every process. Decompression
+        otherwise shares one core with the counting. Default = 1.
+    
+    prefetch: Decode this many reads at a time in a background thread, ahead of the counting, so waiting on
+        slow or network storage overlaps with counting. The reads/s of every sample are in the run log.
+        Default = 0, no read-ahead.
+    
+    jobs: Number of bam files counted at the same time, largest file first. Fewer jobs are started if the
+        available memory does not fit job-memory GB per job. Default = 1.
+    
+    force: Count every bam file again. By default a bam file is skipped when its results were written by an
+        earlier run with the same settings, the bam and barcode files are unchanged and the outputs still exist.
+        Also searches the input folders again instead of using the cached files.
+    
+    prefilter: Reject reads that cannot reach the cutoff, being too short or having too few copies of the
+        longest literal part of the pattern, before counting the pattern. The counts do not change, it
+        speeds up patterns that are regular expressions. Only for one pattern and cutoff per run.
+    
+    max_mismatches: Also count matches of the pattern with up to this many substituted bases or Ns, so variant
+        repeats like TCAGGG and TGAGGG count as TTAGGG with one mismatch. Only for patterns of plain bases and
+        not with prefilter. Default = 0, exact matches.
+    
+    reference: Reference fasta for cram inputs, if it is not found through the cram header.
+    
+    sample_name: Name the output files after this instead of the input file. Needed when reading from
+        standard input, e.g. samtools view -u -q 30 sample.bam | telomemore count -i - -n sample.
+        Standard input is read in one streaming pass and always counted again.
+    
+    Every counted sample adds a line of metrics to telomemore_runs.jsonl in its output folder: reads/s, peak
+    memory, read totals, reads missing a tag or outside the whitelist and telomeric reads.
+    
+    profile: Also time one read in a thousand through the stages of the read loop, bam decoding, tag lookup,
+        sequence decoding and pattern matching, and log the estimated seconds spent in each.
+    
+    index: Write a telomere-read index next to every bam file (sample.bam.<pattern hash>.telomemore.idx), or to
+        ~/.cache/telomemore/index if the folder of the bam file is read-only, with the reads per barcode and,
+        for every read matching the pattern at least once, its barcode, number of matches on each strand and
+        position. Later runs with the same pattern and any cutoff or barcode
+        file count from the index in seconds instead of scanning the bam file. The index is made again when
+        the bam file changes. Only one pattern and cutoff per run.
+    
+    emit_reads: Also write the reads counted as telomeric to sample_telomemore_reads_<pattern>.bam next to the
+        counts, sorted and indexed, with the number of matches of the pattern in the tr tag. The reads are
+        written by a background thread during the count, so re-counting or viewing them later reads megabytes
+        instead of the whole bam file. Only one pattern and cutoff per run and not with --index.
+    
+    format: 'csv' or 'parquet'. Parquet tables store the counts as integers and the pattern and file columns
+        dictionary encoded, and need pyarrow. Default = csv.
+    
+    cell_stats: Add columns for normalizing the counts, counted in the same pass: fragments, the unique
+        fragments of the barcode (primary mapped first reads, without those marked duplicate or starting at
+        the same position, strand and mate position as another), mapped and unmapped reads and gc, the
+        fraction of G and C of all bases read. Only one pattern and cutoff per run and not with --index.
+    
+    subtelomeres: A bed file of chromosome ends. Adds the cell stats columns and a subtelomeric column with the
+        mapped reads per barcode overlapping a region of the bed file.
+    
     '''
+    
+    if output_format == 'parquet':
+        require_pyarrow()
+    
+    patterns = list(dict.fromkeys(pattern))
+    cutoffs = sorted({value for values in cutoff for value in values})
+    check_mismatches(patterns, max_mismatches, prefilter)
+    cell_stats = cell_stats or subtelomeres is not None
+    if index and (len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--index counts one pattern and cutoff at a time')
+    if prefilter and (len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--prefilter rejects reads below one cutoff, it is not used when several patterns or cutoffs are counted')
+    if cell_stats and (len(patterns) > 1 or len(cutoffs) > 1 or index):
+        raise click.UsageError('--cell-stats and --subtelomeres count one pattern and cutoff at a time and scan the bam file, not the --index')
+    if emit_reads and (index or len(patterns) > 1 or len(cutoffs) > 1):
+        raise click.UsageError('--emit-reads writes the reads of one pattern and cutoff while scanning the bam file, not with --index')
+    if len(patterns) > 1 or len(cutoffs) > 1:
+        return sweep(inputs, barcodes, patterns, cutoffs, output, threads, io_threads, prefetch, max_mismatches, jobs, job_memory, force, reference, sample_name, profile, output_format, both_strands=True)
+    pattern, cutoff = patterns[0], cutoffs[0]
+    matcher = PrefilterMatcher if prefilter else TelomereMatcher
+    from telomemore.filehandler_copy import Files_copy
+    from telomemore.programs_copy import NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy
+    from telomemore.telomemore_copy import TeloMemore_copy
 
-    files = Files_copy(inputs)
+    files, barcodes = find_inputs(Files_copy, inputs, barcodes, force)
+    check_inputs(files, sample_name, index)
     
     if barcodes is not None:
-        program = BarcodeProgramTelomemore_copy()
-        barcodes = Barcodes(barcodes)
-        telomemore = TeloMemore_copy(pattern=pattern, files=files, program=program, cutoff=cutoff, barcode=barcodes, output_dir=output)
-        telomemore.run_program()
+        program = BarcodeProgramTelomemore_copy(threads=threads, matcher=matcher, reference=reference, profile=profile, index=index,
+                                                io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches, emit_reads=emit_reads, cell_stats=cell_stats, subtelomeres=subtelomeres)
+        telomemore = TeloMemore_copy(pattern=pattern, files=files, program=program, cutoff=cutoff, barcode=barcodes, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name, output_format=output_format)
+        run_counts(telomemore)
     else:
-        program = NobarcodeProgramTelomemore_copy()
-        telomemore = TeloMemore_copy(pattern=pattern, files=files, program=program, cutoff=cutoff, output_dir=output)
-        telomemore.run_program()
+        program = NobarcodeProgramTelomemore_copy(threads=threads, matcher=matcher, reference=reference, profile=profile, index=index,
+                                                  io_threads=io_threads, prefetch=prefetch, max_mismatches=max_mismatches, emit_reads=emit_reads, cell_stats=cell_stats, subtelomeres=subtelomeres)
+        telomemore = TeloMemore_copy(pattern=pattern, files=files, program=program, cutoff=cutoff, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name, output_format=output_format)
+        run_counts(telomemore)
     
     
   
     
     
+
+
+@cli.command()
+@click.option('--inputs', '-i', type=str, required=True, help='folder of 10x ATAC FASTQ files or one FASTQ file of a sample')
+@click.option('--pattern', '-p', type=str, required=False, default='CCCTAA', help='pattern for searching the reads')
+@click.option('--barcodes', '-bc', type=str, required=False, default=None, help='barcode file, only these cells are counted')
+@click.option('--whitelist', '-w', type=click.Path(exists=True, dir_okay=False), required=False, default=None, help='barcode whitelist of the 10x chemistry the barcodes are corrected against')
+@click.option('--cutoff', '-c', type=int, required=False, default=3, help='cutoff for which telomermore count occurance of pattern as telomere read')
+@click.option('--output', '-o', type=str, required=False, default=None, help='specify customize output folder if wanted')
+@click.option('--threads', '-t', type=int, required=False, default=1, help='number of processes counting the read files of a sample in parallel')
+@click.option('--prefetch', type=click.IntRange(min=0), required=False, default=0, help='reads decompressed ahead of the counting in background threads, 0 for none')
+@click.option('--jobs', '-j', type=int, required=False, default=1, help='number of samples counted at the same time')
+@click.option('--job-memory', type=float, required=False, default=JOB_MEMORY / 1024 ** 3, help='GB of memory one job may use, limits the number of jobs')
+@click.option('--force', '-f', is_flag=True, default=False, help='count every sample again, also those with up to date results')
+@click.option('--prefilter', is_flag=True, default=False, help='skip the pattern count for reads too short or with too few copies of a seed of the pattern')
+@click.option('--max-mismatches', type=click.IntRange(min=0), required=False, default=0, help='substituted bases a match of the pattern may have, 0 for exact matches')
+@click.option('--sample-name', '-n', type=str, required=False, default=None, help='name for the output files instead of the sample name of the FASTQ files')
+def count_fastq(inputs, pattern, barcodes, whitelist, cutoff, output, threads, prefetch, jobs, job_memory, force, prefilter, max_mismatches, sample_name):
+    
+    '''Count the telomeric reads of each cell from the FASTQ files of a 10x ATAC library, before alignment.
+    Writes the same count, total and missed files as count.
+    
+    Required arguments:
+    
+    inputs: a folder searched for FASTQ files named like cell ranger and bcl2fastq name them,
+        sample_S1_L001_R1_001.fastq.gz, or one FASTQ file of a sample. Every sample is counted from all its
+        lanes: the genomic reads R1 and R3 are paired with the barcode read R2 (or R1 and R2 with I2).
+    
+    Optional arguments:
+    
+    pattern: a pattern which TeloMemore searches the reads for. 'CCCTAA' as default. The reads are counted
+        in the orientation they were sequenced in, R1 and R3 of a telomeric fragment are opposite strands.
+    
+    cutoff: integer for which Telomemore uses as cutoff for counting read as telomere. Default = 3.
+    
+    barcodes: barcode file of the cells, e.g. filtered_peak_bc_matrix/barcodes.tsv of an earlier run. Only these
+        cells are counted, under their names in the file.
+    
+    whitelist: barcode whitelist of the chemistry, e.g. 737K-cratac-v1.txt of cell ranger ATAC. The barcode reads
+        are corrected to a whitelist barcode one substitution away, if only one is, and the other reads are
+        left out. Without it the barcodes are corrected against the barcode file, and without either they
+        are counted as read.
+    
+    output: Specify folder to which the count files should be written. Default is the folder of the FASTQ files.
+    
+    threads: Number of processes. The genomic read files of every lane are decompressed and counted in
+        parallel. Default = 1.
+    
+    prefetch: Decompress and parse this many records at a time in background threads, ahead of the counting.
+        Default = 0, no read-ahead.
+    
+    jobs: Number of samples counted at the same time. Default = 1.
+    
+    force: Count every sample again. By default a sample is skipped when its results were written by an earlier
+        run with the same settings and the FASTQ, barcode and whitelist files are unchanged.
+    
+    prefilter: Reject reads that cannot reach the cutoff before counting the pattern, see count.
+    
+    max_mismatches: Count matches of the pattern with up to this many substituted bases, see count.
+    
+    sample_name: Name the output files after this instead of the sample of the FASTQ files, for one sample.
+    
+    '''
+    
+    check_mismatches([pattern], max_mismatches, prefilter)
+    matcher = PrefilterMatcher if prefilter else TelomereMatcher
+    from telomemore.filehandler import FastqFiles
+    from telomemore.fastq import NobarcodeFastqProgramTelomemore, BarcodeFastqProgramTelomemore
+    from telomemore.telomemore import TeloMemore
+    files, barcodes = find_inputs(FastqFiles, inputs, barcodes, force)
+    check_inputs(files, sample_name)
+    
+    if barcodes is not None:
+        program = BarcodeFastqProgramTelomemore(whitelist=whitelist, threads=threads, matcher=matcher, prefetch=prefetch, max_mismatches=max_mismatches)
+        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, barcode=barcodes, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name)
+        run_counts(telomemore)
+    else:
+        program = NobarcodeFastqProgramTelomemore(whitelist=whitelist, threads=threads, matcher=matcher, prefetch=prefetch, max_mismatches=max_mismatches)
+        telomemore = TeloMemore(pattern=pattern, files=files, program=program, cutoff=cutoff, output_dir=output, jobs=jobs, job_memory=int(job_memory * 1024 ** 3), resume=not force, sample_name=sample_name)
+        run_counts(telomemore)
+    
+    
+@cli.command()
+@click.option('--inputs', '-i', type=str, required=True, help='folder with the count tables of count-copy')
+@click.option('--output', '-o', type=str, required=True, help='parquet dataset folder or csv file to write')
+@click.option('--format', 'output_format', type=click.Choice(FORMATS), required=False, default='parquet', help='write a parquet dataset or one csv file')
+def merge(inputs, output, output_format):
+    
+    '''Merge the count tables of all samples into one table. 
+    
+    Every csv or parquet count table found under the input folder is read a chunk at a time and appended
+    to the output, so the merged table never has to fit in memory. Parquet output is a dataset folder with
+    one partition per pattern (output/pattern=CCCTAA/part-0.parquet) which pandas.read_parquet and
+    pyarrow.dataset read as one table. The headerless tables of count are skipped.
+    '''
+    
+    if output_format == 'parquet':
+        require_pyarrow()
+    from telomemore.output import merge_outputs
+    rows = merge_outputs(inputs, output, output_format)
+    print(f'{rows} rows written to {output}')
@@ -0,0 +1,101 @@
+from array import array
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import numpy as np
+
+
+@dataclass
+class Count:
+    '''Hold telomere count and total count when going through bam files.'''
+    telomere: int = 0
+    total: int = 0
+
+    def add(self, other: 'Count') -> None:
+        self.telomere += other.telomere
+        self.total += other.total
+
+
+@dataclass
+class ReadStats:
+    '''Reads left out of the counts, either missing the CB tag or sequence or with a barcode outside the whitelist,
+    counted reads the prefilter rejected before the matcher ran, and reads of barcodes a bounded count dropped.'''
+    missing: int = 0
+    off_whitelist: int = 0
+    prefiltered: int = 0
+    dropped: int = 0
+
+    def add(self, other: 'ReadStats') -> None:
+        self.missing += other.missing
+        self.off_whitelist += other.off_whitelist
+        self.prefiltered += other.prefiltered
+        self.dropped += other.dropped
+
+    def __str__(self) -> str:
+        return (f'{self.missing} reads missing a barcode or sequence, {self.off_whitelist} reads outside the whitelist, '
+                f'{self.prefiltered} reads rejected by the prefilter, {self.dropped} reads of dropped barcodes')
+
+
+class BarcodeCounts:
+    '''Telomere and total read counts per barcode. Every barcode is interned to a dense integer id the first
+    time it is seen and the counts live in two int64 columns indexed by that id. With a whitelist the ids are
+    given in whitelist order up front and other barcodes are never added.'''
+
+    def __init__(self, whitelist: Optional[Iterable[str]] = None):
+        self.index = {}
+        self.telomere = array('q')
+        self.total = array('q')
+        for cb in whitelist or []:
+            self.intern(cb)
+        self.whitelist = whitelist is not None
+
+    def intern(self, cb: str) -> int:
+        '''Id of the barcode, adding it with zero counts if it is new.'''
+        i = self.index.get(cb)
+        if i is None:
+            i = self.index[cb] = len(self.index)
+            self.telomere.append(0)
+            self.total.append(0)
+        return i
+
+    def ids(self, cbs: List[str]) -> np.ndarray:
+        '''Ids of a batch of barcodes. Barcodes outside the whitelist get -1, without a whitelist new
+        barcodes are interned.'''
+        if self.whitelist:
+            index = self.index
+            return np.fromiter((index.get(cb, -1) for cb in cbs), dtype=np.int64, count=len(cbs))
+        return np.fromiter(map(self.intern, cbs), dtype=np.int64, count=len(cbs))
+
+    def merge(self, other: 'BarcodeCounts') -> None:
+        '''Adds the counts of another store, new barcodes are added in the order of the other store.'''
+        ids = np.fromiter(map(self.intern, other.index), dtype=np.int64, count=len(other))
+        np.add.at(np.frombuffer(self.total, dtype=np.int64), ids, np.frombuffer(other.total, dtype=np.int64))
+        np.add.at(np.frombuffer(self.telomere, dtype=np.int64), ids, np.frombuffer(other.telomere, dtype=np.int64))
+
+    @property
+    def barcodes(self) -> List[str]:
+        return list(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, cb: str) -> bool:
+        return cb in self.index
+
+    def __getitem__(self, cb: str) -> Count:
+        i = self.index[cb]
+        return Count(self.telomere[i], self.total[i])
+
+    def items(self) -> Iterator[Tuple[str, Count]]:
+        for cb, i in self.index.items():
+            yield cb, Count(self.telomere[i], self.total[i])
+
+    def columns(self) -> Dict[str, object]:
+        '''The bc, count and total columns, the counts as numpy arrays.'''
+        return {'bc': self.barcodes,
+                'count': np.frombuffer(self.telomere, dtype=np.int64).copy(),
+                'total': np.frombuffer(self.total, dtype=np.int64).copy()}
+
+    def to_frame(self) -> 'pandas.DataFrame':
+        '''DataFrame with the bc, count and total columns, built straight from the count columns.'''
+        import pandas as pd
+        return pd.DataFrame(self.columns())
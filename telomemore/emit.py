@@ -0,0 +1,122 @@
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, List, Optional
+import pysam
+from telomemore.matcher import TelomereMatcher
+from telomemore.regions import is_stdin, open_alignments
+
+# Tag of the emitted reads holding the number of matches of the pattern, on the strand with the most.
+REPEATS_TAG = 'tr'
+# Reads handed to the writer thread at a time, and batches it may hold before the counting loop waits.
+EMIT_BATCH = 1000
+EMIT_DEPTH = 16
+
+
+def reads_file(table: Path) -> Path:
+    '''The telomeric reads file next to a count table, sample_telomemore_reads_CCCTAA.bam for
+    sample_telomemore_count_CCCTAA.csv.'''
+    table = Path(table)
+    return table.with_name(table.name.replace('telomemore_count_', 'telomemore_reads_', 1)).with_suffix('.bam')
+
+
+class ReadEmitter:
+    '''Writes the telomeric reads of one part of the bam file to a part file of the folder, each tagged with its
+    repeats. Reads are collected in batches and written by a background thread, so compressing them does not
+    hold up the counting loop, which only waits when the thread is depth batches behind. The part file is
+    made with the header of the first read, parts without telomeric reads write nothing. Errors of the writer
+    are raised by close.'''
+
+    def __init__(self, folder: Path, matcher: TelomereMatcher, batch_size: int = EMIT_BATCH, depth: int = EMIT_DEPTH):
+        self.folder = Path(folder)
+        self.matcher = matcher
+        self.batch_size = batch_size
+        self.batch = []
+        self.batches = queue.Queue(maxsize=depth)
+        self.thread = None
+        self.error = None
+        self.emitted = 0
+
+    def add(self, read: pysam.AlignedSegment, seq: str) -> None:
+        read.set_tag(REPEATS_TAG, max(self.matcher.counts(seq)), value_type='i')
+        self.batch.append(read)
+        if len(self.batch) == self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.batch:
+            return
+        if self.thread is None:
+            handle, path = tempfile.mkstemp(dir=self.folder, suffix='.bam')
+            os.close(handle)
+            self.thread = threading.Thread(target=self.write, args=(path, self.batch[0].header), name='telomemore-emit', daemon=True)
+            self.thread.start()
+        self.emitted += len(self.batch)
+        self.batches.put(self.batch)
+        self.batch = []
+
+    def write(self, path: str, header: pysam.AlignmentHeader) -> None:
+        try:
+            # Uncompressed, the parts are compressed once when they are sorted together.
+            with pysam.AlignmentFile(path, 'wbu', header=header) as out:
+                for batch in iter(self.batches.get, None):
+                    for read in batch:
+                        out.write(read)
+        except BaseException as error:
+            self.error = error
+            # Keep taking batches so the counting loop does not wait forever.
+            for _ in iter(self.batches.get, None):
+                pass
+
+    def close(self) -> int:
+        '''Writes what is left, waits for the writer and returns the number of reads emitted.'''
+        self.flush()
+        if self.thread is not None:
+            self.batches.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.emitted
+
+
+def sort_reads(folder: Path, sam: Path, path: Path, reference: Optional[str] = None) -> None:
+    '''Sorts the part files of the folder by coordinate into path and indexes it. Without any parts the
+    file only has the header of the bam file, which is empty for standard input.'''
+    parts: List[str] = [str(part) for part in sorted(Path(folder).glob('*.bam'))]
+    unsorted = Path(folder) / 'unsorted.bam.tmp'
+    if not parts:
+        if is_stdin(sam):
+            header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6'}})
+        else:
+            with open_alignments(sam, reference) as sam_file:
+                header = sam_file.header
+        with pysam.AlignmentFile(str(unsorted), 'wbu', header=header):
+            pass
+    elif len(parts) == 1:
+        unsorted = parts[0]
+    else:
+        pysam.cat('-o', str(unsorted), *parts, catch_stdout=False)
+    sorted_file = Path(folder) / 'sorted.bam.tmp'
+    pysam.sort('-o', str(sorted_file), '-O', 'bam', '-T', str(Path(folder) / 'sort'), str(unsorted), catch_stdout=False)
+    pysam.index('-b', str(sorted_file), f'{sorted_file}.bai', catch_stdout=False)
+    os.replace(sorted_file, path)
+    os.replace(f'{sorted_file}.bai', f'{path}.bai')
+
+
+@contextmanager
+def emitting(sam: Path, path: Optional[Path], reference: Optional[str] = None) -> Iterator[Optional[Path]]:
+    '''A folder for the ReadEmitters of a count to write their parts to, which are sorted into path when the
+    with block is left without errors. None if no reads file is wanted.'''
+    if path is None:
+        yield None
+        return
+    folder = Path(tempfile.mkdtemp(prefix='telomemore_reads_', dir=Path(path).parent))
+    try:
+        yield folder
+        sort_reads(folder, sam, path, reference)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
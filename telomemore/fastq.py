@@ -0,0 +1,260 @@
+import gzip
+import os
+import re
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, closing
+from functools import partial
+from itertools import chain, islice, zip_longest
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from telomemore.barcodes import read_whitelist
+from telomemore.cache import file_state
+from telomemore.counts import ReadStats
+from telomemore.matcher import TelomereMatcher, reverse_comp
+from telomemore.programs import BarcodeProgramTelomemore, NobarcodeProgramTelomemore, ProgramTelomemore
+from telomemore.regions import read_ahead
+
+# Illumina file names, sample_S1_L001_R1_001.fastq.gz, the lane is left out by bcl2fastq --no-lane-splitting.
+FASTQ_NAME = re.compile(r'^(?P<sample>.+?)_S\d+(?:_L(?P<lane>\d+))?_(?P<read>[RI][1-4])_\d+\.f(?:ast)?q(?:\.gz)?$')
+# Barcode reads used to find out whether the barcodes are read in the orientation of the whitelist.
+ORIENT_READS = 10_000
+
+
+class FastqLane(NamedTuple):
+    '''The files of one lane: the barcode read and the genomic reads paired with it.'''
+    barcode: Path
+    reads: List[Path]
+
+
+class FastqSample(NamedTuple):
+    '''The lanes of one sample in a folder of FASTQ files.'''
+    sample: str
+    lanes: List[FastqLane]
+
+    @property
+    def files(self) -> List[Path]:
+        return [file for lane in self.lanes for file in [lane.barcode, *lane.reads]]
+
+
+def pair_lane(reads: Dict[str, Path]) -> FastqLane:
+    '''The barcode and genomic reads of a lane. Cell Ranger ATAC names the 16 bp barcode read R2 and the
+    genomic reads R1 and R3, bcl-convert without a cell ranger sample sheet names it I2 and the genomic
+    reads R1 and R2.'''
+    if {'R1', 'R2', 'R3'} <= reads.keys():
+        return FastqLane(reads['R2'], [reads['R1'], reads['R3']])
+    if {'R1', 'R2', 'I2'} <= reads.keys():
+        return FastqLane(reads['I2'], [reads['R1'], reads['R2']])
+    raise ValueError(f'no barcode read with the genomic reads of {", ".join(str(file) for file in sorted(reads.values()))}')
+
+
+def group_fastqs(files: Iterable[Path]) -> List[FastqSample]:
+    '''Groups FASTQ files by folder, sample and lane. Files that are not named like Illumina FASTQ files are
+    left out. Raises ValueError for a lane without a barcode read.'''
+    lanes = defaultdict(dict)
+    for file in files:
+        match = FASTQ_NAME.match(file.name)
+        if match is not None:
+            lanes[file.parent, match['sample'], match['lane'] or ''][match['read']] = file
+
+    samples = defaultdict(list)
+    for (folder, sample, lane), reads in sorted(lanes.items()):
+        samples[folder, sample].append(pair_lane(reads))
+    names = [sample for _, sample in samples]
+    return [FastqSample(sample if names.count(sample) == 1 else f'{folder.name}_{sample}', lanes)
+            for (folder, sample), lanes in samples.items()]
+
+
+def find_fastqs(path: Path) -> List[FastqSample]:
+    '''The FASTQ samples of a folder, searched with its subfolders, or the sample of one of its FASTQ files.'''
+    path = Path(path)
+    if path.is_file():
+        samples = [sample for sample in group_fastqs(path.parent.iterdir()) if path in sample.files]
+        if not samples:
+            raise ValueError(f'{path} is not a FASTQ file of a 10x sample, like sample_S1_L001_R1_001.fastq.gz')
+        return samples
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        files += [Path(root) / name for name in names]
+    return group_fastqs(files)
+
+
+def sample_of(path: Path) -> FastqSample:
+    '''The sample a FASTQ file belongs to, found again from the files of its folder.'''
+    return find_fastqs(path)[0]
+
+
+def read_fastq(path: Path) -> Iterator[Tuple[str, str]]:
+    '''Name and sequence of every record of a FASTQ file, gzipped or not.'''
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt') as handle:
+        for name, seq, _, _ in zip(handle, handle, handle, handle):
+            yield name, seq.rstrip()
+
+
+def paired_reads(barcodes: Iterable[Tuple[str, str]], reads: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+    '''Barcode and sequence of every read, checking that the records of the two files are of the same reads.'''
+    for barcode_record, record in zip_longest(barcodes, reads):
+        if barcode_record is None or record is None:
+            raise ValueError('the barcode and genomic read files do not have the same number of reads')
+        (barcode_name, barcode), (name, seq) = barcode_record, record
+        if barcode_name.split(None, 1)[0] != name.split(None, 1)[0]:
+            raise ValueError(f'the barcode and genomic reads are not in the same order: {barcode_name.split(None, 1)[0]} and {name.split(None, 1)[0]}')
+        yield barcode, seq
+
+
+class BarcodeCorrector:
+    '''Corrects barcode reads to barcodes of a whitelist: a read that is a whitelist barcode is kept, and a read
+    with one substitution or N is corrected if exactly one whitelist barcode is that close, otherwise it is
+    left out. Whitelist barcodes may carry a GEM well suffix like -1, which the reads do not have, and the
+    barcodes are returned as they are in the whitelist. The reads are reverse complemented first if the
+    barcode read of the sequencer reads the barcodes in the other orientation, see orient.'''
+
+    def __init__(self, whitelist: Iterable[str]):
+        self.barcodes = {cb.split('-', 1)[0]: cb for cb in whitelist}
+        self.reverse = False
+
+    def orient(self, barcodes: Iterable[str]) -> None:
+        '''Reverse complements the reads if more of the barcodes match the whitelist that way.'''
+        forward, reverse = 0, 0
+        for barcode in barcodes:
+            forward += barcode in self.barcodes
+            reverse += reverse_comp(barcode) in self.barcodes
+        self.reverse = reverse > forward
+
+    def correct(self, barcode: str) -> Optional[str]:
+        if self.reverse:
+            barcode = reverse_comp(barcode)
+        found = self.barcodes.get(barcode)
+        if found is not None:
+            return found
+        for i, base in enumerate(barcode):
+            for other in 'ACGT':
+                if other == base:
+                    continue
+                candidate = self.barcodes.get(f'{barcode[:i]}{other}{barcode[i + 1:]}')
+                if candidate is not None:
+                    if found is not None:
+                        return None
+                    found = candidate
+        return found
+
+
+def oriented(records: Iterator[Tuple[str, str]], corrector: BarcodeCorrector) -> Iterator[Tuple[str, str]]:
+    '''Orients the corrector on the first barcode reads and yields all records.'''
+    first = list(islice(records, ORIENT_READS))
+    corrector.orient(barcode for barcode, _ in first)
+    return chain(first, records)
+
+
+def count_fastq(barcode_file: Path, read_file: Path, matcher: TelomereMatcher, whitelist: Optional[Path] = None,
+                cells: Optional[List[str]] = None, prefetch: int = 0) -> Tuple[dict, dict, ReadStats]:
+    '''Telomeric and total reads per barcode of one genomic read file and its barcode read file. With a
+    whitelist, or else the cells, the barcodes are corrected against it and reads that cannot be corrected are
+    outside the whitelist. With cells only the cells are counted. With prefetch both files are decompressed
+    and parsed in background threads, in batches of that many records.'''
+    corrector = None
+    if whitelist is not None or cells is not None:
+        corrector = BarcodeCorrector(read_whitelist(whitelist) if whitelist is not None else cells)
+    cell_of = None if cells is None else {cb.split('-', 1)[0]: cb for cb in cells}
+    telomeres_cells = defaultdict(int)
+    total_reads_cells = defaultdict(int)
+    stats = ReadStats()
+    rejected = matcher.rejected
+
+    def sequences(records: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+        for barcode, seq in records:
+            if not barcode:
+                stats.missing += 1
+                continue
+            if corrector is None:
+                cb = barcode
+            else:
+                cb = corrector.correct(barcode)
+                if cb is not None and cell_of is not None:
+                    cb = cell_of.get(cb.split('-', 1)[0])
+                if cb is None:
+                    stats.off_whitelist += 1
+                    continue
+            if not seq:
+                stats.missing += 1
+                continue
+            total_reads_cells[cb] += 1
+            yield cb, seq
+
+    with ExitStack() as stack:
+        barcodes, reads = read_fastq(barcode_file), read_fastq(read_file)
+        if prefetch:
+            barcodes = stack.enter_context(closing(read_ahead(barcodes, prefetch)))
+            reads = stack.enter_context(closing(read_ahead(reads, prefetch)))
+        records = paired_reads(barcodes, reads)
+        if corrector is not None:
+            records = oriented(records, corrector)
+
+        for cb, _, telomeric in matcher.classified(sequences(records)):
+            if telomeric:
+                telomeres_cells[cb] += 1
+
+    stats.prefiltered = matcher.rejected - rejected
+    return telomeres_cells, total_reads_cells, stats
+
+
+class FastqProgramTelomemore(ProgramTelomemore):
+    '''Counts telomeric reads per barcode straight from the gzipped FASTQ files of a 10x ATAC library, before
+    alignment. Every genomic read, R1 and R3, is paired with the barcode read of its lane and counted like a
+    read of the bam file, so the totals are about twice the read pairs. Without alignment the reads are in
+    the orientation they were sequenced in rather than that of the reference.
+
+    A sample is given by any of its FASTQ files and counted from all its lanes. The genomic read files of
+    every lane are counted in parallel in a process pool of threads processes, each decompressing its own
+    files, and with prefetch the files are also decompressed ahead of the counting in background threads.
+    Barcodes are corrected against the whitelist if one is given, like the 10x barcode whitelist of the
+    chemistry, or else against the barcode file.'''
+
+    def __init__(self, whitelist: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.whitelist = whitelist
+
+    def input_key(self, sam: Path) -> dict:
+        return {'fastqs': [file_state(file) for file in sample_of(sam).files], 'whitelist': file_state(self.whitelist)}
+
+    def fastq_count(self, fastq: Path, cells: Optional[List[str]], cutoff: int, pattern: str,
+                    reads_file: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        if reads_file is not None:
+            raise ValueError('telomeric reads are emitted from bam files, the reads of FASTQ files are not aligned')
+        sample = sample_of(fastq)
+        matcher = self.make_matcher(pattern, cutoff)
+        units = [(lane.barcode, reads) for lane in sample.lanes for reads in lane.reads]
+        count = partial(count_fastq, matcher=matcher, whitelist=self.whitelist, cells=cells, prefetch=self.prefetch)
+        if self.threads > 1 and len(units) > 1:
+            print(f'Counting {len(units)} read files of {sample.sample} on {self.threads} processes')
+            with ProcessPoolExecutor(max_workers=min(self.threads, len(units))) as pool:
+                results = list(pool.map(count, *zip(*units)))
+        else:
+            results = [count(barcode, reads) for barcode, reads in units]
+
+        telomeres_cells = defaultdict(int) if cells is None else dict.fromkeys(cells, 0)
+        total_reads_cells = defaultdict(int) if cells is None else dict.fromkeys(cells, 0)
+        read_stats = ReadStats()
+        for telomeres, totals, stats in results:
+            for cb, value in totals.items():
+                total_reads_cells[cb] += value
+            for cb, value in telomeres.items():
+                telomeres_cells[cb] += value
+            read_stats.add(stats)
+
+        print(f'Reads of {sample.sample}: {read_stats}')
+        return telomeres_cells, total_reads_cells, read_stats
+
+
+class NobarcodeFastqProgramTelomemore(FastqProgramTelomemore, NobarcodeProgramTelomemore):
+
+    def telomere_count(self, fastq: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        return self.fastq_count(fastq, None, cutoff, pattern, reads_file)
+
+
+class BarcodeFastqProgramTelomemore(FastqProgramTelomemore, BarcodeProgramTelomemore):
+
+    def telomere_count(self, fastq: Path, barcode: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        return self.fastq_count(fastq, read_whitelist(barcode), cutoff, pattern, reads_file)
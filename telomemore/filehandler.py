@@ -1,16 +1,27 @@
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from telomemore.regions import is_stdin
+from telomemore.fastq import find_fastqs
+from telomemore.samples import find_files, is_sample_sheet, read_sample_sheet
 
 class Files:
-    '''Returns list of one file or list of all bam files is input is a folder.'''
-    def __init__(self, path: str):
-        self.files = self.init_files(path)
+    '''Returns list of one file, standard input for -, the bam files of a sample sheet, or list of all bam and cram
+    files is input is a folder. Samples of a sample sheet are named after their sample.'''
+    def __init__(self, path: str, rescan: bool = False):
+        self.names = {}
+        self.samples = []
+        self.files = self.init_files(path, rescan)
         
-    def init_files(self, path: str) -> List[Path]:
+    def init_files(self, path: str, rescan: bool = False) -> List[Path]:
+        if is_stdin(path):
+            return [Path(path)]
+        if is_sample_sheet(path):
+            self.samples = read_sample_sheet(path)
+            self.names = {sample.bam: sample.sample for sample in self.samples}
+            return [sample.bam for sample in self.samples]
         if Path(path).is_file():
             return [Path(path)]
-        
-        return sorted([bam for bam in Path(path).rglob('*.bam') if bam.is_file()])
+        return find_files(path, rescan).bams
     
     @classmethod
     def make_folder(cls, input_folder: str) -> None:
@@ -19,23 +30,35 @@ class Files:
             path.mkdir(exist_ok=True, parents=True)
     
     @classmethod
-    def save_files_default(cls, file: Path, pattern: str) -> Tuple[Path, Path, Path]:
-        telomere_file = file.parent / f'telomemore_count_{pattern}.csv'
-        totalreads_file = file.parent / f'telomemore_total_{pattern}.csv'
-        missed_barcods_file = file.parent / f'telomemore_missed.txt'
+    def save_files_default(cls, file: Path, pattern: str, name: Optional[str] = None) -> Tuple[Path, Path, Path]:
+        prefix = f'{name}_' if name else ''
+        telomere_file = file.parent / f'{prefix}telomemore_count_{pattern}.csv'
+        totalreads_file = file.parent / f'{prefix}telomemore_total_{pattern}.csv'
+        missed_barcods_file = file.parent / f'{prefix}telomemore_missed.txt'
         
         return telomere_file, totalreads_file, missed_barcods_file
         
     @classmethod
-    def save_files_output(cls, file: Path, input_folder: str, pattern: str) -> Tuple[Path, Path, Path]:
+    def save_files_output(cls, file: Path, input_folder: str, pattern: str, name: Optional[str] = None) -> Tuple[Path, Path, Path]:
         folder = Path(input_folder)
         
         cls.make_folder(folder)
         
-        telomere_file = folder / f'{file.stem}_telomemore_count_{pattern}.csv'
-        totalreads_file = folder / f'{file.stem}_telomemore_total_{pattern}.csv'
-        missed_barcods_file = folder / f'{file.stem}_telomemore_missed.txt'
+        telomere_file = folder / f'{name or file.stem}_telomemore_count_{pattern}.csv'
+        totalreads_file = folder / f'{name or file.stem}_telomemore_total_{pattern}.csv'
+        missed_barcods_file = folder / f'{name or file.stem}_telomemore_missed.txt'
         
         return telomere_file, totalreads_file, missed_barcods_file
+
+
+class FastqFiles(Files):
+    '''The 10x FASTQ samples of a folder, or the sample of one FASTQ file. Every sample is given by the barcode
+    read file of its first lane and its outputs are named after the sample.'''
+    def init_files(self, path: str, rescan: bool = False) -> List[Path]:
+        samples = find_fastqs(path)
+        if not samples:
+            raise ValueError(f'no 10x FASTQ files like sample_S1_L001_R1_001.fastq.gz in {path}')
+        self.names = {sample.lanes[0].barcode: sample.sample for sample in samples}
+        return list(self.names)
     
 #WORKS
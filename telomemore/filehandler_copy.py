@@ -1,15 +1,26 @@
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
+from telomemore.regions import is_stdin
+from telomemore.samples import find_files, is_sample_sheet, read_sample_sheet
 
 class Files_copy:
-    '''Returns list of one file or list of all bam files is input is a folder.'''
-    def __init__(self, path: str):
-        self.files = self.init_files(path)
+    '''Returns list of one file, standard input for -, the bam files of a sample sheet, or list of all bam and cram
+    files is input is a folder. Samples of a sample sheet are named after their sample.'''
+    def __init__(self, path: str, rescan: bool = False):
+        self.names = {}
+        self.samples = []
+        self.files = self.init_files(path, rescan)
         
-    def init_files(self, path: str) -> List[Path]:
+    def init_files(self, path: str, rescan: bool = False) -> List[Path]:
+        if is_stdin(path):
+            return [Path(path)]
+        if is_sample_sheet(path):
+            self.samples = read_sample_sheet(path)
+            self.names = {sample.bam: sample.sample for sample in self.samples}
+            return [sample.bam for sample in self.samples]
         if Path(path).is_file():
             return [Path(path)]
-        return sorted([bam for bam in Path(path).rglob('*.bam') if bam.is_file()])
+        return find_files(path, rescan).bams
     
     @classmethod
     def make_folder(cls, input_folder: str) -> None:
@@ -18,14 +29,15 @@ class Files_copy:
             path.mkdir(exist_ok=True, parents=True)
     
     @classmethod
-    def save_files_default(cls, file: Path, pattern: str) -> Path:
-        telomere_file = file.parent / f'telomemore_count_{pattern}.csv'
+    def save_files_default(cls, file: Path, pattern: str, name: Optional[str] = None) -> Path:
+        prefix = f'{name}_' if name else ''
+        telomere_file = file.parent / f'{prefix}telomemore_count_{pattern}.csv'
         return telomere_file
         
     @classmethod
-    def save_files_output(cls, file: Path, input_folder: str, pattern: str) -> Tuple[Path, Path, Path]:
+    def save_files_output(cls, file: Path, input_folder: str, pattern: str, name: Optional[str] = None) -> Tuple[Path, Path, Path]:
         folder = Path(input_folder)
         cls.make_folder(folder)
-        telomere_file = folder / f'{file.stem}_telomemore_count_{pattern}.csv'
+        telomere_file = folder / f'{name or file.stem}_telomemore_count_{pattern}.csv'
         return telomere_file
     
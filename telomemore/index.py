@@ -0,0 +1,235 @@
+import hashlib
+import json
+from array import array
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+import pysam
+from telomemore.cache import atomic_open, cache_folder
+from telomemore.counts import BarcodeCounts, ReadStats
+from telomemore.matcher import TelomereMatcher
+from telomemore.regions import is_stdin, scan_bam
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.telomemore.idx'
+MAGIC = b'TELOIDX\n'
+ALIGN = 64
+
+
+def index_path(sam: Path, key: str, strands: List[str], folder: Optional[Path] = None) -> Path:
+    '''The sidecar index of a bam file for a pattern, sample.bam.<hash of the pattern, mismatches and strands>.telomemore.idx
+    next to sample.bam. In another folder the name also holds a hash of the full path of the bam file, so bam
+    files of the same name in different folders get their own index.'''
+    name = f"{hashlib.sha1(' '.join([key, *strands]).encode()).hexdigest()[:10]}{INDEX_SUFFIX}"
+    if folder is None:
+        return Path(f'{sam}.{name}')
+    return Path(folder) / f'{Path(sam).name}.{hashlib.sha1(str(Path(sam).resolve()).encode()).hexdigest()[:10]}.{name}'
+
+
+def index_paths(sam: Path, matcher: TelomereMatcher) -> List[Path]:
+    '''Where the index of a bam file for the matcher is looked for and written, in order: next to the bam file
+    and, for bam files in folders that cannot be written to, in the cache folder.'''
+    return [index_path(sam, matcher.key, matcher.strands),
+            index_path(sam, matcher.key, matcher.strands, cache_folder() / 'index')]
+
+
+def bam_state(sam: Path) -> dict:
+    '''Size and modification time of the bam file, an index made from another version of the file is stale.'''
+    stat = Path(sam).stat()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ReadIndex:
+    '''Telomere-read index of part of a bam file while it is scanned. Every read with a CB tag and a sequence
+    adds to the total of its barcode, and reads with at least one match on any strand are kept as a hit with
+    their barcode id, the number of matches on every strand and their position. Barcodes are interned in the
+    order their first read with a sequence is seen. Reads with a CB tag but no sequence are only counted per
+    barcode, so re-whitelisting can still tell missing reads from reads outside the whitelist.'''
+
+    def __init__(self, strands: int):
+        self.strands = strands
+        self.index = {}
+        self.total = array('q')
+        self.unsequenced = {}
+        self.missing = 0
+        self.hit_barcode = array('i')
+        self.hit_repeats = array('i')
+        self.hit_contig = array('i')
+        self.hit_position = array('q')
+
+    def intern(self, cb: str) -> int:
+        i = self.index.get(cb)
+        if i is None:
+            i = self.index[cb] = len(self.index)
+            self.total.append(0)
+        return i
+
+    def add(self, cb: str, repeats: Tuple[int, ...], contig: int, position: int) -> None:
+        i = self.intern(cb)
+        self.total[i] += 1
+        if any(repeats):
+            self.hit_barcode.append(i)
+            self.hit_repeats.extend(repeats)
+            self.hit_contig.append(contig)
+            self.hit_position.append(position)
+
+    def merge(self, other: 'ReadIndex') -> None:
+        '''Appends the index of the next part of the bam file.'''
+        ids = array('i', map(self.intern, other.index))
+        for i, total in zip(ids, other.total):
+            self.total[i] += total
+        for cb, reads in other.unsequenced.items():
+            self.unsequenced[cb] = self.unsequenced.get(cb, 0) + reads
+        self.missing += other.missing
+        self.hit_barcode.extend(ids[i] for i in other.hit_barcode)
+        self.hit_repeats.extend(other.hit_repeats)
+        self.hit_contig.extend(other.hit_contig)
+        self.hit_position.extend(other.hit_position)
+
+    def arrays(self) -> dict:
+        '''The index as numpy arrays. Barcodes only seen on reads without a sequence are put last.'''
+        barcodes = list(self.index) + [cb for cb in self.unsequenced if cb not in self.index]
+        total = np.zeros(len(barcodes), dtype=np.int64)
+        total[:len(self.index)] = self.total
+        unsequenced = np.fromiter((self.unsequenced.get(cb, 0) for cb in barcodes), dtype=np.int64, count=len(barcodes))
+        return {'barcodes': np.array(barcodes, dtype=bytes) if barcodes else np.empty(0, dtype='S1'),
+                'total': total,
+                'unsequenced': unsequenced,
+                'hit_barcode': np.frombuffer(self.hit_barcode, dtype=np.int32),
+                'hit_repeats': np.frombuffer(self.hit_repeats, dtype=np.int32).reshape(-1, self.strands),
+                'hit_contig': np.frombuffer(self.hit_contig, dtype=np.int32),
+                'hit_position': np.frombuffer(self.hit_position, dtype=np.int64)}
+
+
+def index_reads(reads: Iterable[pysam.AlignedSegment], matcher: TelomereMatcher) -> ReadIndex:
+    '''Indexes the reads with the number of matches of every strand of the matcher, whatever the cutoff.'''
+    index = ReadIndex(len(matcher.strands))
+    for read in reads:
+        try:
+            cb = read.get_tag('CB')
+        except KeyError:
+            index.missing += 1
+            continue
+        seq = read.query_sequence
+        if seq is None:
+            index.unsequenced[cb] = index.unsequenced.get(cb, 0) + 1
+            continue
+        index.add(cb, matcher.counts(seq), read.reference_id, read.reference_start)
+    return index
+
+
+class TelomereIndex:
+    '''Sidecar index of a bam file for one pattern, from which the counts of any cutoff and any whitelist are
+    read without scanning the bam file again.
+
+    The file is a magic line and the length of a JSON header, followed by the arrays of ReadIndex.arrays
+    aligned to 64 bytes. The header holds the format version, the size and modification time of the bam file
+    it was made from, the strands of the pattern and the dtype, shape and offset of every array, so the arrays
+    are memory mapped rather than read.'''
+
+    def __init__(self, header: dict, arrays: dict):
+        self.header = header
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, path: Path) -> 'TelomereIndex':
+        with open(path, 'rb') as handle:
+            if handle.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a telomemore index')
+            length = int.from_bytes(handle.read(8), 'little')
+            header = json.loads(handle.read(length))
+        start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+        arrays = {}
+        for name, layout in header['arrays'].items():
+            dtype, shape = np.dtype(layout['dtype']), tuple(layout['shape'])
+            if 0 in shape:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=start + layout['offset'], shape=shape)
+        return cls(header, arrays)
+
+    @staticmethod
+    def write(path: Path, sam: Path, strands: List[str], index: ReadIndex) -> None:
+        arrays = index.arrays()
+        layouts, offset = {}, 0
+        for name, values in arrays.items():
+            layouts[name] = {'dtype': values.dtype.str, 'shape': list(values.shape), 'offset': offset}
+            offset = -(-(offset + values.nbytes) // ALIGN) * ALIGN
+        header = json.dumps({'version': INDEX_VERSION, 'bam': bam_state(sam), 'strands': strands,
+                             'missing': index.missing, 'arrays': layouts}).encode()
+        start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+        with atomic_open(path, 'wb') as handle:
+            handle.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+            for name, values in arrays.items():
+                handle.seek(start + layouts[name]['offset'])
+                handle.write(np.ascontiguousarray(values).tobytes())
+
+    def is_current(self, sam: Path, strands: List[str]) -> bool:
+        '''True if the index was made from this version of the bam file and counts these strands.'''
+        header = self.header
+        return header['version'] == INDEX_VERSION and header['bam'] == bam_state(sam) and header['strands'] == strands
+
+    def count(self, cutoff: int, whitelist: Optional[List[str]] = None, strands: Optional[int] = None) -> Tuple[BarcodeCounts, ReadStats, np.ndarray]:
+        '''Telomeric and total reads per barcode for a cutoff, counted over the first strands of the index.
+        With a whitelist only those barcodes are counted, in whitelist order, like the counting programs do.
+        Also returns the read stats and the ids of barcodes with telomeric reads in the order their first
+        telomeric read is found in the bam file.'''
+        arrays = self.arrays
+        barcodes = np.char.decode(arrays['barcodes'], 'ascii').tolist()
+        total, unsequenced = np.asarray(arrays['total']), np.asarray(arrays['unsequenced'])
+        counts = BarcodeCounts(whitelist)
+        if whitelist is None:
+            # Barcodes only seen on reads without a sequence come last and are never counted, like in a scan.
+            ids = counts.ids(barcodes[:np.count_nonzero(total)])
+            ids = np.concatenate([ids, np.full(len(barcodes) - len(ids), -1, dtype=np.int64)])
+            stats = ReadStats(self.header['missing'] + int(unsequenced.sum()))
+        else:
+            ids = counts.ids(barcodes)
+            outside = ids < 0
+            stats = ReadStats(self.header['missing'] + int(unsequenced[~outside].sum()),
+                              int(total[outside].sum() + unsequenced[outside].sum()))
+        kept = ids >= 0
+
+        np.add.at(np.frombuffer(counts.total, dtype=np.int64), ids[kept], total[kept])
+        if cutoff <= 0:
+            # Every read with a sequence reaches a cutoff of 0.
+            np.frombuffer(counts.telomere, dtype=np.int64)[:] = counts.total
+            return counts, stats, np.flatnonzero(np.frombuffer(counts.telomere, dtype=np.int64))
+
+        repeats = np.asarray(arrays['hit_repeats'])[:, :strands]
+        hits = ids[np.asarray(arrays['hit_barcode'])[repeats.max(axis=1, initial=0) >= cutoff]]
+        hits = hits[hits >= 0]
+        np.frombuffer(counts.telomere, dtype=np.int64)[:] += np.bincount(hits, minlength=len(counts))
+        order, first = np.unique(hits, return_index=True)
+        return counts, stats, order[np.argsort(first, kind='stable')]
+
+
+def open_index(sam: Path, matcher: TelomereMatcher, threads: int = 1, reference: Optional[str] = None, profiler=None,
+               io_threads: int = 1, prefetch: int = 0) -> TelomereIndex:
+    '''The index of the bam file for the strands of the matcher. A missing or stale index is made with one
+    scan of the bam file and written next to it, or to the cache folder if the folder of the bam file cannot
+    be written to. Standard input is indexed in memory only.'''
+    paths = [] if is_stdin(sam) else index_paths(sam, matcher)
+    for path in paths:
+        if path.exists():
+            index = TelomereIndex.load(path)
+            if index.is_current(sam, matcher.strands):
+                print(f'Counting {sam} from {path}')
+                return index
+            print(f'{path} is out of date')
+
+    print(f'Indexing telomeric reads of {sam}')
+    read_index = ReadIndex(len(matcher.strands))
+    for part in scan_bam(sam, threads, index_reads, matcher, reference=reference, profiler=profiler,
+                         io_threads=io_threads, prefetch=prefetch):
+        read_index.merge(part)
+    for path in paths:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            TelomereIndex.write(path, sam, matcher.strands, read_index)
+        except OSError as error:
+            print(f'Could not write the index to {path}: {error}')
+            continue
+        return TelomereIndex.load(path)
+    header = {'version': INDEX_VERSION, 'strands': matcher.strands, 'missing': read_index.missing}
+    return TelomereIndex(header, read_index.arrays())
@@ -0,0 +1,270 @@
+import re
+from itertools import islice
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# Reads MismatchMatcher.classified classifies at once, a few thousand keep the numpy buffers in cache.
+CLASSIFY_BATCH = 2048
+
+
+def reverse_comp(pattern: str) -> str:
+    table = str.maketrans('ATCG', 'TAGC')
+    return pattern.translate(table)[::-1]
+
+
+class TelomereMatcher:
+    '''Decides if a read is telomeric. The pattern, and its reverse complement if both_strands is set,
+    is compiled once per run. Counts are the same as len(re.findall(pattern, sequence)) but no list of
+    matches is built and counting stops once the cutoff is reached.'''
+
+    rejected = 0
+    max_mismatches = 0
+
+    def __init__(self, pattern: str, cutoff: int, both_strands: bool = False):
+        self.pattern = pattern
+        self.cutoff = cutoff
+        self.strands = [pattern]
+        if both_strands and reverse_comp(pattern) != pattern:
+            self.strands.append(reverse_comp(pattern))
+        # Literal patterns are counted with str.count, which gives the same non-overlapping count as
+        # re.findall in a single C call. Everything else goes through a precompiled regex.
+        self.literal = all(re.escape(strand) == strand for strand in self.strands)
+        self.regexes = [re.compile(strand) for strand in self.strands]
+
+    @property
+    def key(self) -> str:
+        '''What the counts of a read depend on besides the strands, for naming the telomere-read index.'''
+        return self.pattern
+
+    def count(self, sequence: str, strand: int = 0, limit: int = None) -> int:
+        '''Number of non-overlapping matches of one strand in the sequence, at most limit.'''
+        if self.literal:
+            counts = sequence.count(self.strands[strand])
+            return counts if limit is None else min(counts, limit)
+        return sum(1 for _ in islice(self.regexes[strand].finditer(sequence), limit))
+
+    def counts(self, sequence: str) -> Tuple[int, ...]:
+        '''Number of matches on every strand.'''
+        return tuple(self.count(sequence, strand) for strand in range(len(self.strands)))
+
+    def repeats(self, sequence: str) -> int:
+        '''Highest number of matches on any strand, at most cutoff.'''
+        return max(self.count(sequence, strand, self.cutoff) for strand in range(len(self.strands)))
+
+    def is_telomeric(self, sequence: str) -> bool:
+        '''True if any strand is found at least cutoff times in the sequence.'''
+        if self.literal:
+            for strand in self.strands:
+                if sequence.count(strand) >= self.cutoff:
+                    return True
+            return False
+        for strand in range(len(self.strands)):
+            if self.count(sequence, strand, self.cutoff) >= self.cutoff:
+                return True
+        return False
+
+    def classify(self, sequences: List[str]) -> List[bool]:
+        '''is_telomeric of every sequence, matchers that can match many sequences at once do so.'''
+        return [self.is_telomeric(sequence) for sequence in sequences]
+
+    def classified(self, items: Iterable[Tuple[Any, str]]) -> Iterator[Tuple[Any, str, bool]]:
+        '''(item, sequence, is_telomeric) for every (item, sequence), in order.'''
+        for item, sequence in items:
+            yield item, sequence, self.is_telomeric(sequence)
+
+
+def join_sequences(sequences: List[str]) -> Tuple['numpy.ndarray', 'numpy.ndarray', 'numpy.ndarray']:
+    '''All sequences in one buffer, each followed by a newline, and the start and length of every sequence.'''
+    import numpy as np
+    lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+    buffer = np.frombuffer(('\n'.join(sequences) + '\n').encode('ascii'), dtype=np.uint8)
+    return buffer, np.cumsum(lengths + 1) - lengths - 1, lengths
+
+
+def seed(regex: re.Pattern) -> Optional[str]:
+    '''Longest run of literal characters at the top level of the regex, which every match contains.
+    None if there is no such run.'''
+    if regex.flags & re.IGNORECASE:
+        return None
+    runs, run = [], ''
+    for op, value in sre_parse.parse(regex.pattern, regex.flags):
+        if op is sre_parse.LITERAL:
+            run += chr(value)
+        else:
+            runs.append(run)
+            run = ''
+    runs.append(run)
+    return max(runs, key=len) or None
+
+
+class PrefilterMatcher(TelomereMatcher):
+    '''TelomereMatcher which first rejects reads that cannot be telomeric and counts them in rejected.
+
+    The prefilter is lossless. Matches counted for the cutoff do not overlap, so a telomeric read is at least
+    cutoff times the shortest match long and, as every match contains the seed of its strand, has at least
+    cutoff non-overlapping copies of the seed. The seed of a literal pattern is the pattern itself, so reads
+    passing the prefilter are telomeric without running the matcher.'''
+
+    def __init__(self, pattern: str, cutoff: int, both_strands: bool = False):
+        super().__init__(pattern, cutoff, both_strands)
+        self.min_length = cutoff * min(sre_parse.parse(regex.pattern, regex.flags).getwidth()[0] for regex in self.regexes)
+        seeds = [seed(regex) for regex in self.regexes]
+        self.seeds = None if None in seeds else seeds
+
+    def is_telomeric(self, sequence: str) -> bool:
+        if len(sequence) >= self.min_length:
+            if self.seeds is None:
+                return super().is_telomeric(sequence)
+            for seed in self.seeds:
+                if sequence.count(seed) >= self.cutoff:
+                    return self.literal or super().is_telomeric(sequence)
+        self.rejected += 1
+        return False
+
+
+def base_tables(bases: str) -> dict:
+    '''str.translate tables turning a sequence into the binary digits of where each base is.'''
+    return {base: str.maketrans({chr(i): '1' if chr(i) == base else '0' for i in range(128)}) for base in bases}
+
+
+class MismatchMatcher(TelomereMatcher):
+    '''TelomereMatcher counting the matches of a plain sequence pattern with up to max_mismatches substituted
+    bases, an N being a substitution too, so variant repeats like TCAGGG and TGAGGG count as TTAGGG with one
+    mismatch. Matches do not overlap and are taken from the left, the same count str.count gives without
+    mismatches.
+
+    Reads are matched bit-parallel. A read becomes one integer per base with a bit set where the read has
+    that base, the integer of pattern base j shifted by j has a bit set for every window matching the pattern
+    at j, and a bit-sliced counter adds these up for all windows of the read in len(pattern) big integer
+    additions. Reads shorter than cutoff matches, or with fewer than cutoff copies of the max_mismatches + 1
+    parts of the pattern, are rejected, and reads with cutoff exact matches accepted, before the bits are
+    counted. The bits of a read that is neither cost about ten times the str.count of an exact match, so the
+    read loops classify their reads in batches with classified, which runs about as fast as exact matching.'''
+
+    def __init__(self, pattern: str, cutoff: int, both_strands: bool = False, max_mismatches: int = 1):
+        super().__init__(pattern, cutoff, both_strands)
+        if not self.literal:
+            raise ValueError(f'mismatches are counted for patterns of plain bases, not {pattern}')
+        if not 0 <= max_mismatches < len(pattern):
+            raise ValueError(f'the number of mismatches must be from 0 to {len(pattern) - 1} for {pattern}')
+        self.max_mismatches = max_mismatches
+        self.length = len(pattern)
+        self.tables = base_tables(''.join(sorted(set(''.join(self.strands)))))
+        self.bits = self.length.bit_length()
+        # A match with k mismatches has one of k + 1 parts of the pattern without a mismatch.
+        bounds = [round(i * self.length / (max_mismatches + 1)) for i in range(max_mismatches + 2)]
+        self.segments = [[strand[start:stop] for start, stop in zip(bounds, bounds[1:])] for strand in self.strands]
+
+    @property
+    def key(self) -> str:
+        return f'{self.pattern}~{self.max_mismatches}'
+
+    def masks(self, sequence: str) -> dict:
+        return {base: int(sequence.translate(table), 2) for base, table in self.tables.items()}
+
+    def hits(self, masks: dict, strand: str, n: int) -> int:
+        '''Bit n - 1 - i is set if the window starting at i has at most max_mismatches mismatches.'''
+        counter = [0] * self.bits
+        for j, base in enumerate(strand):
+            carry = masks[base] << j
+            for bit in range(self.bits):
+                counter[bit], carry = counter[bit] ^ carry, counter[bit] & carry
+                if not carry:
+                    break
+        # Windows with at least len(pattern) - max_mismatches matching bases, compared from the top bit down.
+        least = self.length - self.max_mismatches
+        above, equal = 0, -1
+        for bit in reversed(range(self.bits)):
+            if least >> bit & 1:
+                equal &= counter[bit]
+            else:
+                above |= equal & counter[bit]
+                equal &= ~counter[bit]
+        # Only windows inside the read, starting at 0 to n - len(pattern).
+        return (above | equal) & ((1 << n) - (1 << (self.length - 1)))
+
+    def take(self, hits: int, limit: Optional[int]) -> int:
+        '''Number of non-overlapping windows taken from the left, at most limit.'''
+        found = 0
+        while hits and (limit is None or found < limit):
+            top = hits.bit_length() - 1
+            hits &= (1 << max(top - self.length + 1, 0)) - 1
+            found += 1
+        return found
+
+    def count(self, sequence: str, strand: int = 0, limit: int = None) -> int:
+        if len(sequence) < self.length:
+            return 0
+        return self.take(self.hits(self.masks(sequence), self.strands[strand], len(sequence)), limit)
+
+    def counts(self, sequence: str) -> Tuple[int, ...]:
+        if len(sequence) < self.length:
+            return (0,) * len(self.strands)
+        masks = self.masks(sequence)
+        return tuple(self.take(self.hits(masks, strand, len(sequence)), None) for strand in self.strands)
+
+    def repeats(self, sequence: str) -> int:
+        if len(sequence) < self.length:
+            return 0
+        masks = self.masks(sequence)
+        return max(self.take(self.hits(masks, strand, len(sequence)), self.cutoff) for strand in self.strands)
+
+    def is_telomeric(self, sequence: str) -> bool:
+        if len(sequence) < self.cutoff * self.length:
+            return self.cutoff <= 0
+        # Taking windows from the left finds the most non-overlapping windows, so exact matches are a lower bound,
+        # and every match holds a part of the pattern, so the matches of the parts are an upper bound.
+        for strand in self.strands:
+            if sequence.count(strand) >= self.cutoff:
+                return True
+        strands = [strand for strand, segments in zip(self.strands, self.segments)
+                   if sum(sequence.count(segment) for segment in segments) >= self.cutoff]
+        if not strands:
+            return False
+        masks = self.masks(sequence)
+        for strand in strands:
+            hits = self.hits(masks, strand, len(sequence))
+            if bin(hits).count('1') >= self.cutoff and self.take(hits, self.cutoff) >= self.cutoff:
+                return True
+        return False
+
+    def classify(self, sequences: List[str]) -> List[bool]:
+        '''is_telomeric of every sequence, matched in one buffer with numpy. The matching bases of every window
+        of the buffer are added up one pattern position at a time, and windows with at most max_mismatches
+        mismatches that end inside their sequence are hits. Sequences with fewer hits than the cutoff cannot
+        have cutoff non-overlapping matches, the few others are checked by is_telomeric.'''
+        import numpy as np
+        if self.cutoff <= 0 or not sequences:
+            return [self.cutoff <= 0] * len(sequences)
+        buffer, starts, lengths = join_sequences(sequences)
+        candidates = np.zeros(len(sequences), dtype=bool)
+        for strand in self.strands:
+            windows = len(buffer) - self.length + 1
+            if windows <= 0:
+                break
+            matching = (buffer[:windows] == ord(strand[0])).astype(np.uint8)
+            for offset, base in enumerate(strand.encode('ascii')[1:], 1):
+                matching += buffer[offset:offset + windows] == base
+            positions = np.flatnonzero(matching >= self.length - self.max_mismatches)
+            read_of = np.searchsorted(starts, positions, side='right') - 1
+            inside = positions + self.length <= starts[read_of] + lengths[read_of]
+            candidates |= np.bincount(read_of[inside], minlength=len(sequences)) >= self.cutoff
+        telomeric = [False] * len(sequences)
+        for i in np.flatnonzero(candidates).tolist():
+            telomeric[i] = self.is_telomeric(sequences[i])
+        return telomeric
+
+    def classified(self, items: Iterable[Tuple[Any, str]]) -> Iterator[Tuple[Any, str, bool]]:
+        '''(item, sequence, is_telomeric) for every (item, sequence), in order. The sequences are classified
+        CLASSIFY_BATCH at a time, so the items of a batch are read before the first of them is given back.'''
+        items = iter(items)
+        while True:
+            batch = list(islice(items, CLASSIFY_BATCH))
+            if not batch:
+                return
+            for (item, sequence), telomeric in zip(batch, self.classify([sequence for _, sequence in batch])):
+                yield item, sequence, telomeric
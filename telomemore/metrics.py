@@ -0,0 +1,96 @@
+import json
+import resource
+import time
+from dataclasses import asdict
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, List, Union
+import pysam
+from telomemore.counts import ReadStats
+from telomemore.matcher import TelomereMatcher
+
+RUN_LOG = 'telomemore_runs.jsonl'
+PROFILE_EVERY = 1000
+STAGES = ['decode', 'tag', 'sequence', 'match']
+
+
+def peak_memory() -> float:
+    '''Peak resident memory in MB of this process or any of its finished worker processes.'''
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class Profiler:
+    '''Times the stages of the read loop on one read in every `every`. The other reads are passed through
+    untouched, and nothing is timed unless a profiler is given to the program, so normal runs are not slowed.
+    Sampled reads are timed again outside the loop: getting the read from pysam (decode), the CB tag lookup,
+    the sequence decode and the matchers.'''
+
+    def __init__(self, matchers: List[TelomereMatcher], every: int = PROFILE_EVERY):
+        self.matchers = matchers
+        self.every = every
+        self.sampled = 0
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    def wrap(self, reads: Iterable[pysam.AlignedSegment]) -> Iterator[pysam.AlignedSegment]:
+        clock = time.perf_counter
+        reads = iter(reads)
+        while True:
+            yield from islice(reads, self.every - 1)
+            start = clock()
+            read = next(reads, None)
+            decoded = clock()
+            if read is None:
+                return
+            self.sample(read, decoded - start)
+            yield read
+
+    def sample(self, read: pysam.AlignedSegment, decode: float) -> None:
+        clock = time.perf_counter
+        start = clock()
+        try:
+            read.get_tag('CB')
+        except KeyError:
+            pass
+        tagged = clock()
+        seq = read.query_sequence
+        decoded = clock()
+        if seq is not None:
+            for matcher in self.matchers:
+                # The prefilter counts its rejections, which must not include the profiler's calls.
+                rejected = matcher.rejected
+                matcher.is_telomeric(seq)
+                matcher.rejected = rejected
+        matched = clock()
+        for stage, seconds in zip(STAGES, [decode, tagged - start, decoded - tagged, matched - decoded]):
+            self.seconds[stage] += seconds
+        self.sampled += 1
+
+    def merge(self, other: 'Profiler') -> None:
+        for stage in STAGES:
+            self.seconds[stage] += other.seconds[stage]
+        self.sampled += other.sampled
+
+    def estimate(self, reads: int) -> dict:
+        '''Estimated seconds spent in every stage over all reads.'''
+        scale = reads / self.sampled if self.sampled else 0
+        return {'sampled_reads': self.sampled, **{stage: seconds * scale for stage, seconds in self.seconds.items()}}
+
+
+def count_metrics(program, stats: ReadStats, counted: int, telomeric: Union[int, List[dict]], barcodes: int, **settings) -> dict:
+    '''Metrics of one counted sample, returned by run_program and written to the run log by the scheduler.
+    A sweep gives the telomeric reads of every pattern and cutoff.'''
+    reads = counted + stats.missing + stats.off_whitelist + stats.dropped
+    metrics = {'program': type(program).__name__, 'matcher': program.matcher.__name__,
+               'threads': program.threads, 'io_threads': program.io_threads, 'prefetch': program.prefetch,
+               'max_mismatches': program.max_mismatches, **settings, 'reads': reads, 'counted': counted, 'telomeric': telomeric,
+               'barcodes': barcodes, **asdict(stats)}
+    if program.profiler is not None:
+        metrics['profile'] = program.profiler.estimate(reads)
+    return metrics
+
+
+def log_run(folder: Path, metrics: dict) -> None:
+    '''Appends the metrics of one sample as a line to the run log of the output folder.'''
+    with open(Path(folder) / RUN_LOG, 'a') as log:
+        print(json.dumps(metrics, default=str), file=log)
@@ -0,0 +1,4 @@
+# Choices and defaults of the command line options. They are kept out of the modules that use them, which import
+# numpy, pysam and pandas, so the command line can be built without importing any of those.
+FORMATS = ['csv', 'parquet']
+JOB_MEMORY = 4 * 1024 ** 3
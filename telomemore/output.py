@@ -0,0 +1,181 @@
+import csv
+from pathlib import Path
+from typing import IO, Dict, Iterator, List, Optional, Sequence, Union
+from urllib.parse import quote
+from telomemore.cache import atomic_open
+from telomemore.options import FORMATS
+
+CHUNK_ROWS = 1_000_000
+COLUMNS = ['bc', 'count', 'total', 'fraction', 'pattern', 'cutoff', 'file']
+
+
+def import_pyarrow():
+    '''pyarrow is only needed for parquet output, install it with pip install telomemore[parquet].'''
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('parquet output needs pyarrow, install it with pip install telomemore[parquet]') from None
+    return pyarrow, pyarrow.parquet
+
+
+Columns = Dict[str, Sequence]
+
+
+def write_csv(columns: Columns, handle: IO[str]) -> None:
+    '''Writes columns of numpy arrays or lists as csv like DataFrame.to_csv(index=False) does, floats at full
+    precision and NaN as an empty field, without importing pandas.'''
+    values = []
+    for column in columns.values():
+        column = column.tolist() if hasattr(column, 'tolist') else list(column)
+        if any(isinstance(value, float) for value in column[:1]):
+            column = ['' if value != value else value for value in column]
+        values.append(column)
+    writer = csv.writer(handle, lineterminator='\n')
+    writer.writerow(columns)
+    writer.writerows(zip(*values))
+
+
+def write_table(df: Union['pandas.DataFrame', Columns], path: Path) -> None:
+    '''Writes a count table, a DataFrame or a dict of columns, as csv, or as parquet if the file ends with
+    .parquet. In parquet the pattern and file columns are dictionary encoded, so the bam path is stored once
+    instead of on every row. A dict of columns is written as csv without importing pandas.'''
+    path = Path(path)
+    if path.suffix != '.parquet':
+        with atomic_open(path) as handle:
+            if isinstance(df, dict):
+                write_csv(df, handle)
+            else:
+                df.to_csv(handle, index=False)
+        return
+
+    import pandas as pd
+    pa, pq = import_pyarrow()
+    df = pd.DataFrame(df)
+    df = df.assign(pattern=df['pattern'].astype(str).astype('category'), file=df['file'].astype(str).astype('category'))
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with atomic_open(path, 'wb') as handle:
+        pq.write_table(table, handle)
+
+
+def find_outputs(folder: Path, exclude: Optional[Path] = None) -> List[Path]:
+    '''All per sample count tables under folder, skipping the headerless tables of count and anything
+    inside exclude.'''
+    outputs = []
+    for path in sorted(Path(folder).rglob('*telomemore_count_*')):
+        if path.suffix not in ('.csv', '.parquet') or not path.is_file():
+            continue
+        if exclude is not None and Path(exclude).resolve() in [path.resolve(), *path.resolve().parents]:
+            continue
+        if path.suffix == '.csv':
+            with open(path) as handle:
+                if not handle.readline().startswith('bc,'):
+                    print(f'{path} has no header, skipping')
+                    continue
+        outputs.append(path)
+    return outputs
+
+
+def table_columns(inputs: List[Path]) -> Dict[str, str]:
+    '''The columns of the count tables, COLUMNS first and then the extra columns such as the cell stats in the
+    order they are found, with the dtype of every extra column: Int64 if it only holds integers, float64 for
+    other numbers and object for anything else. The dtypes of csv tables are taken from their first rows.'''
+    import pandas as pd
+    columns = {}
+    for path in inputs:
+        if path.suffix == '.parquet':
+            _, pq = import_pyarrow()
+            dtypes = pq.ParquetFile(path).schema_arrow.empty_table().to_pandas().dtypes
+        else:
+            dtypes = pd.read_csv(path, nrows=1000).dtypes
+        for name, dtype in dtypes.items():
+            if name in COLUMNS:
+                continue
+            if pd.api.types.is_integer_dtype(dtype):
+                dtype = 'Int64'
+            elif pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype):
+                dtype = 'float64'
+            else:
+                dtype = 'object'
+            if columns.get(name, dtype) != dtype:
+                dtype = 'float64' if {dtype, columns[name]} == {'Int64', 'float64'} else 'object'
+            columns[name] = dtype
+    return {**{name: None for name in COLUMNS}, **columns}
+
+
+def read_chunks(path: Path, rows: int = CHUNK_ROWS, columns: Optional[Dict[str, str]] = None) -> Iterator['pandas.DataFrame']:
+    '''Reads a count table a chunk of rows at a time, with every column of COLUMNS present, or of columns as
+    given by table_columns, missing columns left empty.'''
+    import pandas as pd
+    columns = columns or dict.fromkeys(COLUMNS)
+    extra = {name: dtype for name, dtype in columns.items() if dtype is not None}
+    if path.suffix == '.parquet':
+        _, pq = import_pyarrow()
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=rows))
+    else:
+        chunks = pd.read_csv(path, chunksize=rows, dtype={'bc': str, 'pattern': str, 'file': str})
+
+    for chunk in chunks:
+        chunk = chunk.reindex(columns=list(columns))
+        yield chunk.astype({'bc': str, 'pattern': str, 'file': str, 'cutoff': 'Int64', **extra})
+
+
+def merge_csv(inputs: List[Path], output: Path, rows: int = CHUNK_ROWS) -> int:
+    '''Concatenates the count tables into one csv file, one chunk in memory at a time. Columns only some
+    tables have are kept and left empty for the others.'''
+    merged = 0
+    columns = table_columns(inputs)
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with atomic_open(output) as handle:
+        print(','.join(columns), file=handle)
+        for path in inputs:
+            for chunk in read_chunks(path, rows, columns):
+                chunk.to_csv(handle, header=False, index=False)
+                merged += len(chunk)
+    return merged
+
+
+def merge_parquet(inputs: List[Path], output: Path, rows: int = CHUNK_ROWS) -> int:
+    '''Concatenates the count tables into a parquet dataset partitioned by pattern, output/pattern=CCCTAA/,
+    one chunk in memory at a time. Every partition is one file written as the chunks come in. Columns only
+    some tables have are kept and left null for the others.'''
+    pa, pq = import_pyarrow()
+    columns = table_columns(inputs)
+    types = {'Int64': pa.int64(), 'float64': pa.float64(), 'object': pa.string()}
+    schema = pa.schema([('bc', pa.string()), ('count', pa.int64()), ('total', pa.int64()), ('fraction', pa.float64()),
+                        ('cutoff', pa.int64()), ('file', pa.dictionary(pa.int32(), pa.string()))]
+                       + [(name, types[dtype]) for name, dtype in columns.items() if dtype is not None])
+    writers = {}
+    merged = 0
+    try:
+        for path in inputs:
+            for chunk in read_chunks(path, rows, columns):
+                for pattern, rows_of_pattern in chunk.groupby('pattern', sort=False):
+                    if pattern not in writers:
+                        partition = Path(output) / f'pattern={quote(pattern, safe="")}'
+                        partition.mkdir(parents=True, exist_ok=True)
+                        writers[pattern] = pq.ParquetWriter(partition / 'part-0.parquet', schema)
+                    table = pa.Table.from_arrays([pa.array(rows_of_pattern['bc'], pa.string()),
+                                                  pa.array(rows_of_pattern['count'], pa.int64()),
+                                                  pa.array(rows_of_pattern['total'], pa.int64()),
+                                                  pa.array(rows_of_pattern['fraction'], pa.float64()),
+                                                  pa.array(rows_of_pattern['cutoff'], pa.int64()),
+                                                  pa.array(rows_of_pattern['file'], pa.string()).dictionary_encode()]
+                                                 + [pa.array(rows_of_pattern[field.name], field.type) for field in list(schema)[6:]],
+                                                 schema=schema)
+                    writers[pattern].write_table(table)
+                    merged += len(rows_of_pattern)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return merged
+
+
+def merge_outputs(folder: Path, output: Path, output_format: str = 'parquet', rows: int = CHUNK_ROWS) -> int:
+    '''Merges every count table under folder into output, a csv file or a parquet dataset folder. Returns
+    the number of rows written.'''
+    inputs = find_outputs(folder, exclude=output)
+    print(f'merging {len(inputs)} count tables into {output}')
+    if output_format == 'parquet':
+        return merge_parquet(inputs, output, rows)
+    return merge_csv(inputs, output, rows)
@@ -1,19 +1,52 @@
 import re
-from typing import Tuple, List
+import shutil
+import tempfile
+from typing import Iterable, Iterator, Tuple, List, Type, Optional
 from abc import ABC, abstractmethod
 import pysam
-import pandas as pd
+import numpy as np
 from pathlib import Path
 from collections import defaultdict
+from telomemore.regions import scan_bam
+from telomemore.index import open_index
+from telomemore.metrics import Profiler, count_metrics
+from telomemore.matcher import MismatchMatcher, PrefilterMatcher, TelomereMatcher
+from telomemore.emit import ReadEmitter, emitting
+from telomemore.cache import atomic_open
+from telomemore.counts import BarcodeCounts, ReadStats
+from telomemore.barcodes import read_whitelist
+from telomemore.spill import Counted, Dropped, SpillCounts, keep_barcodes, max_barcodes, merge_runs
 
 class ProgramTelomemore(ABC):
+    
+    both_strands = False
+    
+    def __init__(self, threads: int = 1, matcher: Type[TelomereMatcher] = TelomereMatcher, reference: Optional[str] = None, profile: bool = False, index: bool = False,
+                 io_threads: int = 1, prefetch: int = 0, max_mismatches: int = 0, max_memory: Optional[float] = None, min_reads: int = 1, top_barcodes: Optional[int] = None,
+                 emit_reads: bool = False):
+        self.threads = threads
+        self.matcher = matcher
+        self.reference = reference
+        self.profile = profile
+        self.io_threads = io_threads
+        self.prefetch = prefetch
+        self.max_mismatches = max_mismatches
+        self.profiler = None
+        self.index = index
+        self.max_memory = max_memory
+        self.min_reads = min_reads
+        self.top_barcodes = top_barcodes
+        self.dropped = None
+        self.emit_reads = emit_reads
+        if emit_reads and (index or max_memory is not None):
+            raise ValueError('telomeric reads are emitted while scanning the bam file, not from an index or a bounded count')
         
     @abstractmethod
     def telomere_count(self) -> Tuple[dict, dict, int]:
         pass
         
     @abstractmethod
-    def run_program(self) -> None:
+    def run_program(self) -> dict:
         pass
     
     def number_telomere(self, pattern: str, sequence: str) -> int:
@@ -21,87 +54,290 @@ class ProgramTelomemore(ABC):
         counts = re.findall(pattern, sequence)
         return len(counts)
     
+    def make_matcher(self, pattern: str, cutoff: int) -> TelomereMatcher:
+        if self.max_mismatches:
+            return MismatchMatcher(pattern, cutoff, both_strands=self.both_strands, max_mismatches=self.max_mismatches)
+        return self.matcher(pattern, cutoff, both_strands=self.both_strands)
+    
+    @property
+    def prefilter(self) -> bool:
+        '''True if reads that cannot reach the cutoff are rejected before the pattern is counted.'''
+        return issubclass(self.matcher, PrefilterMatcher) and not self.max_mismatches
+    
+    def input_key(self, sam: Path) -> dict:
+        '''Input files and settings beyond the bam and barcode file the outputs of a sample depend on.'''
+        return {}
+    
+    def make_emitter(self, emit: Optional[Path], matcher: TelomereMatcher) -> Optional[ReadEmitter]:
+        '''A writer of the telomeric reads of a part of the bam file if they are emitted to the folder emit.'''
+        return None if emit is None else ReadEmitter(emit, matcher)
+    
+    def make_profiler(self, matchers: List[TelomereMatcher]) -> Optional[Profiler]:
+        '''A new profiler for the next count if profiling is on, kept for the run metrics.'''
+        self.profiler = Profiler(matchers) if self.profile else None
+        return self.profiler
+    
+    def indexed_count(self, sam: Path, cutoff: int, pattern: str, whitelist: Optional[List[str]] = None) -> Tuple[BarcodeCounts, ReadStats, np.ndarray]:
+        '''Counts from the telomere-read index of the bam file, which is made by one scan of the bam file if it
+        is missing or out of date.'''
+        matcher = self.make_matcher(pattern, cutoff)
+        index = open_index(sam, matcher, self.threads, self.reference, self.make_profiler([matcher]),
+                           io_threads=self.io_threads, prefetch=self.prefetch)
+        return index.count(cutoff, whitelist, len(matcher.strands))
+    
 class NobarcodeProgramTelomemore(ProgramTelomemore):
     
-    def telomere_count(self, sam: Path, cutoff: int, pattern: str) -> Tuple[dict, dict, int]:
+    def telomere_count(self, sam: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        
+        if self.index:
+            counts, read_stats, order = self.indexed_count(sam, cutoff, pattern)
+            barcodes = counts.barcodes
+            telomeres_cells = defaultdict(int, ((barcodes[i], counts.telomere[i]) for i in order))
+            return telomeres_cells, defaultdict(int, zip(barcodes, counts.total)), read_stats
         
-        sam = pysam.AlignmentFile(sam, 'rb')
+        if self.max_memory is not None:
+            telomeres_cells, total_reads_cells = defaultdict(int), defaultdict(int)
+            counted, read_stats = self.bounded_count(sam, cutoff, pattern)
+            for cb, telomere, total in counted:
+                total_reads_cells[cb] = total
+                if telomere:
+                    telomeres_cells[cb] = telomere
+            return telomeres_cells, total_reads_cells, read_stats
+        
+        telomeres_cells = defaultdict(int)
+        total_reads_cells = defaultdict(int)
+        read_stats = ReadStats()
+        matcher = self.make_matcher(pattern, cutoff)
+        
+        with emitting(sam, reads_file, self.reference) as emit:
+            for telomeres, totals, stats in scan_bam(sam, self.threads, self._count_reads, matcher, emit, reference=self.reference, profiler=self.make_profiler([matcher]),
+                                                     io_threads=self.io_threads, prefetch=self.prefetch):
+                for cb, value in totals.items():
+                    total_reads_cells[cb] += value
+                for cb, value in telomeres.items():
+                    telomeres_cells[cb] += value
+                read_stats.add(stats)
+            
+        return telomeres_cells, total_reads_cells, read_stats
     
+    def _count_reads(self, reads: Iterable[pysam.AlignedSegment], matcher: TelomereMatcher, emit: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        
         telomeres_cells = defaultdict(int)
         total_reads_cells = defaultdict(int)
-        missed_barcodes = 0
+        stats = ReadStats()
+        rejected = matcher.rejected
+        emitter = self.make_emitter(emit, matcher)
 
-        for read in sam:
+        def sequences() -> Iterator[Tuple[Tuple[str, Optional[pysam.AlignedSegment]], str]]:
+            for read in reads:
+                try:
+                    cb = read.get_tag('CB')
+                except KeyError:
+                    stats.missing += 1
+                    continue
+                seq = read.query_sequence
+                if seq is None:
+                    stats.missing += 1
+                    continue
+                total_reads_cells[cb] += 1
+                yield (cb, read if emitter is not None else None), seq
+
+        for (cb, read), seq, telomeric in matcher.classified(sequences()):
+            if telomeric:
+                telomeres_cells[cb] += 1
+                if emitter is not None:
+                    emitter.add(read, seq)
+
+        if emitter is not None:
+            emitter.close()
+        stats.prefiltered = matcher.rejected - rejected
+        return telomeres_cells, total_reads_cells, stats
+    
+    def bounded_count(self, sam: Path, cutoff: int, pattern: str) -> Tuple[Iterator[Counted], ReadStats]:
+        '''Counts in max_memory MB of barcode counts. Every process spills its counts to sorted run files when
+        its share is full and the runs are merged at the end. Returns the barcodes with at least min_reads
+        reads, or the top_barcodes with the most reads, as (barcode, telomeric reads, total reads) in barcode
+        order. The other barcodes are added to self.dropped and their reads to the read stats as the barcodes
+        are consumed.'''
+        matcher = self.make_matcher(pattern, cutoff)
+        folder = Path(tempfile.mkdtemp(prefix='telomemore_'))
+        runs, read_stats = [], ReadStats()
+        for part, stats in scan_bam(sam, self.threads, self._count_spilled, matcher, folder, max_barcodes(self.max_memory, self.threads),
+                                    reference=self.reference, profiler=self.make_profiler([matcher]), io_threads=self.io_threads, prefetch=self.prefetch):
+            runs += part
+            read_stats.add(stats)
+        self.dropped = Dropped()
+        
+        def counted() -> Iterator[Counted]:
             try:
-                cb = read.get_tag('CB')
-                seq = read.seq
-                assert isinstance(seq, str)               
-            except Exception:
-                missed_barcodes += 1
-            else:
-                total_reads_cells[read.get_tag('CB')] += 1 
-                if self.number_telomere(pattern, seq) >= cutoff:
-                    telomeres_cells[read.get_tag('CB')] += 1
+                yield from keep_barcodes(merge_runs(runs), self.dropped, self.min_reads, self.top_barcodes)
+                read_stats.dropped = self.dropped.reads
+            finally:
+                shutil.rmtree(folder, ignore_errors=True)
+        
+        return counted(), read_stats
+    
+    def _count_spilled(self, reads: Iterable[pysam.AlignedSegment], matcher: TelomereMatcher, folder: Path, limit: int) -> Tuple[List[Path], ReadStats]:
+        
+        counts = SpillCounts(folder, limit)
+        stats = ReadStats()
+        rejected = matcher.rejected
+
+        def sequences() -> Iterator[Tuple[str, str]]:
+            for read in reads:
+                try:
+                    cb = read.get_tag('CB')
+                except KeyError:
+                    stats.missing += 1
+                    continue
+                seq = read.query_sequence
+                if seq is None:
+                    stats.missing += 1
+                    continue
+                yield cb, seq
+
+        for cb, _, telomeric in matcher.classified(sequences()):
+            counts.add(cb, telomeric)
 
-        return telomeres_cells, total_reads_cells, missed_barcodes
+        stats.prefiltered = matcher.rejected - rejected
+        return counts.close(), stats
     
-    def run_program(self, bam_file: Path, cutoff: int, pattern: str, telomere_file: Path, total_file: Path, missed_file: Path) -> None:
+    def run_program(self, bam_file: Path, cutoff: int, pattern: str, telomere_file: Path, total_file: Path, missed_file: Path,
+                    reads_file: Optional[Path] = None) -> dict:
         
-        telomeres_cells, total_reads_cells, missed_barcodes = self.telomere_count(bam_file, cutoff, pattern)
+        if self.max_memory is not None and not self.index:
+            return self.run_bounded(bam_file, cutoff, pattern, telomere_file, total_file, missed_file)
         
-        with open(telomere_file, 'a+') as telomere:
+        telomeres_cells, total_reads_cells, stats = self.telomere_count(bam_file, cutoff, pattern, reads_file)
+        
+        with atomic_open(telomere_file) as telomere:
             for key, value in telomeres_cells.items():
                 print(f'{key},{value}', file=telomere)
 
-        with open(total_file, 'a+') as total:
+        with atomic_open(total_file) as total:
             for key, value in total_reads_cells.items():
                 print(f'{key},{value}', file=total)
 
-        with open(missed_file, 'w+') as missed:
-            print(f'Number of missed barcodes = {missed_barcodes}', file=missed)
+        with atomic_open(missed_file) as missed:
+            print(f'Number of missed barcodes = {stats.missing}', file=missed)
+            if self.prefilter:
+                print(f'Number of reads rejected by the prefilter = {stats.prefiltered}', file=missed)
+            
+        return count_metrics(self, stats, sum(total_reads_cells.values()), sum(telomeres_cells.values()),
+                             len(total_reads_cells), pattern=pattern, cutoff=cutoff)
+    
+    def run_bounded(self, bam_file: Path, cutoff: int, pattern: str, telomere_file: Path, total_file: Path, missed_file: Path) -> dict:
+        '''run_program for a bounded count, the barcodes are written as they come out of the merge so they are
+        never all held in memory.'''
+        counted, stats = self.bounded_count(bam_file, cutoff, pattern)
+        reads, telomeric, barcodes = 0, 0, 0
+        
+        with atomic_open(telomere_file) as telomere_out, atomic_open(total_file) as total_out:
+            for cb, telomere, total in counted:
+                if telomere:
+                    print(f'{cb},{telomere}', file=telomere_out)
+                print(f'{cb},{total}', file=total_out)
+                reads, telomeric, barcodes = reads + total, telomeric + telomere, barcodes + 1
+        
+        with atomic_open(missed_file) as missed:
+            print(f'Number of missed barcodes = {stats.missing}', file=missed)
+            if self.prefilter:
+                print(f'Number of reads rejected by the prefilter = {stats.prefiltered}', file=missed)
+            print(f'Number of dropped barcodes = {self.dropped.barcodes}', file=missed)
+            print(f'Number of reads of dropped barcodes = {self.dropped.reads}', file=missed)
+            print(f'Number of telomeric reads of dropped barcodes = {self.dropped.telomeric}', file=missed)
+        
+        return count_metrics(self, stats, reads, telomeric, barcodes, pattern=pattern, cutoff=cutoff, max_memory=self.max_memory,
+                             min_reads=self.min_reads, top_barcodes=self.top_barcodes, dropped_barcodes=self.dropped.barcodes,
+                             dropped_telomeric=self.dropped.telomeric)
         
 
 class BarcodeProgramTelomemore(ProgramTelomemore):
     
-    def telomere_count(self, sam: Path, barcode: Path, cutoff: int, pattern: str) -> Tuple[dict, dict, int]:
+    def telomere_count(self, sam: Path, barcode: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
         '''Counts number of telomeres from barcode file and returns the total reads per cells, 
-        telomeres per cells and reads with missed barcodes. '''
+        telomeres per cells and statistics on the reads dropped for a missing tag or a barcode outside the whitelist.
+        The telomeric reads of the cells are written to reads_file if one is given. '''
+        
+        barcode = read_whitelist(barcode)
         
-        sam = pysam.AlignmentFile(sam, 'rb')
-        barcode = pd.read_csv(barcode, header=None, delimiter='\t', names=['bc'])
+        if self.index:
+            counts, read_stats, _ = self.indexed_count(sam, cutoff, pattern, barcode)
+            return dict(zip(barcode, counts.telomere)), dict(zip(barcode, counts.total)), read_stats
         
-        telomeres_cells = dict().fromkeys(barcode['bc'].to_list(), 0)
-        total_reads_cells = dict().fromkeys(barcode['bc'].to_list(), 0)
-        missed_barcodes = 0
+        telomeres_cells = dict().fromkeys(barcode, 0)
+        total_reads_cells = dict().fromkeys(barcode, 0)
+        read_stats = ReadStats()
+        matcher = self.make_matcher(pattern, cutoff)
+        
+        with emitting(sam, reads_file, self.reference) as emit:
+            for telomeres, totals, stats in scan_bam(sam, self.threads, self._count_reads, barcode, matcher, emit, reference=self.reference, profiler=self.make_profiler([matcher]),
+                                                     io_threads=self.io_threads, prefetch=self.prefetch):
+                for cb in total_reads_cells:
+                    total_reads_cells[cb] += totals[cb]
+                    telomeres_cells[cb] += telomeres[cb]
+                read_stats.add(stats)
 
-        for read in sam:
-            try:
-                cb = read.get_tag('CB')
-                seq = read.seq
-                assert isinstance(seq, str)
-            except Exception:
-                missed_barcodes += 1
-            else:
-                if cb in total_reads_cells:
-                    total_reads_cells[cb] += 1
-                if cb in telomeres_cells and self.number_telomere(pattern, seq) >= cutoff:
-                    telomeres_cells[cb] += 1
+        return telomeres_cells, total_reads_cells, read_stats
+    
+    def _count_reads(self, reads: Iterable[pysam.AlignedSegment], barcode: List[str], matcher: TelomereMatcher, emit: Optional[Path] = None) -> Tuple[dict, dict, ReadStats]:
+        
+        emitter = self.make_emitter(emit, matcher)
+        telomeres_cells = dict().fromkeys(barcode, 0)
+        total_reads_cells = dict().fromkeys(barcode, 0)
+        stats = ReadStats()
+        rejected = matcher.rejected
+
+        # Reads are rejected on the CB tag before their sequence is decoded, most reads of a scATAC
+        # library come from barcodes that are not cells.
+        def sequences() -> Iterator[Tuple[Tuple[str, Optional[pysam.AlignedSegment]], str]]:
+            for read in reads:
+                try:
+                    cb = read.get_tag('CB')
+                except KeyError:
+                    stats.missing += 1
+                    continue
+                if cb not in total_reads_cells:
+                    stats.off_whitelist += 1
+                    continue
+                seq = read.query_sequence
+                if seq is None:
+                    stats.missing += 1
+                    continue
+                total_reads_cells[cb] += 1
+                yield (cb, read if emitter is not None else None), seq
+
+        for (cb, read), seq, telomeric in matcher.classified(sequences()):
+            if telomeric:
+                telomeres_cells[cb] += 1
+                if emitter is not None:
+                    emitter.add(read, seq)
 
-        return telomeres_cells, total_reads_cells, missed_barcodes
+        if emitter is not None:
+            emitter.close()
+        stats.prefiltered = matcher.rejected - rejected
+        return telomeres_cells, total_reads_cells, stats
     
-    def run_program(self, bam_file: Path, barcode: Path, cutoff: int, pattern: str, telomere_file: Path, total_file: Path, missed_file: Path) -> None:
+    def run_program(self, bam_file: Path, barcode: Path, cutoff: int, pattern: str, telomere_file: Path, total_file: Path, missed_file: Path,
+                    reads_file: Optional[Path] = None) -> dict:
 
-        telomeres_cells, total_reads_cells, missed_barcodes = self.telomere_count(bam_file, barcode, cutoff, pattern)
+        telomeres_cells, total_reads_cells, stats = self.telomere_count(bam_file, barcode, cutoff, pattern, reads_file)
 
-        with open(telomere_file, 'a+') as telomere:
+        with atomic_open(telomere_file) as telomere:
             for key, value in telomeres_cells.items():
                 print(f'{key},{value}', file=telomere)
 
-        with open(total_file, 'a+') as total:
+        with atomic_open(total_file) as total:
             for key, value in total_reads_cells.items():
                 print(f'{key},{value}', file=total)
 
-        with open(missed_file, 'w+') as missed:
-            print(f'Number of missed barcodes = {missed_barcodes}', file=missed)
+        with atomic_open(missed_file) as missed:
+            print(f'Number of reads missing a barcode or sequence = {stats.missing}', file=missed)
+            print(f'Number of reads outside the whitelist = {stats.off_whitelist}', file=missed)
+            if self.prefilter:
+                print(f'Number of reads rejected by the prefilter = {stats.prefiltered}', file=missed)
+            
+        return count_metrics(self, stats, sum(total_reads_cells.values()), sum(telomeres_cells.values()),
+                             len(total_reads_cells), pattern=pattern, cutoff=cutoff)
 
 
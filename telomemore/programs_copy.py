@@ -2,31 +2,54 @@
 ## ADD PROGRESS BAR
 ## ADD SAMPLE INFO TO Column
 import re
-from typing import Tuple, List
+from typing import Dict, Iterable, Iterator, Tuple, List, Type, Optional
 from abc import ABC, abstractmethod
 import pysam
-import pandas as pd
+import numpy as np
 from pathlib import Path
-from collections import defaultdict, namedtuple
-from dataclasses import dataclass
-
-@dataclass
-class Count:
-    '''Hold telomere count and total count when going through bam files.'''
-    telomere: int = 0
-    total: int = 0
+from telomemore.regions import scan_bam
+from telomemore.index import open_index
+from telomemore.metrics import Profiler, count_metrics
+from telomemore.matcher import MismatchMatcher, TelomereMatcher, reverse_comp
+from telomemore.emit import ReadEmitter, emitting
+# Count lived here before the counts moved to telomemore.counts, it is imported for code that imports it from here.
+from telomemore.counts import BarcodeCounts, Count, ReadStats  # noqa: F401
+from telomemore.barcodes import read_whitelist
+from telomemore.output import write_table
+from telomemore.cellstats import CellStats, Subtelomeres
 
 class ProgramTelomemore(ABC):
     
-    def __init__(self):
-        self.counter = 0
+    both_strands = True
+    
+    def __init__(self, threads: int = 1, matcher: Type[TelomereMatcher] = TelomereMatcher, reference: Optional[str] = None, profile: bool = False, index: bool = False,
+                 io_threads: int = 1, prefetch: int = 0, max_mismatches: int = 0, cell_stats: bool = False, subtelomeres: Optional[str] = None,
+                 emit_reads: bool = False):
+        self.threads = threads
+        self.matcher = matcher
+        self.reference = reference
+        self.profile = profile
+        self.io_threads = io_threads
+        self.prefetch = prefetch
+        self.max_mismatches = max_mismatches
+        self.profiler = None
+        self.index = index
+        self.cell_stats = cell_stats or subtelomeres is not None
+        self.subtelomeres_bed = subtelomeres
+        self.subtelomeres = None if subtelomeres is None else Subtelomeres(subtelomeres)
+        if index and self.cell_stats:
+            raise ValueError('cell stats are counted while scanning the bam file, not from an index')
+        self.emit_reads = emit_reads
+        if index and emit_reads:
+            raise ValueError('telomeric reads are emitted while scanning the bam file, not from an index')
+        self.cells = None
     
     @abstractmethod
     def telomere_count(self) -> Tuple[dict, dict, int]:
         pass
         
     @abstractmethod
-    def run_program(self) -> None:
+    def run_program(self) -> dict:
         pass
     
     def number_telomere(self, pattern: str, sequence: str) -> int:
@@ -35,86 +58,193 @@ class ProgramTelomemore(ABC):
         return len(counts)
     
     def reverse_comp(self, pattern: str) -> str:
-        table = str.maketrans('ATCG', 'TAGC')
-        return pattern.translate(table)[::-1]
+        return reverse_comp(pattern)
     
+    def make_matcher(self, pattern: str, cutoff: int) -> TelomereMatcher:
+        if self.max_mismatches:
+            return MismatchMatcher(pattern, cutoff, both_strands=self.both_strands, max_mismatches=self.max_mismatches)
+        return self.matcher(pattern, cutoff, both_strands=self.both_strands)
     
-class NobarcodeProgramTelomemore_copy(ProgramTelomemore):
+    def make_emitter(self, emit: Optional[Path], matcher: TelomereMatcher) -> Optional[ReadEmitter]:
+        '''A writer of the telomeric reads of a part of the bam file if they are emitted to the folder emit.'''
+        return None if emit is None else ReadEmitter(emit, matcher)
+    
+    def make_profiler(self, matchers: List[TelomereMatcher]) -> Optional[Profiler]:
+        '''A new profiler for the next count if profiling is on, kept for the run metrics.'''
+        self.profiler = Profiler(matchers) if self.profile else None
+        return self.profiler
+    
+    def indexed_count(self, sam: Path, cutoff: int, pattern: str, whitelist: Optional[List[str]] = None) -> Tuple[BarcodeCounts, ReadStats, np.ndarray]:
+        '''Counts from the telomere-read index of the bam file, which is made by one scan of the bam file if it
+        is missing or out of date.'''
+        matcher = self.make_matcher(pattern, cutoff)
+        index = open_index(sam, matcher, self.threads, self.reference, self.make_profiler([matcher]),
+                           io_threads=self.io_threads, prefetch=self.prefetch)
+        return index.count(cutoff, whitelist, len(matcher.strands))
+    
+    def make_cells(self) -> Optional[CellStats]:
+        '''Empty per barcode accumulators for a part of the bam file if cell stats are on.'''
+        return CellStats(self.subtelomeres) if self.cell_stats else None
     
-    def telomere_count(self, sam: Path, cutoff: int, pattern: str) -> dict:
-        sam_file = pysam.AlignmentFile(sam, 'rb')
-        telomeres_cells = defaultdict(Count)
-        missed_barcodes = 0
-        rev_comp = self.reverse_comp(pattern)
+    def add_cells(self, results: Iterable[Tuple[BarcodeCounts, ReadStats, Optional[CellStats]]], telomeres_cells: BarcodeCounts) -> ReadStats:
+        '''Merges the counts of every part of the bam file, keeping the cell stats for the count table.'''
+        read_stats = ReadStats()
+        self.cells = self.make_cells()
+        for counts, stats, cells in results:
+            telomeres_cells.merge(counts)
+            read_stats.add(stats)
+            if cells is not None:
+                self.cells.merge(cells)
+        return read_stats
+    
+    def cell_columns(self, telomeres_cells: BarcodeCounts) -> Dict[str, object]:
+        '''Columns of the count table of the barcodes, with the cell stats columns if they were counted.'''
+        columns = telomeres_cells.columns()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            columns['fraction'] = columns['count'] / columns['total']
+        if self.cells is not None:
+            columns.update(self.cells.frame_columns(columns['bc']))
+        return columns
 
-        for read in sam_file:
-            try:
-                cb = read.get_tag('CB')
-                seq = read.seq
-                assert isinstance(seq, str)               
-            except Exception:
-                missed_barcodes += 1
-            else:
-                telomeres_cells[cb].total += 1 
-                if self.number_telomere(pattern, seq) >= cutoff or self.number_telomere(rev_comp, seq) >= cutoff:
-                    telomeres_cells[cb].telomere += 1
-                    
-            if self.counter % 10000000 == 0:
-                print(f'Reads processed: {self.counter / 1000000} M')
-            self.counter += 1
+    def cell_table(self, telomeres_cells: BarcodeCounts) -> 'pandas.DataFrame':
+        '''Count table of the barcodes as a DataFrame.'''
+        import pandas as pd
+        return pd.DataFrame(self.cell_columns(telomeres_cells))
+    
+    
+class NobarcodeProgramTelomemore_copy(ProgramTelomemore):
+    
+    def telomere_count(self, sam: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> BarcodeCounts:
+        if self.index:
+            telomeres_cells, read_stats, _ = self.indexed_count(sam, cutoff, pattern)
+        else:
+            telomeres_cells = BarcodeCounts()
+            matcher = self.make_matcher(pattern, cutoff)
+            with emitting(sam, reads_file, self.reference) as emit:
+                read_stats = self.add_cells(scan_bam(sam, self.threads, self._count_reads, matcher, emit, reference=self.reference,
+                                                     profiler=self.make_profiler([matcher]), io_threads=self.io_threads,
+                                                     prefetch=self.prefetch), telomeres_cells)
                     
-        print(f'Number of missed barcodes or reads: {missed_barcodes} in {sam}')
+        print(f'Reads of {sam}: {read_stats}')
+        self.read_stats = read_stats
         return telomeres_cells
     
-    def run_program(self, bam_file: Path, cutoff: int, pattern: str, telomere_file: Path) -> None:
-        telomeres_cells = self.telomere_count(bam_file, cutoff, pattern)
-        df = pd.DataFrame({'bc': [key for key in telomeres_cells.keys()],
-                          'count': [x.telomere for x in telomeres_cells.values()],
-                          'total': [x.total for x in telomeres_cells.values()]})
-        df['fraction'] = df['count'] / df['total']
-        df['pattern'] = pattern
-        df['file'] = bam_file
-        df.to_csv(telomere_file, index=False)
+    def _count_reads(self, reads: Iterable[pysam.AlignedSegment], matcher: TelomereMatcher, emit: Optional[Path] = None) -> Tuple[BarcodeCounts, ReadStats, Optional[CellStats]]:
+        telomeres_cells = BarcodeCounts()
+        index, telomere, total = telomeres_cells.index, telomeres_cells.telomere, telomeres_cells.total
+        cells = self.make_cells()
+        emitter = self.make_emitter(emit, matcher)
+        stats = ReadStats()
+        rejected = matcher.rejected
+
+        def sequences() -> Iterator[Tuple[Tuple[int, Optional[pysam.AlignedSegment]], str]]:
+            for read in reads:
+                try:
+                    cb = read.get_tag('CB')
+                    seq = read.seq
+                    assert isinstance(seq, str)               
+                except Exception:
+                    stats.missing += 1
+                else:
+                    i = index.get(cb)
+                    if i is None:
+                        i = telomeres_cells.intern(cb)
+                    total[i] += 1 
+                    if cells is not None:
+                        cells.add(cb, read, seq)
+                    yield (i, read if emitter is not None else None), seq
+
+        for (i, read), seq, telomeric in matcher.classified(sequences()):
+            if telomeric:
+                telomere[i] += 1
+                if emitter is not None:
+                    emitter.add(read, seq)
+                    
+        if emitter is not None:
+            emitter.close()
+        stats.prefiltered = matcher.rejected - rejected
+        return telomeres_cells, stats, cells
+    
+    def run_program(self, bam_file: Path, cutoff: int, pattern: str, telomere_file: Path, reads_file: Optional[Path] = None) -> dict:
+        telomeres_cells = self.telomere_count(bam_file, cutoff, pattern, reads_file)
+        columns = self.cell_columns(telomeres_cells)
+        rows = len(columns['bc'])
+        columns['pattern'] = [pattern] * rows
+        columns['file'] = [bam_file] * rows
+        write_table(columns, telomere_file)
+        return count_metrics(self, self.read_stats, int(columns['total'].sum()), int(columns['count'].sum()), rows,
+                             pattern=pattern, cutoff=cutoff)
         
 
 class BarcodeProgramTelomemore_copy(ProgramTelomemore):
     
-    def telomere_count(self, sam: Path, barcode: Path, cutoff: int, pattern: str) -> Tuple[dict, dict, int]:
+    def telomere_count(self, sam: Path, barcode: Path, cutoff: int, pattern: str, reads_file: Optional[Path] = None) -> BarcodeCounts:
         '''Counts number of telomeres from barcode file and returns the total reads per cells, 
-        telomeres per cells and reads with missed barcodes. '''
+        telomeres per cells and reads with missed barcodes. The telomeric reads of the cells are written to
+        reads_file if one is given. '''
         
-        sam_file = pysam.AlignmentFile(sam, 'rb')
-        barcode = pd.read_csv(barcode, header=None, delimiter='\t', names=['bc'])
-        telomeres_cells = {x: Count() for x in barcode['bc'].to_list()}
-        missed_barcodes = 0
-        rev_comp = self.reverse_comp(pattern)
-
-        for read in sam_file:
-            try:
-                cb = read.get_tag('CB')
-                seq = read.seq
-                assert isinstance(seq, str)
-            except Exception:
-                missed_barcodes += 1
-            else:
-                if cb in telomeres_cells:
-                    telomeres_cells[cb].total += 1
-                    if self.number_telomere(pattern, seq) >= cutoff or self.number_telomere(rev_comp, seq) >= cutoff:
-                        telomeres_cells[cb].telomere += 1
-                        
-            if self.counter % 10000000 == 0:
-                print(f'Reads processed: {self.counter / 1000000} M')
-            self.counter += 1
+        barcode = read_whitelist(barcode)
+        if self.index:
+            telomeres_cells, read_stats, _ = self.indexed_count(sam, cutoff, pattern, barcode)
+        else:
+            telomeres_cells = BarcodeCounts(barcode)
+            matcher = self.make_matcher(pattern, cutoff)
+            with emitting(sam, reads_file, self.reference) as emit:
+                read_stats = self.add_cells(scan_bam(sam, self.threads, self._count_reads, barcode, matcher, emit, reference=self.reference,
+                                                     profiler=self.make_profiler([matcher]), io_threads=self.io_threads,
+                                                     prefetch=self.prefetch), telomeres_cells)
                 
-        print(f'Number of missed barcodes or reads: {missed_barcodes} in {sam}')
+        print(f'Reads of {sam}: {read_stats}')
+        self.read_stats = read_stats
         return telomeres_cells
     
-    def run_program(self, bam_file: Path, barcode: Path, cutoff: int, pattern: str, telomere_file: Path) -> None:
-        telomeres_cells = self.telomere_count(bam_file, barcode, cutoff, pattern)
-        df = pd.DataFrame({'bc': [key for key in telomeres_cells.keys()],
-                          'count': [x.telomere for x in telomeres_cells.values()],
-                          'total': [x.total for x in telomeres_cells.values()]})
-        df['fraction'] = df['count'] / df['total']
-        df['pattern'] = pattern
-        df['file'] = bam_file
-        df.to_csv(telomere_file, index=False)
+    def _count_reads(self, reads: Iterable[pysam.AlignedSegment], barcode: List[str], matcher: TelomereMatcher,
+                     emit: Optional[Path] = None) -> Tuple[BarcodeCounts, ReadStats, Optional[CellStats]]:
+        telomeres_cells = BarcodeCounts(barcode)
+        index, telomere, total = telomeres_cells.index, telomeres_cells.telomere, telomeres_cells.total
+        cells = self.make_cells()
+        emitter = self.make_emitter(emit, matcher)
+        stats = ReadStats()
+        rejected = matcher.rejected
+
+        # Off-whitelist reads are rejected on the CB tag before their sequence is decoded.
+        def sequences() -> Iterator[Tuple[Tuple[int, Optional[pysam.AlignedSegment]], str]]:
+            for read in reads:
+                try:
+                    cb = read.get_tag('CB')
+                except KeyError:
+                    stats.missing += 1
+                    continue
+                i = index.get(cb)
+                if i is None:
+                    stats.off_whitelist += 1
+                    continue
+                seq = read.query_sequence
+                if seq is None:
+                    stats.missing += 1
+                    continue
+                total[i] += 1
+                if cells is not None:
+                    cells.add(cb, read, seq)
+                yield (i, read if emitter is not None else None), seq
+
+        for (i, read), seq, telomeric in matcher.classified(sequences()):
+            if telomeric:
+                telomere[i] += 1
+                if emitter is not None:
+                    emitter.add(read, seq)
+                
+        if emitter is not None:
+            emitter.close()
+        stats.prefiltered = matcher.rejected - rejected
+        return telomeres_cells, stats, cells
+    
+    def run_program(self, bam_file: Path, barcode: Path, cutoff: int, pattern: str, telomere_file: Path, reads_file: Optional[Path] = None) -> dict:
+        telomeres_cells = self.telomere_count(bam_file, barcode, cutoff, pattern, reads_file)
+        columns = self.cell_columns(telomeres_cells)
+        rows = len(columns['bc'])
+        columns['pattern'] = [pattern] * rows
+        columns['file'] = [bam_file] * rows
+        write_table(columns, telomere_file)
+        return count_metrics(self, self.read_stats, int(columns['total'].sum()), int(columns['count'].sum()), rows,
+                             pattern=pattern, cutoff=cutoff)
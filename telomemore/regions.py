@@ -0,0 +1,171 @@
+import queue
+import threading
+from contextlib import closing, contextmanager
+from itertools import chain, islice
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import pysam
+
+CHUNK_SIZE = 10_000_000
+# Reads between two progress messages of a count.
+PROGRESS_READS = 10_000_000
+STDIN = '-'
+# Batches of reads the read-ahead thread may hold before it waits for the counting loop.
+PREFETCH_DEPTH = 4
+
+
+class Region(NamedTuple):
+    '''Part of a bam file counted by one worker. A contig of None is the tail of unplaced unmapped reads,
+    a stop of None runs to the end of the contig.'''
+    contig: Optional[str]
+    start: int = 0
+    stop: Optional[int] = None
+
+
+def is_stdin(sam: Path) -> bool:
+    return str(sam) == STDIN
+
+
+def open_alignments(sam: Path, reference: Optional[str] = None, io_threads: int = 1) -> pysam.AlignmentFile:
+    '''Opens a SAM, BAM or CRAM file, or standard input for -. The format is detected from the data, CRAM
+    files are decoded with the reference fasta if one is given. With more than one io thread htslib
+    decompresses the BGZF blocks, or CRAM containers, in a pool of that many threads.'''
+    return pysam.AlignmentFile(str(sam), 'r', reference_filename=reference, threads=max(io_threads, 1))
+
+
+def read_ahead(reads: Iterable[pysam.AlignedSegment], batch_size: int, depth: int = PREFETCH_DEPTH) -> Iterator[pysam.AlignedSegment]:
+    '''Yields the reads while a background thread decodes the next batches of batch_size reads, so reading
+    and decompressing the bam file overlaps with counting. pysam lets go of the GIL while htslib reads a
+    record, which is where the time goes on slow storage. At most depth batches are held ahead. Errors of the
+    reading thread are raised in the caller, and closing the generator stops the thread.'''
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            reads_iter = iter(reads)
+            while not stop.is_set():
+                batch = list(islice(reads_iter, batch_size))
+                batches.put(batch)
+                if not batch:
+                    return
+        except BaseException as error:
+            batches.put(error)
+
+    thread = threading.Thread(target=produce, name='telomemore-read-ahead', daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch = batches.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            if not batch:
+                return
+            yield from batch
+    finally:
+        # Empty the queue until the thread sees the stop, it may be waiting to put a batch.
+        stop.set()
+        while thread.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+@contextmanager
+def reading(sam: Path, reference: Optional[str] = None, io_threads: int = 1, prefetch: int = 0, region: Optional[Region] = None) -> Iterator[Iterable[pysam.AlignedSegment]]:
+    '''The reads of the bam file, or of a region of it, read with io_threads decompression threads and, if
+    prefetch is set, ahead of the caller in batches of prefetch reads. The file stays open, and the read-ahead
+    thread running, until the with block is left.'''
+    with open_alignments(sam, reference, io_threads) as sam_file:
+        reads = sam_file if region is None else fetch_region(sam_file, region)
+        if not prefetch:
+            yield reads
+            return
+        with closing(read_ahead(reads, prefetch)) as ahead:
+            yield ahead
+
+
+def progress(reads: Iterable[pysam.AlignedSegment], every: int = PROGRESS_READS) -> Iterator[pysam.AlignedSegment]:
+    '''Yields the reads, printing how many have been read after every `every` reads. The reads are chained in
+    chunks of `every`, so passing a read on costs no Python call. A chunk is only reported once the read after
+    it is found, it was full then.'''
+    reads_iter = iter(reads)
+
+    def chunks() -> Iterator[Iterable[pysam.AlignedSegment]]:
+        done = 0
+        for first in reads_iter:
+            if done:
+                print(f'Reads processed: {done / 1000000} M')
+            yield chain((first,), islice(reads_iter, every - 1))
+            done += every
+
+    return chain.from_iterable(chunks())
+
+
+def split_regions(sam: Path, chunk_size: Optional[int] = CHUNK_SIZE, reference: Optional[str] = None) -> Optional[List[Region]]:
+    '''Splits an indexed bam or cram file into chunks of chunk_size bases, or whole contigs if chunk_size is None.
+    Returns None if the file has no index or is read from standard input.'''
+    if is_stdin(sam):
+        return None
+    with open_alignments(sam, reference) as sam_file:
+        if not sam_file.has_index():
+            return None
+        # Cram indexes carry no read counts, so every contig is scanned.
+        if sam_file.is_cram:
+            used = set(sam_file.references)
+        else:
+            used = {stat.contig for stat in sam_file.get_index_statistics() if stat.total > 0}
+        regions = []
+        for contig, length in zip(sam_file.references, sam_file.lengths):
+            if contig not in used:
+                continue
+            step = chunk_size or length
+            starts = list(range(0, length, step)) or [0]
+            for start in starts[:-1]:
+                regions.append(Region(contig, start, start + step))
+            regions.append(Region(contig, starts[-1]))
+        regions.append(Region(None))
+    return regions
+
+
+def fetch_region(sam_file: pysam.AlignmentFile, region: Region) -> Iterator[pysam.AlignedSegment]:
+    '''Yields the reads starting inside the region, so reads spanning two chunks are only counted once.'''
+    if region.contig is None:
+        yield from sam_file.fetch('*')
+        return
+    for read in sam_file.fetch(region.contig, region.start, region.stop):
+        if read.reference_start >= region.start:
+            yield read
+
+
+def count_region(sam: Path, reference: Optional[str], io_threads: int, prefetch: int, profiler, count_reads: Callable, args: tuple, region: Region):
+    with reading(sam, reference, io_threads, prefetch, region) as reads:
+        if profiler is None:
+            return count_reads(reads, *args), None
+        return count_reads(profiler.wrap(reads), *args), profiler
+
+
+def scan_bam(sam: Path, threads: int, count_reads: Callable, *args, reference: Optional[str] = None, profiler=None,
+             io_threads: int = 1, prefetch: int = 0) -> list:
+    '''Runs count_reads(reads, *args) over the whole bam file. With more than one thread and an indexed bam
+    file the chunks are counted in a process pool. Results are returned in file order, ready to be merged.
+    Otherwise the reads are streamed through count_reads in one pass, which also works for standard input.
+    A profiler samples the reads on their way in, the samples of the workers are merged into it. Every
+    process reads with io_threads decompression threads and a read-ahead of prefetch reads, see reading.
+    Progress is printed every PROGRESS_READS reads of a single pass, the workers count their regions quietly.'''
+    regions = split_regions(sam, reference=reference) if threads > 1 else None
+    if regions is None:
+        with reading(sam, reference, io_threads, prefetch) as reads:
+            reads = progress(reads, PROGRESS_READS)
+            return [count_reads(reads if profiler is None else profiler.wrap(reads), *args)]
+
+    print(f'Counting {len(regions)} regions of {sam} on {threads} processes')
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(partial(count_region, sam, reference, io_threads, prefetch, profiler, count_reads, args), regions))
+    for _, samples in results:
+        if samples is not None:
+            profiler.merge(samples)
+    return [result for result, _ in results]
@@ -0,0 +1,150 @@
+import csv
+import hashlib
+import json
+import os
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from telomemore.cache import atomic_open, cache_folder
+
+ALIGNMENTS = ('.bam', '.cram')
+BARCODES = 'filtered_peak_bc_matrix'
+SHEET_COLUMNS = ['sample', 'bam', 'barcodes']
+# Caches of an older version recorded fewer folders and are walked again.
+LAYOUT_VERSION = 2
+
+
+class SampleFiles(NamedTuple):
+    '''A sample of a sample sheet: its name, bam file and barcode file if it has one.'''
+    sample: str
+    bam: Path
+    barcodes: Optional[Path] = None
+
+
+class Layout(NamedTuple):
+    '''Bam and barcode files found under a folder, and the folders searched for them.'''
+    bams: List[Path]
+    barcodes: List[Path]
+    folders: List[Path] = []
+
+
+def is_sample_sheet(path: str) -> bool:
+    '''True for a .tsv file whose header line names the sample and bam columns, barcodes.tsv files have no header.'''
+    path = Path(path)
+    if path.suffix != '.tsv' or not path.is_file():
+        return False
+    with open(path) as handle:
+        return set(SHEET_COLUMNS[:2]) <= set(handle.readline().rstrip('\r\n').split('\t'))
+
+
+def read_sample_sheet(path: Path) -> List[SampleFiles]:
+    '''Samples of a tab separated sheet with a sample, bam and optional barcodes column. Relative paths are
+    relative to the sheet.'''
+    path = Path(path)
+    with open(path, newline='') as handle:
+        rows = list(csv.DictReader(handle, delimiter='\t'))
+        missing = [column for column in SHEET_COLUMNS[:2] if column not in (rows[0] if rows else {})]
+    if missing:
+        raise ValueError(f'sample sheet {path} needs the columns {", ".join(SHEET_COLUMNS)} in a header line')
+
+    samples = []
+    for row in rows:
+        barcodes = row.get('barcodes') or None
+        samples.append(SampleFiles(row['sample'], path.parent / row['bam'], barcodes and path.parent / barcodes))
+    absent = [str(file) for sample in samples for file in sample[1:] if file is not None and not file.exists()]
+    if absent:
+        raise ValueError(f'files of sample sheet {path} do not exist: {", ".join(absent)}')
+    names = [sample.sample for sample in samples]
+    if len(set(names)) < len(names):
+        raise ValueError(f'sample sheet {path} names a sample twice')
+    return samples
+
+
+def sample_dir(path: Path) -> Path:
+    '''Sample directory of a cell ranger output file, the folder holding outs/, or the file's own folder.'''
+    path = Path(path).resolve()
+    for parent in path.parents:
+        if parent.name == 'outs':
+            return parent.parent
+    return path.parent
+
+
+def output_names(bams: List[Path], output_dir: Optional[Path] = None) -> Dict[Path, str]:
+    '''Names for the outputs of the bam files that would otherwise write the same files. Next to the bam files,
+    files sharing a folder are named after the file. In an output folder, files of the same name are named after
+    their sample directory, like the possorted_bam.bam of every cell ranger sample.'''
+    if output_dir is None:
+        folders = Counter(bam.parent for bam in bams)
+        return {bam: bam.stem for bam in bams if folders[bam.parent] > 1}
+    stems = Counter(bam.stem for bam in bams)
+    return {bam: sample_dir(bam).name for bam in bams if stems[bam.stem] > 1}
+
+
+def walk(folder: Path) -> Layout:
+    '''Finds the bam, cram and outs/filtered_peak_bc_matrix/barcodes.tsv(.gz) files under the folder in one
+    walk of the tree. Hidden folders and the pipeline folders of cell ranger (SC_ATAC_COUNTER_CS and other
+    *_CS folders), which hold many small files and intermediate bam files, are not searched.'''
+    bams, barcodes, folders = [], [], []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [name for name in dirs if not name.startswith('.') and not name.endswith('_CS')]
+        root = Path(root)
+        folders.append(root)
+        for name in files:
+            if name.endswith(ALIGNMENTS):
+                bams.append(root / name)
+            elif name in ('barcodes.tsv', 'barcodes.tsv.gz') and root.name == BARCODES and root.parent.name.endswith('outs'):
+                barcodes.append(root / name)
+    return Layout(sorted(bams), sorted(barcodes), sorted(folders))
+
+
+def cache_file(folder: Path) -> Path:
+    return cache_folder() / f'layout_{hashlib.sha1(str(folder).encode()).hexdigest()[:16]}.json'
+
+
+def folder_states(folder: Path, folders: List[Path]) -> Dict[str, int]:
+    '''Modification times of the searched folders by path relative to the folder. They change when a file or
+    folder is added to or removed from them, such as the outs/ of a sample that finished after the search.'''
+    return {str(path.relative_to(folder)): path.stat().st_mtime_ns for path in folders}
+
+
+def find_files(folder: Path, rescan: bool = False) -> Layout:
+    '''The layout of the folder, walked once and cached. The cache is used as long as every folder the walk
+    searched is unchanged, rescan walks the folder again.'''
+    folder = Path(folder)
+    cache = cache_file(folder.resolve())
+    cached = json.loads(cache.read_text()) if not rescan and cache.exists() else {}
+    if cached.get('version') == LAYOUT_VERSION:
+        folders = [folder / path for path in cached['folders']]
+        layout = Layout([folder / bam for bam in cached['bams']], [folder / bc for bc in cached['barcodes']], folders)
+        try:
+            if cached['folders'] == folder_states(folder, folders):
+                return layout
+        except FileNotFoundError:
+            pass
+
+    layout = walk(folder)
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_open(cache) as handle:
+            json.dump({'version': LAYOUT_VERSION, 'folder': str(folder.resolve()),
+                       'bams': [str(bam.relative_to(folder)) for bam in layout.bams],
+                       'barcodes': [str(bc.relative_to(folder)) for bc in layout.barcodes],
+                       'folders': folder_states(folder, layout.folders)}, handle)
+    except OSError:
+        print(f'could not cache the files found under {folder} in {cache}')
+    return layout
+
+
+def pair_barcodes(bams: List[Path], barcodes: List[Path]) -> List[Tuple[Path, Path]]:
+    '''Pairs every bam file with the barcode file of its sample directory. Raises ValueError naming every bam file
+    without a barcode file, rather than pairing it with the barcode file of another sample.'''
+    by_sample = {}
+    for bc in barcodes:
+        if sample_dir(bc) in by_sample:
+            raise ValueError(f'{sample_dir(bc)} has two barcode files: {by_sample[sample_dir(bc)]} and {bc}')
+        by_sample[sample_dir(bc)] = bc
+
+    unpaired = [str(bam) for bam in bams if sample_dir(bam) not in by_sample]
+    if unpaired:
+        raise ValueError(f'no barcode file in the sample folder of: {", ".join(unpaired)}')
+    return [(bam, by_sample[sample_dir(bam)]) for bam in bams]
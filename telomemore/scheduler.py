@@ -0,0 +1,107 @@
+import os
+import time
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from telomemore.cache import Manifest
+from telomemore.metrics import log_run, peak_memory
+from telomemore.options import JOB_MEMORY
+
+
+class Sample(NamedTuple):
+    '''One bam file to count, the arguments to count it with, its output files and their fingerprint,
+    None if the input cannot be fingerprinted like standard input.'''
+    bam: Path
+    args: tuple
+    outputs: List[Path]
+    key: Optional[dict]
+
+
+class DuplicateOutputs(ValueError):
+    '''Two samples would write the same output file, and only the one counted last would be kept.'''
+
+
+def check_outputs(samples: List[Sample]) -> None:
+    '''Raises DuplicateOutputs if two samples would write the same output file.'''
+    writers = {}
+    for sample in samples:
+        for output in sample.outputs:
+            path = Path(output).resolve()
+            if path in writers:
+                raise DuplicateOutputs(f'{writers[path]} and {sample.bam} would both be written to {output}, '
+                                       f'name the samples in a sample sheet')
+            writers[path] = sample.bam
+
+
+def available_memory() -> Optional[int]:
+    '''Bytes of memory available to new processes, None if it cannot be found.'''
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def max_jobs(jobs: int, job_memory: Optional[int] = JOB_MEMORY) -> int:
+    '''Number of jobs that fit in the available memory when every job needs job_memory bytes, at least one.'''
+    memory = available_memory()
+    if memory is None or not job_memory:
+        return jobs
+    return max(1, min(jobs, int(memory // job_memory)))
+
+
+def run_sample(run: Callable, sample: Sample) -> dict:
+    '''Counts one sample and returns the metrics run_program reports together with the wall time, reads/s
+    and peak memory of the process that counted it.'''
+    start = time.perf_counter()
+    metrics = run(sample.bam, *sample.args) or {}
+    seconds = time.perf_counter() - start
+    return {'sample': str(sample.bam), 'outputs': [str(output) for output in sample.outputs],
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'), 'seconds': seconds,
+            'reads_per_second': metrics.get('reads', 0) / seconds, 'peak_rss_mb': peak_memory(), **metrics}
+
+
+def finish(sample: Sample, metrics: dict, manifest: Optional[Manifest]) -> None:
+    '''Logs the metrics of a counted sample next to its outputs and records it in the manifest.'''
+    log_run(Path(sample.outputs[0]).parent, metrics)
+    if manifest is not None:
+        manifest.record(sample.bam, sample.outputs, sample.key)
+
+
+def run_samples(run: Callable, samples: List[Sample], jobs: int = 1, job_memory: Optional[int] = JOB_MEMORY,
+                manifest: Optional[Manifest] = None) -> None:
+    '''Calls run(bam, *args) for every sample. Samples the manifest has already counted are skipped and
+    finished samples are recorded in it, and the metrics of every sample are appended to the run log. With more than one job the samples are counted in a process
+    pool, largest bam file first so the long samples do not end up last, and reported as they finish. Samples
+    writing the same output file are refused before any is counted.'''
+    check_outputs(samples)
+    if manifest is not None:
+        for sample in samples:
+            if manifest.is_done(sample.bam, sample.outputs, sample.key):
+                print(f'{sample.bam} is up to date, skipping')
+        samples = [sample for sample in samples if not manifest.is_done(sample.bam, sample.outputs, sample.key)]
+
+    if jobs <= 1 or len(samples) <= 1:
+        for sample in samples:
+            print(f'processing {sample.bam}...')
+            metrics = run_sample(run, sample)
+            finish(sample, metrics, manifest)
+            print(f"{sample.bam} done! {metrics['reads_per_second'] / 1e6:.2f} M reads/s")
+        return
+
+    samples = sorted(samples, key=lambda sample: Path(sample.bam).stat().st_size, reverse=True)
+    workers = max_jobs(min(jobs, len(samples)), job_memory)
+    print(f'processing {len(samples)} samples in {workers} jobs...')
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_sample, run, sample): sample for sample in samples}
+        for done, future in enumerate(as_completed(futures), 1):
+            metrics = future.result()
+            sample = futures[future]
+            finish(sample, metrics, manifest)
+            print(f"{sample.bam} done! {metrics['reads_per_second'] / 1e6:.2f} M reads/s ({done}/{len(samples)})")
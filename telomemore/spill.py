@@ -0,0 +1,159 @@
+import heapq
+import os
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+# Memory of one barcode in the count dicts, the string, its dict entries and the dict slack, in bytes.
+BARCODE_BYTES = 200
+# Run files merged at once, every worker writes at least one run and the open files of a process are limited.
+MERGE_FAN_IN = 64
+
+Counted = Tuple[str, int, int]
+
+
+def max_barcodes(max_memory: float, threads: int = 1) -> int:
+    '''Barcodes each of the counting processes may hold in memory for max_memory MB of counts in total.'''
+    return max(1000, int(max_memory * 2 ** 20 / BARCODE_BYTES / max(threads, 1)))
+
+
+@dataclass
+class Dropped:
+    '''Barcodes left out of a bounded count for having too few reads or not being among the top barcodes,
+    with their reads and telomeric reads.'''
+    barcodes: int = 0
+    reads: int = 0
+    telomeric: int = 0
+
+    def add(self, telomere: int, total: int) -> None:
+        self.barcodes += 1
+        self.reads += total
+        self.telomeric += telomere
+
+
+class SpillCounts:
+    '''Telomeric and total reads per barcode in at most max_barcodes barcodes of memory. When that many barcodes
+    are held, the counts are written to a run file sorted by barcode and the dicts are emptied, so memory does
+    not grow with the number of barcodes in the bam file. The runs are summed again by merge_runs.'''
+
+    def __init__(self, folder: Path, max_barcodes: int):
+        self.folder = Path(folder)
+        self.max_barcodes = max_barcodes
+        self.total = {}
+        self.telomere = {}
+        self.runs = []
+
+    def add(self, cb: str, telomeric: bool) -> None:
+        total = self.total
+        total[cb] = total.get(cb, 0) + 1
+        if telomeric:
+            self.telomere[cb] = self.telomere.get(cb, 0) + 1
+        if len(total) >= self.max_barcodes:
+            self.spill()
+
+    def spill(self) -> None:
+        if not self.total:
+            return
+        telomere = self.telomere
+        self.runs.append(write_run(self.folder, ((cb, telomere.get(cb, 0), self.total[cb]) for cb in sorted(self.total))))
+        self.total, self.telomere = {}, {}
+
+    def close(self) -> List[Path]:
+        '''Spills what is left and returns the run files.'''
+        self.spill()
+        return self.runs
+
+
+def write_run(folder: Path, counted: Iterable[Counted]) -> Path:
+    '''Writes counts in barcode order to a new run file in folder.'''
+    handle, path = tempfile.mkstemp(dir=folder, suffix='.run')
+    with os.fdopen(handle, 'w') as run:
+        for cb, telomere, total in counted:
+            print(f'{cb}\t{telomere}\t{total}', file=run)
+    return Path(path)
+
+
+def read_run(path: Path) -> Iterator[Counted]:
+    with open(path) as run:
+        for line in run:
+            cb, telomere, total = line.rstrip('\n').split('\t')
+            yield cb, int(telomere), int(total)
+
+
+def merge_runs(runs: Iterable[Path], fan_in: int = MERGE_FAN_IN) -> Iterator[Counted]:
+    '''Barcode, telomeric and total reads summed over the sorted run files, in barcode order. One line of
+    every run is held in memory at a time. More than fan_in runs are first merged in passes of fan_in runs at
+    a time into new runs next to them, and the merged runs deleted, so at most fan_in files are open at once.'''
+    runs = list(runs)
+    while len(runs) > fan_in:
+        merged = []
+        for start in range(0, len(runs), fan_in):
+            group = runs[start:start + fan_in]
+            if len(group) == 1:
+                merged += group
+                continue
+            merged.append(write_run(group[0].parent, sum_runs(group)))
+            for run in group:
+                run.unlink()
+        runs = merged
+    return sum_runs(runs)
+
+
+def sum_runs(runs: List[Path]) -> Iterator[Counted]:
+    '''Counts of the runs summed per barcode, every run open at once.'''
+    current, telomere, total = None, 0, 0
+    for cb, run_telomere, run_total in heapq.merge(*map(read_run, runs)):
+        if cb != current:
+            if current is not None:
+                yield current, telomere, total
+            current, telomere, total = cb, 0, 0
+        telomere += run_telomere
+        total += run_total
+    if current is not None:
+        yield current, telomere, total
+
+
+class Reversed:
+    '''Barcode ordered in reverse, so the heap of top barcodes drops the largest barcode of a tie.'''
+    __slots__ = ('value',)
+
+    def __init__(self, value: str):
+        self.value = value
+
+    def __lt__(self, other: 'Reversed') -> bool:
+        return self.value > other.value
+
+    def __eq__(self, other: 'Reversed') -> bool:
+        return self.value == other.value
+
+
+def keep_barcodes(counted: Iterable[Counted], dropped: Dropped, min_reads: int = 1, top: Optional[int] = None) -> Iterator[Counted]:
+    '''The barcodes with at least min_reads reads and, if top is given, only the top barcodes with the most reads,
+    ties broken by barcode. Everything else is added to dropped. Barcodes above min_reads are streamed through
+    in barcode order, the top barcodes are held in a heap of size top and given in barcode order at the end.'''
+    if top is None:
+        for cb, telomere, total in counted:
+            if total >= min_reads:
+                yield cb, telomere, total
+            else:
+                dropped.add(telomere, total)
+        return
+
+    heap = []
+    for cb, telomere, total in counted:
+        if total < min_reads:
+            dropped.add(telomere, total)
+            continue
+        # Smallest total first, and of equal totals the largest barcode, which is dropped first.
+        entry = (total, Reversed(cb), telomere)
+        if len(heap) < top:
+            heapq.heappush(heap, entry)
+            continue
+        if top == 0 or entry < heap[0]:
+            dropped.add(telomere, total)
+            continue
+        smallest, _, telomere = heapq.heapreplace(heap, entry)
+        dropped.add(telomere, smallest)
+    for total, cb, telomere in sorted(heap, key=lambda entry: entry[1].value):
+        yield cb.value, telomere, total
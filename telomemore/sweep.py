@@ -0,0 +1,127 @@
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+import pysam
+from telomemore.counts import BarcodeCounts, ReadStats
+from telomemore.barcodes import read_whitelist
+from telomemore.programs_copy import ProgramTelomemore
+from telomemore.regions import scan_bam
+from telomemore.output import write_table
+from telomemore.metrics import count_metrics
+
+Histograms = Dict[str, Counter]
+
+
+class SweepProgramTelomemore(ProgramTelomemore):
+    '''Counts several patterns and cutoffs in one pass over the bam file. For every pattern each read gets a
+    repeat count, the highest number of matches on either strand capped at the largest cutoff, and reads
+    reaching the smallest cutoff are added to a histogram keyed by (barcode id, repeats). The count for any
+    cutoff is then the number of reads in the histogram at or above it.'''
+
+    def __init__(self, both_strands: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.both_strands = both_strands
+
+    def sweep_count(self, sam: Path, barcode: Optional[List[str]], cutoffs: List[int], patterns: List[str]) -> Tuple[BarcodeCounts, Histograms]:
+        telomeres_cells = BarcodeCounts(barcode)
+        histograms = {pattern: Counter() for pattern in patterns}
+        read_stats = ReadStats()
+        matchers = [self.make_matcher(pattern, max(cutoffs)) for pattern in patterns]
+
+        for counts, counted, stats in scan_bam(sam, self.threads, self._count_reads, barcode, matchers, min(cutoffs), reference=self.reference,
+                                                  profiler=self.make_profiler(matchers), io_threads=self.io_threads, prefetch=self.prefetch):
+            ids = [telomeres_cells.intern(cb) for cb in counts.index]
+            for pattern, histogram in counted.items():
+                for (i, repeats), value in histogram.items():
+                    histograms[pattern][ids[i], repeats] += value
+            telomeres_cells.merge(counts)
+            read_stats.add(stats)
+
+        print(f'Reads of {sam}: {read_stats}')
+        self.read_stats = read_stats
+        return telomeres_cells, histograms
+
+    def _count_reads(self, reads: Iterable[pysam.AlignedSegment], barcode: Optional[List[str]], matchers: list, floor: int) -> Tuple[BarcodeCounts, Histograms, ReadStats]:
+        telomeres_cells = BarcodeCounts(barcode)
+        index, total = telomeres_cells.index, telomeres_cells.total
+        histograms = {matcher.pattern: Counter() for matcher in matchers}
+        counters = [(matcher, histograms[matcher.pattern]) for matcher in matchers]
+        missing, off_whitelist = 0, 0
+
+        for read in reads:
+            try:
+                cb = read.get_tag('CB')
+            except KeyError:
+                missing += 1
+                continue
+            i = index.get(cb)
+            if i is None and barcode is not None:
+                off_whitelist += 1
+                continue
+            seq = read.query_sequence
+            if seq is None:
+                missing += 1
+                continue
+            if i is None:
+                i = telomeres_cells.intern(cb)
+            total[i] += 1
+            for matcher, histogram in counters:
+                repeats = matcher.repeats(seq)
+                if repeats >= floor:
+                    histogram[i, repeats] += 1
+
+        return telomeres_cells, histograms, ReadStats(missing, off_whitelist)
+
+    def sweep_metrics(self, telomeres_cells: BarcodeCounts, frame: pd.DataFrame) -> dict:
+        '''Run metrics with the number of telomeric reads for every pattern and cutoff.'''
+        telomeric = frame.groupby(['pattern', 'cutoff'], sort=False)['count'].sum()
+        return count_metrics(self, self.read_stats, int(np.frombuffer(telomeres_cells.total, dtype=np.int64).sum()),
+                             [{'pattern': pattern, 'cutoff': int(cutoff), 'telomeric': int(count)}
+                              for (pattern, cutoff), count in telomeric.items()],
+                             len(telomeres_cells), patterns=frame['pattern'].unique().tolist(),
+                             cutoffs=sorted(frame['cutoff'].unique().tolist()))
+
+    def sweep_frame(self, telomeres_cells: BarcodeCounts, histograms: Histograms, cutoffs: List[int], bam_file: Path) -> pd.DataFrame:
+        '''Long format table with one row per barcode, pattern and cutoff.'''
+        total = np.frombuffer(telomeres_cells.total, dtype=np.int64)
+        frames = []
+        for pattern, histogram in histograms.items():
+            repeats = np.zeros((len(telomeres_cells), max(cutoffs) + 1), dtype=np.int64)
+            if histogram:
+                keys = np.array(list(histogram.keys()), dtype=np.int64)
+                repeats[keys[:, 0], keys[:, 1]] = list(histogram.values())
+            at_least = repeats[:, ::-1].cumsum(axis=1)[:, ::-1]
+            for cutoff in cutoffs:
+                frames.append(pd.DataFrame({'bc': telomeres_cells.barcodes, 'count': at_least[:, cutoff], 'total': total,
+                                            'pattern': pattern, 'cutoff': cutoff}))
+        df = pd.concat(frames, ignore_index=True)
+        df.insert(3, 'fraction', df['count'] / df['total'])
+        df['file'] = bam_file
+        return df
+
+
+class NobarcodeSweepProgramTelomemore(SweepProgramTelomemore):
+
+    def telomere_count(self, sam: Path, cutoffs: List[int], patterns: List[str]) -> Tuple[BarcodeCounts, Histograms]:
+        return self.sweep_count(sam, None, cutoffs, patterns)
+
+    def run_program(self, bam_file: Path, cutoffs: List[int], patterns: List[str], telomere_file: Path) -> dict:
+        telomeres_cells, histograms = self.telomere_count(bam_file, cutoffs, patterns)
+        frame = self.sweep_frame(telomeres_cells, histograms, cutoffs, bam_file)
+        write_table(frame, telomere_file)
+        return self.sweep_metrics(telomeres_cells, frame)
+
+
+class BarcodeSweepProgramTelomemore(SweepProgramTelomemore):
+
+    def telomere_count(self, sam: Path, barcode: Path, cutoffs: List[int], patterns: List[str]) -> Tuple[BarcodeCounts, Histograms]:
+        barcode = read_whitelist(barcode)
+        return self.sweep_count(sam, barcode, cutoffs, patterns)
+
+    def run_program(self, bam_file: Path, barcode: Path, cutoffs: List[int], patterns: List[str], telomere_file: Path) -> dict:
+        telomeres_cells, histograms = self.telomere_count(bam_file, barcode, cutoffs, patterns)
+        frame = self.sweep_frame(telomeres_cells, histograms, cutoffs, bam_file)
+        write_table(frame, telomere_file)
+        return self.sweep_metrics(telomeres_cells, frame)
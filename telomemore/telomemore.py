@@ -3,6 +3,11 @@ from typing import List, Optional, Tuple
 from telomemore.filehandler import Files
 from telomemore.programs import NobarcodeProgramTelomemore, BarcodeProgramTelomemore, ProgramTelomemore
 from telomemore.barcodes import Barcodes
+from telomemore.scheduler import run_samples, Sample, JOB_MEMORY
+from telomemore.cache import Manifest, fingerprint
+from telomemore.regions import is_stdin
+from telomemore.samples import output_names
+from telomemore.emit import reads_file
 from dataclasses import dataclass
 
 
@@ -15,27 +20,42 @@ class TeloMemore:
     cutoff: int = 3
     barcode: Optional[Barcodes] = None
     output_dir: Optional[str] = None 
+    jobs: int = 1
+    job_memory: Optional[int] = JOB_MEMORY
+    resume: bool = True
+    sample_name: Optional[str] = None
+    
+    def __post_init__(self):
+        self.output_names = output_names(self.files.files, self.output_dir)
+    
+    def name(self, file: Path) -> Optional[str]:
+        '''Name of the output files of a bam file, the sample name given or its sample in a sample sheet, or a name
+        keeping it apart from other bam files that would write the same files.'''
+        return self.sample_name or self.files.names.get(file) or self.output_names.get(file)
     
     def output_files(self, file: Path) -> List[Path]:
         if self.output_dir is not None:
-            return self.files.save_files_output(file, self.output_dir, self.pattern)
+            return self.files.save_files_output(file, self.output_dir, self.pattern, self.name(file))
         
-        return self.files.save_files_default(file, self.pattern)
+        return self.files.save_files_default(file, self.pattern, self.name(file))
+  
+    def sample(self, bam: Path, barcode: Optional[Path] = None) -> Sample:
+        outputs = list(self.output_files(bam))
+        if self.program.emit_reads:
+            outputs.append(reads_file(outputs[0]))
+        args = (self.cutoff, self.pattern, *outputs) if barcode is None else (barcode, self.cutoff, self.pattern, *outputs)
+        key = None if is_stdin(bam) else fingerprint(bam, barcode, pattern=self.pattern, cutoff=self.cutoff, reference=self.program.reference,
+                                                     program=type(self.program).__name__, matcher=self.program.matcher.__name__,
+                                                     bounded=self.program.max_memory is not None, min_reads=self.program.min_reads,
+                                                     top_barcodes=self.program.top_barcodes, max_mismatches=self.program.max_mismatches,
+                                                     **self.program.input_key(bam))
+        return Sample(bam, args, outputs, key)
   
     def run_program(self) -> None:
         if self.barcode is not None:
             print('bc')
-            for bam, bc in zip(self.files.files, self.barcode.files):
-                print(f'processing {bam}...')
-                telomere, total, missed = self.output_files(bam)
-                self.program.run_program(bam, bc, self.cutoff, self.pattern, telomere, total, missed)
-                print(f'{bam} done!')
-
-
+            samples = [self.sample(bam, bc) for bam, bc in self.barcode.pair(self.files.files)]
         else:
-            for bam in self.files.files:
-                print(f'processing {bam}...')
-                telomere, total, missed = self.output_files(bam)
-                self.program.run_program(bam, self.cutoff, self.pattern, telomere, total, missed)
-                print(f'{bam} done!')
+            samples = [self.sample(bam) for bam in self.files.files]
             
+        run_samples(self.program.run_program, samples, self.jobs, self.job_memory, Manifest() if self.resume else None)
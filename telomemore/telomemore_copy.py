@@ -1,36 +1,67 @@
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Union
 from telomemore.filehandler_copy import Files_copy
 from telomemore.programs import ProgramTelomemore
 from telomemore.barcodes import Barcodes
+from telomemore.scheduler import run_samples, Sample, JOB_MEMORY
+from telomemore.cache import Manifest, file_state, fingerprint
+from telomemore.regions import is_stdin
+from telomemore.samples import output_names
+from telomemore.emit import reads_file
 from dataclasses import dataclass
 
 
 @dataclass
 class TeloMemore_copy:
-    pattern: str
+    pattern: Union[str, List[str]]
     files: Files_copy
     program: ProgramTelomemore
-    cutoff: int = 3
+    cutoff: Union[int, List[int]] = 3
     barcode: Optional[Barcodes] = None
     output_dir: Optional[str] = None 
+    jobs: int = 1
+    job_memory: Optional[int] = JOB_MEMORY
+    resume: bool = True
+    sample_name: Optional[str] = None
+    output_format: str = 'csv'
     
-    def output_files(self, file: Path) -> List[Path]:
+    @property
+    def label(self) -> str:
+        '''Pattern part of the output file name, several patterns are counted as a sweep.'''
+        if isinstance(self.pattern, str) and isinstance(self.cutoff, int):
+            return self.pattern
+        patterns = [self.pattern] if isinstance(self.pattern, str) else self.pattern
+        return '_'.join(patterns) + '_sweep'
+    
+    def __post_init__(self):
+        self.output_names = output_names(self.files.files, self.output_dir)
+    
+    def name(self, file: Path) -> Optional[str]:
+        '''Name of the output files of a bam file, the sample name given or its sample in a sample sheet, or a name
+        keeping it apart from other bam files that would write the same files.'''
+        return self.sample_name or self.files.names.get(file) or self.output_names.get(file)
+    
+    def output_files(self, file: Path) -> Path:
         if self.output_dir is not None:
-            return self.files.save_files_output(file, self.output_dir, self.pattern)
-        return self.files.save_files_default(file, self.pattern)
+            telomere_file = self.files.save_files_output(file, self.output_dir, self.label, self.name(file))
+        else:
+            telomere_file = self.files.save_files_default(file, self.label, self.name(file))
+        return telomere_file.with_suffix(f'.{self.output_format}')
+  
+    def sample(self, bam: Path, barcode: Optional[Path] = None) -> Sample:
+        outputs = [self.output_files(bam)]
+        if self.program.emit_reads:
+            outputs.append(reads_file(outputs[0]))
+        args = (self.cutoff, self.pattern, *outputs) if barcode is None else (barcode, self.cutoff, self.pattern, *outputs)
+        key = None if is_stdin(bam) else fingerprint(bam, barcode, pattern=self.pattern, cutoff=self.cutoff, reference=self.program.reference,
+                                                     program=type(self.program).__name__, matcher=self.program.matcher.__name__,
+                                                     max_mismatches=self.program.max_mismatches, cell_stats=self.program.cell_stats, subtelomeres=file_state(self.program.subtelomeres_bed))
+        return Sample(bam, args, outputs, key)
   
     def run_program(self) -> None:
         if self.barcode is not None:
-            for bam, bc in zip(self.files.files, self.barcode.files):
-                print(f'processing {bam}...')
-                telomere_file = self.output_files(bam)
-                self.program.run_program(bam, bc, self.cutoff, self.pattern, telomere_file)
-                print(f'{bam} done!')
+            samples = [self.sample(bam, bc) for bam, bc in self.barcode.pair(self.files.files)]
         else:
-            for bam in self.files.files:
-                print(f'processing {bam}...')
-                telomere_file = self.output_files(bam)
-                self.program.run_program(bam, self.cutoff, self.pattern, telomere_file)
-                print(f'{bam} done!')
+            samples = [self.sample(bam) for bam in self.files.files]
             
+        run_samples(self.program.run_program, samples, self.jobs, self.job_memory, Manifest() if self.resume else None)
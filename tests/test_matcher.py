@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""Tests for `telomemore.matcher`."""
+
+
+import random
+import re
+import unittest
+
+from telomemore.matcher import MismatchMatcher, TelomereMatcher, PrefilterMatcher, reverse_comp, seed
+
+
+def mismatch_count(read, pattern, max_mismatches):
+    count, i = 0, 0
+    while i + len(pattern) <= len(read):
+        if sum(a != b for a, b in zip(read[i:i + len(pattern)], pattern)) <= max_mismatches:
+            count += 1
+            i += len(pattern)
+        else:
+            i += 1
+    return count
+
+
+class TestTelomereMatcher(unittest.TestCase):
+    """Tests for `TelomereMatcher`."""
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.reads = [''.join(rng.choices('ACGT', k=60)) for _ in range(200)]
+        self.reads += ['CCCTAA' * n + 'ACGT' for n in range(6)] + ['TTAGGG' * 4, 'AAAAAAAA', '']
+
+    def test_same_counts_as_findall(self):
+        for pattern in ['CCCTAA', 'AA', 'CC[CT]TAA', 'A+']:
+            matcher = TelomereMatcher(pattern, 3)
+            for read in self.reads:
+                self.assertEqual(matcher.count(read), len(re.findall(pattern, read)))
+
+    def test_is_telomeric_both_strands(self):
+        for pattern in ['CCCTAA', 'AA', 'TTAGGG']:
+            for cutoff in range(1, 5):
+                matcher = TelomereMatcher(pattern, cutoff, both_strands=True)
+                for read in self.reads:
+                    expected = (len(re.findall(pattern, read)) >= cutoff
+                                or len(re.findall(reverse_comp(pattern), read)) >= cutoff)
+                    self.assertEqual(matcher.is_telomeric(read), expected)
+
+    def test_seed(self):
+        self.assertEqual(seed(re.compile('CCCTAA')), 'CCCTAA')
+        self.assertEqual(seed(re.compile('CC[CT]TAA')), 'TAA')
+        self.assertEqual(seed(re.compile('TTA+GGG')), 'GGG')
+        self.assertIsNone(seed(re.compile('CCCTAA|TTAGGG')))
+        self.assertIsNone(seed(re.compile('(?i)ccctaa')))
+
+    def test_prefilter_is_lossless(self):
+        rejected = 0
+        for pattern in ['CCCTAA', 'AA', 'CC[CT]TAA', 'TTA+GGG', 'CCCTAA|TTAGGG', 'A*']:
+            for cutoff in range(0, 5):
+                matcher = TelomereMatcher(pattern, cutoff)
+                prefilter = PrefilterMatcher(pattern, cutoff)
+                for read in self.reads:
+                    self.assertEqual(prefilter.is_telomeric(read), matcher.is_telomeric(read))
+                rejected += prefilter.rejected
+        self.assertGreater(rejected, 0)
+
+    def test_mismatches(self):
+        rng = random.Random(1)
+        reads = self.reads + [''.join(rng.choices('ACGTN', k=rng.randrange(40))) for _ in range(200)]
+        reads += ['TTAGGGTCAGGGTGAGGG', 'CCCTGACCCTAACCGTAA', 'AATAAT']
+        for pattern in ['CCCTAA', 'TTAGGG', 'AAT']:
+            for max_mismatches in [0, 1, 2]:
+                for cutoff in [0, 1, 3]:
+                    matcher = MismatchMatcher(pattern, cutoff, both_strands=True, max_mismatches=max_mismatches)
+                    exact = TelomereMatcher(pattern, cutoff, both_strands=True)
+                    for read in reads:
+                        counts = tuple(mismatch_count(read, strand, max_mismatches) for strand in matcher.strands)
+                        self.assertEqual(matcher.counts(read), counts)
+                        self.assertEqual(matcher.repeats(read), min(max(counts), cutoff))
+                        self.assertEqual(matcher.is_telomeric(read), max(counts) >= cutoff)
+                        if max_mismatches == 0:
+                            self.assertEqual(matcher.counts(read), exact.counts(read))
+                    self.assertEqual(matcher.classify(reads), [matcher.is_telomeric(read) for read in reads])
+                    self.assertEqual(matcher.classify(['CCC']), [cutoff <= 0])
+                    self.assertEqual(list(matcher.classified(enumerate(reads))),
+                                     [(i, read, matcher.is_telomeric(read)) for i, read in enumerate(reads)])
+                    self.assertEqual(exact.classify(reads), [exact.is_telomeric(read) for read in reads])
+        self.assertEqual(MismatchMatcher('TTAGGG', 3).counts('TTAGGGTCAGGGTGAGGG'), (3,))
+        self.assertRaises(ValueError, MismatchMatcher, 'CC[CT]TAA', 3)
+        self.assertRaises(ValueError, MismatchMatcher, 'AA', 3, max_mismatches=2)
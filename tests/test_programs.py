@@ -0,0 +1,659 @@
+#!/usr/bin/env python
+
+"""Tests for the counting programs in `telomemore`."""
+
+
+import gzip
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import pysam
+
+import telomemore.samples
+import telomemore.spill
+from telomemore.programs import NobarcodeProgramTelomemore, BarcodeProgramTelomemore
+from telomemore.programs_copy import NobarcodeProgramTelomemore_copy, BarcodeProgramTelomemore_copy
+from telomemore.regions import split_regions, fetch_region, progress, read_ahead, reading
+from telomemore.sweep import NobarcodeSweepProgramTelomemore, BarcodeSweepProgramTelomemore
+from telomemore.filehandler_copy import Files_copy
+from telomemore.barcodes import Barcodes, read_whitelist
+from telomemore.matcher import MismatchMatcher, PrefilterMatcher, TelomereMatcher, reverse_comp
+from telomemore.output import merge_outputs
+from telomemore.index import TelomereIndex, index_path
+from telomemore.telomemore_copy import TeloMemore_copy
+from telomemore.scheduler import DuplicateOutputs
+from telomemore.samples import read_sample_sheet
+from telomemore import count_bam, count_reads
+from telomemore.emit import REPEATS_TAG, reads_file
+from telomemore.fastq import NobarcodeFastqProgramTelomemore, BarcodeFastqProgramTelomemore, paired_reads
+
+
+def write_bam(folder: Path, n_reads: int = 3000, seed: int = 1) -> Path:
+    """Write a small sorted and indexed bam file with telomeric, unmapped and barcode-less reads."""
+    rng = random.Random(seed)
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': 'chr1', 'LN': 100000}, {'SN': 'chr2', 'LN': 50000}, {'SN': 'chrM', 'LN': 16569}]}
+    unsorted = folder / 'unsorted.bam'
+    with pysam.AlignmentFile(unsorted, 'wb', header=header) as out:
+        for i in range(n_reads):
+            read = pysam.AlignedSegment(out.header)
+            read.query_name = f'read{i}'
+            seq = ''.join(rng.choice('ACGT') for _ in range(60))
+            if rng.random() < 0.2:
+                seq = rng.choice(['CCCTAA', 'TTAGGG']) * rng.randrange(1, 8) + seq
+                seq = seq[:60]
+            read.query_sequence = seq
+            read.query_qualities = pysam.qualitystring_to_array('I' * 60)
+            if rng.random() < 0.1:
+                read.flag = 4
+                read.reference_id = -1
+                read.reference_start = -1
+            else:
+                read.reference_id = rng.choice([0, 1])
+                read.reference_start = rng.randrange(0, 45000)
+                read.cigarstring = '60M'
+            if rng.random() < 0.9:
+                read.set_tag('CB', f'BC{rng.randrange(30)}-1')
+            out.write(read)
+    bam = folder / 'sample.bam'
+    pysam.sort('-o', str(bam), str(unsorted))
+    pysam.index(str(bam))
+    unsorted.unlink()
+    return bam
+
+
+def write_barcodes(folder: Path) -> Path:
+    barcodes = folder / 'barcodes.tsv'
+    barcodes.write_text(''.join(f'BC{i}-1\n' for i in range(0, 40, 2)))
+    return barcodes
+
+
+class TestPrograms(unittest.TestCase):
+    """Tests for the programs in `telomemore.programs` and `telomemore.programs_copy`."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tmp.name)
+        self.bam = write_bam(self.folder)
+        self.barcodes = write_barcodes(self.folder)
+        self.cache = tempfile.TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': self.cache.name})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.cache.cleanup()
+        self.tmp.cleanup()
+
+    def test_threads_nobarcode(self):
+        serial = NobarcodeProgramTelomemore().telomere_count(self.bam, 3, 'CCCTAA')
+        parallel = NobarcodeProgramTelomemore(threads=3).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual([list(x.items()) for x in serial[:2]], [list(x.items()) for x in parallel[:2]])
+        self.assertEqual(serial[2], parallel[2])
+
+    def test_threads_barcode(self):
+        serial = BarcodeProgramTelomemore().telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        parallel = BarcodeProgramTelomemore(threads=3).telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        self.assertEqual(serial, parallel)
+
+    def test_threads_copy(self):
+        serial = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA')
+        parallel = NobarcodeProgramTelomemore_copy(threads=3).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual(list(serial.items()), list(parallel.items()))
+
+        serial = BarcodeProgramTelomemore_copy().telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        parallel = BarcodeProgramTelomemore_copy(threads=3).telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        self.assertEqual(list(serial.items()), list(parallel.items()))
+
+    def test_threads_without_index(self):
+        Path(f'{self.bam}.bai').unlink()
+        serial = NobarcodeProgramTelomemore().telomere_count(self.bam, 3, 'CCCTAA')
+        parallel = NobarcodeProgramTelomemore(threads=3).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual(serial, parallel)
+
+    def test_regions_cover_bam(self):
+        regions = split_regions(self.bam, chunk_size=1000)
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            names = [read.query_name for region in regions for read in fetch_region(sam_file, region)]
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            self.assertEqual(names, [read.query_name for read in sam_file])
+
+    def test_io_threads_and_prefetch(self):
+        serial = NobarcodeProgramTelomemore().telomere_count(self.bam, 3, 'CCCTAA')
+        for threads in [1, 3]:
+            program = NobarcodeProgramTelomemore(threads=threads, io_threads=2, prefetch=100)
+            self.assertEqual(serial, program.telomere_count(self.bam, 3, 'CCCTAA'))
+
+        with reading(self.bam) as reads:
+            names = [read.query_name for read in reads]
+        with reading(self.bam, io_threads=2, prefetch=7) as reads:
+            self.assertEqual(names, [read.query_name for read in reads])
+        with reading(self.bam, prefetch=7) as reads:
+            self.assertEqual(names[:10], [read.query_name for read, _ in zip(reads, range(10))])
+
+        def failing():
+            yield from range(5)
+            raise OSError('truncated file')
+        with self.assertRaises(OSError):
+            list(read_ahead(failing(), 2))
+
+    def test_progress(self):
+        with redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(list(progress(range(25), 10)), list(range(25)))
+        self.assertEqual(output.getvalue().splitlines(), ['Reads processed: 1e-05 M', 'Reads processed: 2e-05 M'])
+
+        # Only a single pass reports progress, the workers of a split bam file each see part of the reads.
+        for threads, lines in [(1, 2), (3, 0)]:
+            with mock.patch('telomemore.regions.PROGRESS_READS', 1000), redirect_stdout(io.StringIO()) as output:
+                NobarcodeProgramTelomemore_copy(threads=threads).telomere_count(self.bam, 3, 'CCCTAA')
+            self.assertEqual(output.getvalue().count('Reads processed'), lines)
+
+    def test_max_mismatches(self):
+        for cutoff in [1, 3]:
+            exact = NobarcodeProgramTelomemore().telomere_count(self.bam, cutoff, 'CCCTAA')
+            loop = NobarcodeProgramTelomemore(max_mismatches=1).telomere_count(self.bam, cutoff, 'CCCTAA')
+            indexed = NobarcodeProgramTelomemore(index=True, max_mismatches=1).telomere_count(self.bam, cutoff, 'CCCTAA')
+            self.assertEqual([list(x.items()) for x in loop[:2]], [list(x.items()) for x in indexed[:2]])
+            self.assertGreater(sum(loop[0].values()), sum(exact[0].values()))
+            self.assertTrue(all(loop[0][cb] >= value for cb, value in exact[0].items()))
+
+        # The reads are classified in batches, counts are those of matching the reads one at a time.
+        program = NobarcodeProgramTelomemore(max_mismatches=1)
+        matcher = program.make_matcher('CCCTAA', 3)
+        expected = {}
+        with pysam.AlignmentFile(self.bam) as bam:
+            for read in bam:
+                if read.has_tag('CB') and matcher.is_telomeric(read.query_sequence):
+                    expected[read.get_tag('CB')] = expected.get(read.get_tag('CB'), 0) + 1
+        self.assertIsInstance(matcher, MismatchMatcher)
+        with mock.patch('telomemore.matcher.CLASSIFY_BATCH', 7):
+            self.assertEqual(dict(program.telomere_count(self.bam, 3, 'CCCTAA')[0]), expected)
+            telomeres, _, _ = BarcodeProgramTelomemore(max_mismatches=1).telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        self.assertEqual({cb: count for cb, count in telomeres.items() if count}, {cb: count for cb, count in expected.items() if cb in telomeres})
+
+        self.assertNotEqual(index_path(self.bam, 'CCCTAA~1', ['CCCTAA']), index_path(self.bam, 'CCCTAA', ['CCCTAA']))
+        self.assertTrue(index_path(self.bam, 'CCCTAA~1', ['CCCTAA']).exists())
+
+    def test_emit_reads(self):
+        whitelist = set(read_whitelist(self.barcodes))
+        expected, cells = {}, set()
+        with pysam.AlignmentFile(self.bam) as bam:
+            for read in bam:
+                seq = read.query_sequence
+                if read.has_tag('CB') and max(seq.count('CCCTAA'), seq.count('TTAGGG')) >= 3:
+                    expected[read.query_name] = max(seq.count('CCCTAA'), seq.count('TTAGGG'))
+                    if read.get_tag('CB') in whitelist and seq.count('CCCTAA') >= 3:
+                        cells.add(read.query_name)
+
+        for threads in [1, 3]:
+            path = self.folder / f'emitted_{threads}.bam'
+            NobarcodeProgramTelomemore_copy(threads=threads).telomere_count(self.bam, 3, 'CCCTAA', path)
+            with pysam.AlignmentFile(path) as emitted:
+                self.assertTrue(emitted.has_index())
+                reads = list(emitted)
+            self.assertEqual({read.query_name: read.get_tag(REPEATS_TAG) for read in reads}, expected)
+            positions = [(read.reference_id if read.reference_id >= 0 else 1 << 30, read.reference_start) for read in reads]
+            self.assertEqual(positions, sorted(positions))
+
+            path = self.folder / f'cells_{threads}.bam'
+            counts = BarcodeProgramTelomemore(threads=threads).telomere_count(self.bam, self.barcodes, 3, 'CCCTAA', path)
+            with pysam.AlignmentFile(path) as emitted:
+                self.assertEqual({read.query_name for read in emitted}, cells)
+            self.assertEqual(sum(counts[0].values()), len(cells))
+
+        files = Files_copy(str(self.bam))
+        program = NobarcodeProgramTelomemore_copy(emit_reads=True)
+        TeloMemore_copy(pattern='CCCTAA', files=files, program=program, output_dir=str(self.folder / 'out')).run_program()
+        path = self.folder / 'out' / 'sample_telomemore_reads_CCCTAA.bam'
+        self.assertEqual(reads_file(self.folder / 'out' / 'sample_telomemore_count_CCCTAA.csv'), path)
+        self.assertEqual(int(pysam.view('-c', str(path))), len(expected))
+        self.assertFalse([name for name in os.listdir(self.folder / 'out') if name.startswith('telomemore_reads_')])
+        self.assertRaises(ValueError, NobarcodeProgramTelomemore, index=True, emit_reads=True)
+
+    def test_sweep_matches_single_runs(self):
+        patterns, cutoffs = ['CCCTAA', 'TTAGGG', 'AA'], [1, 2, 3, 5]
+        sweep = NobarcodeSweepProgramTelomemore(threads=2)
+        frame = sweep.sweep_frame(*sweep.telomere_count(self.bam, cutoffs, patterns), cutoffs, self.bam)
+        for pattern in patterns:
+            for cutoff in cutoffs:
+                single = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, cutoff, pattern).to_frame()
+                rows = frame[(frame['pattern'] == pattern) & (frame['cutoff'] == cutoff)]
+                self.assertEqual(rows[['bc', 'count', 'total']].values.tolist(), single.values.tolist())
+
+        sweep = BarcodeSweepProgramTelomemore(both_strands=False)
+        frame = sweep.sweep_frame(*sweep.telomere_count(self.bam, self.barcodes, cutoffs, patterns), cutoffs, self.bam)
+        for cutoff in cutoffs:
+            telomeres, totals, _ = BarcodeProgramTelomemore().telomere_count(self.bam, self.barcodes, cutoff, 'CCCTAA')
+            rows = frame[(frame['pattern'] == 'CCCTAA') & (frame['cutoff'] == cutoff)]
+            self.assertEqual(rows[['bc', 'count', 'total']].values.tolist(),
+                             [[cb, telomeres[cb], totals[cb]] for cb in telomeres])
+
+        # A barcode only seen on reads without a sequence gets no rows.
+        unsequenced = self.folder / 'unsequenced.bam'
+        with pysam.AlignmentFile(self.bam) as sam_file, pysam.AlignmentFile(unsequenced, 'wb', template=sam_file) as out:
+            for read in sam_file:
+                out.write(read)
+            read = pysam.AlignedSegment(out.header)
+            read.query_name, read.flag, read.reference_id, read.reference_start = 'unsequenced', 4, -1, -1
+            read.set_tag('CB', 'BC99-1')
+            out.write(read)
+        sweep = NobarcodeSweepProgramTelomemore()
+        counts, histograms = sweep.telomere_count(unsequenced, cutoffs, patterns)
+        self.assertNotIn('BC99-1', counts.barcodes)
+        self.assertEqual(sweep.read_stats.missing, 1 + sum(1 for read in pysam.AlignmentFile(self.bam) if not read.has_tag('CB')))
+
+    def test_resume_skips_finished_samples(self):
+        def run(cutoff=3, resume=True):
+            TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.folder), program=NobarcodeProgramTelomemore_copy(),
+                            cutoff=cutoff, resume=resume).run_program()
+            return self.folder / 'telomemore_count_CCCTAA.csv'
+
+        output = run()
+        written = output.stat().st_mtime_ns
+        self.assertEqual(run().stat().st_mtime_ns, written)
+        self.assertNotEqual(run(resume=False).stat().st_mtime_ns, written)
+
+        written = output.stat().st_mtime_ns
+        self.assertNotEqual(run(cutoff=4).stat().st_mtime_ns, written)
+        self.assertEqual(sorted(path.name for path in self.folder.iterdir() if path.name.startswith('.')), [])
+
+    def test_duplicate_outputs(self):
+        shutil.copy(self.bam, self.folder / 'sample.cram')
+        with mock.patch.object(NobarcodeProgramTelomemore_copy, 'run_program') as run_program:
+            with self.assertRaisesRegex(DuplicateOutputs, 'sample.cram'):
+                TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.folder), program=NobarcodeProgramTelomemore_copy(),
+                                jobs=2).run_program()
+        run_program.assert_not_called()
+
+    def test_read_whitelist(self):
+        self.assertEqual(read_whitelist(self.barcodes), [f'BC{i}-1' for i in range(0, 40, 2)])
+        packed = self.folder / 'barcodes.tsv.gz'
+        with gzip.open(packed, 'wt') as handle:
+            handle.write('AAAC-1\tcell\nAAAC-1\tcell\n\nGGGT-1\tcell\n')
+        self.assertEqual(read_whitelist(packed), ['AAAC-1', 'GGGT-1'])
+
+    def test_read_stats(self):
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            cbs = [read.get_tag('CB') if read.has_tag('CB') else None for read in sam_file]
+        whitelist = set(read_whitelist(self.barcodes))
+        _, totals, stats = BarcodeProgramTelomemore(threads=2).telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')
+        self.assertEqual(stats.missing, cbs.count(None))
+        self.assertEqual(stats.off_whitelist, sum(cb is not None and cb not in whitelist for cb in cbs))
+        self.assertEqual(sum(totals.values()), sum(cb in whitelist for cb in cbs))
+
+    def test_prefilter(self):
+        for pattern in ['CCCTAA', 'CC[CT]TAA']:
+            exact = BarcodeProgramTelomemore().telomere_count(self.bam, self.barcodes, 3, pattern)
+            prefiltered = BarcodeProgramTelomemore(threads=2, matcher=PrefilterMatcher).telomere_count(self.bam, self.barcodes, 3, pattern)
+            self.assertEqual(exact[:2], prefiltered[:2])
+            self.assertGreater(prefiltered[2].prefiltered, 0)
+
+        exact = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA')
+        prefiltered = NobarcodeProgramTelomemore_copy(matcher=PrefilterMatcher).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual(list(exact.items()), list(prefiltered.items()))
+
+        missed = {}
+        for matcher in [TelomereMatcher, PrefilterMatcher]:
+            missed[matcher] = self.folder / f'missed_{matcher.__name__}.txt'
+            BarcodeProgramTelomemore(matcher=matcher).run_program(self.bam, self.barcodes, 3, 'CCCTAA', self.folder / 'telomere.csv',
+                                                                  self.folder / 'total.csv', missed[matcher])
+        self.assertNotIn('prefilter', missed[TelomereMatcher].read_text())
+        self.assertIn('Number of reads rejected by the prefilter', missed[PrefilterMatcher].read_text())
+
+    def test_stdin_and_cram(self):
+        output = self.folder / 'out'
+        with open(self.bam, 'rb') as stdin:
+            subprocess.run([sys.executable, '-c', 'from telomemore.cli import cli; cli()', 'count-copy',
+                            '-i', '-', '-n', 'piped', '-o', str(output)], stdin=stdin, check=True, capture_output=True)
+        piped = (output / 'piped_telomemore_count_CCCTAA.csv').read_text().splitlines()
+        expected = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA').to_frame()
+        self.assertEqual([line.split(',')[:3] for line in piped[1:]], expected.astype(str).values.tolist())
+
+        rng = random.Random(0)
+        reference = self.folder / 'reference.fa'
+        reference.write_text(''.join(f'>{contig}\n' + ''.join(rng.choices('ACGT', k=length)) + '\n'
+                                     for contig, length in [('chr1', 100000), ('chr2', 50000), ('chrM', 16569)]))
+        cram = self.folder / 'sample.cram'
+        pysam.view('-C', '-T', str(reference), '-o', str(cram), str(self.bam), catch_stdout=False)
+        pysam.index(str(cram))
+        counted = NobarcodeProgramTelomemore_copy(threads=2, reference=str(reference)).telomere_count(cram, 3, 'CCCTAA')
+        self.assertEqual(counted.to_frame().values.tolist(), expected.values.tolist())
+
+    def test_run_log(self):
+        program = BarcodeProgramTelomemore_copy(threads=2, profile=True)
+        TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.bam), program=program, barcode=Barcodes(self.barcodes)).run_program()
+        TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.bam), program=NobarcodeProgramTelomemore_copy(), cutoff=4).run_program()
+        profiled, plain = [json.loads(line) for line in (self.folder / 'telomemore_runs.jsonl').read_text().splitlines()]
+
+        frame = BarcodeProgramTelomemore_copy().telomere_count(self.bam, self.barcodes, 3, 'CCCTAA').to_frame()
+        self.assertEqual(profiled['reads'], 3000)
+        self.assertEqual(profiled['counted'], frame['total'].sum())
+        self.assertEqual(profiled['telomeric'], frame['count'].sum())
+        self.assertEqual(profiled['counted'] + profiled['missing'] + profiled['off_whitelist'], 3000)
+        self.assertGreater(profiled['profile']['sampled_reads'], 0)
+        self.assertGreater(profiled['reads_per_second'], 0)
+        self.assertEqual((plain['cutoff'], plain['off_whitelist']), (4, 0))
+        self.assertNotIn('profile', plain)
+
+    def test_merge(self):
+        for folder in ['a', 'b']:
+            (self.folder / folder).mkdir()
+            (self.folder / folder / 'sample.bam').symlink_to(self.bam)
+        output = self.folder / 'counts'
+        TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.folder / 'a'), program=NobarcodeProgramTelomemore_copy(cell_stats=True)).run_program()
+        TeloMemore_copy(pattern=['CCCTAA', 'AA'], cutoff=[2, 3], files=Files_copy(self.folder / 'b'), program=NobarcodeSweepProgramTelomemore()).run_program()
+        (self.folder / 'a' / 'telomemore_count_old.csv').write_text('BC1-1,3\n')
+
+        rows = merge_outputs(self.folder, output / 'merged.csv', 'csv', rows=7)
+        merged = pd.read_csv(output / 'merged.csv')
+        single = pd.read_csv(self.folder / 'a' / 'telomemore_count_CCCTAA.csv')
+        sweep = pd.read_csv(self.folder / 'b' / 'telomemore_count_CCCTAA_AA_sweep.csv')
+        self.assertEqual(rows, len(single) + len(sweep))
+        self.assertEqual(merged.columns.tolist(), ['bc', 'count', 'total', 'fraction', 'pattern', 'cutoff', 'file',
+                                                   'fragments', 'mapped', 'unmapped', 'gc'])
+        self.assertEqual(merged[['bc', 'count', 'total']].values.tolist(),
+                         single[['bc', 'count', 'total']].values.tolist() + sweep[['bc', 'count', 'total']].values.tolist())
+        self.assertEqual(merged['cutoff'].isna().sum(), len(single))
+        self.assertEqual(merged['mapped'][:len(single)].tolist(), single['mapped'].tolist())
+        self.assertEqual(merged['mapped'].isna().sum(), len(sweep))
+        self.assertEqual(merge_outputs(self.folder, output / 'merged.csv', 'csv'), rows)
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_parquet(self):
+        parquet = TeloMemore_copy(pattern='CCCTAA', files=Files_copy(self.bam), program=NobarcodeProgramTelomemore_copy(cell_stats=True),
+                                  output_format='parquet')
+        parquet.run_program()
+        table = pd.read_parquet(parquet.output_files(self.bam))
+        expected = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA').to_frame()
+        self.assertEqual(table[['bc', 'count', 'total']].values.tolist(), expected.values.tolist())
+        self.assertEqual(str(table['file'].dtype), 'category')
+
+        rows = merge_outputs(self.folder, self.folder / 'dataset', 'parquet', rows=7)
+        merged = pd.read_parquet(self.folder / 'dataset')
+        self.assertEqual(rows, len(merged))
+        self.assertEqual(merged[['bc', 'count', 'total']].values.tolist(), expected.values.tolist())
+        self.assertEqual(merged['mapped'].tolist(), table['mapped'].tolist())
+        self.assertTrue(np.allclose(merged['gc'], table['gc'], equal_nan=True))
+
+    def test_index(self):
+        for cutoff in [1, 3, 5]:
+            scan = NobarcodeProgramTelomemore().telomere_count(self.bam, cutoff, 'CCCTAA')
+            indexed = NobarcodeProgramTelomemore(index=True, threads=2).telomere_count(self.bam, cutoff, 'CCCTAA')
+            self.assertEqual([list(x.items()) for x in scan[:2]], [list(x.items()) for x in indexed[:2]])
+            self.assertEqual(scan[2], indexed[2])
+            scan = BarcodeProgramTelomemore().telomere_count(self.bam, self.barcodes, cutoff, 'CC[CT]TAA')
+            indexed = BarcodeProgramTelomemore(index=True).telomere_count(self.bam, self.barcodes, cutoff, 'CC[CT]TAA')
+            self.assertEqual(scan, indexed)
+            scan = BarcodeProgramTelomemore_copy().telomere_count(self.bam, self.barcodes, cutoff, 'CCCTAA')
+            indexed = BarcodeProgramTelomemore_copy(index=True).telomere_count(self.bam, self.barcodes, cutoff, 'CCCTAA')
+            self.assertEqual(list(scan.items()), list(indexed.items()))
+
+        both, one = index_path(self.bam, 'CCCTAA', ['CCCTAA', 'TTAGGG']), index_path(self.bam, 'CCCTAA', ['CCCTAA'])
+        self.assertNotEqual(both, one)
+        index = TelomereIndex.load(both)
+        self.assertIsInstance(index.arrays['hit_repeats'], np.memmap)
+        self.assertEqual(index.header['strands'], ['CCCTAA', 'TTAGGG'])
+        self.assertFalse(index.is_current(self.bam, ['CCCTAA']))
+        written = [both.stat().st_mtime_ns, one.stat().st_mtime_ns]
+        NobarcodeProgramTelomemore(index=True).telomere_count(self.bam, 2, 'CCCTAA')
+        NobarcodeProgramTelomemore_copy(index=True).telomere_count(self.bam, 2, 'CCCTAA')
+        self.assertEqual([both.stat().st_mtime_ns, one.stat().st_mtime_ns], written)
+
+        write_bam(self.folder, seed=2)
+        self.assertFalse(TelomereIndex.load(one).is_current(self.bam, ['CCCTAA']))
+        scan = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA')
+        indexed = NobarcodeProgramTelomemore_copy(index=True).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual(list(scan.items()), list(indexed.items()))
+
+        # A bam file in a read-only folder is indexed to the cache folder.
+        write_bam(self.folder, seed=3)
+        write = TelomereIndex.write
+
+        def read_only(path, *args):
+            if path.parent == self.folder:
+                raise PermissionError(13, 'Permission denied', str(path))
+            write(path, *args)
+        with mock.patch.object(TelomereIndex, 'write', side_effect=read_only):
+            scan = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA')
+            indexed = NobarcodeProgramTelomemore_copy(index=True).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertEqual(list(scan.items()), list(indexed.items()))
+        cached = index_path(self.bam, 'CCCTAA', ['CCCTAA', 'TTAGGG'], Path(self.cache.name) / 'telomemore' / 'index')
+        self.assertTrue(TelomereIndex.load(cached).is_current(self.bam, ['CCCTAA', 'TTAGGG']))
+        self.assertFalse(TelomereIndex.load(both).is_current(self.bam, ['CCCTAA', 'TTAGGG']))
+        written = cached.stat().st_mtime_ns
+        NobarcodeProgramTelomemore_copy(index=True).telomere_count(self.bam, 2, 'CCCTAA')
+        self.assertEqual(cached.stat().st_mtime_ns, written)
+
+    def test_sample_discovery(self):
+        project = self.folder / 'project'
+        for sample in ['S1', 'S2']:
+            (project / sample / 'outs').mkdir(parents=True)
+            shutil.copy(self.bam, project / sample / 'outs' / 'possorted_bam.bam')
+        (project / 'S1' / 'SC_ATAC_COUNTER_CS').mkdir()
+        shutil.copy(self.bam, project / 'S1' / 'SC_ATAC_COUNTER_CS' / 'intermediate.bam')
+        # S3 is still running, it has no outs/ yet.
+        (project / 'S3' / 'SC_ATAC_COUNTER_CS').mkdir(parents=True)
+        (project / 'S1' / 'outs' / 'filtered_peak_bc_matrix').mkdir()
+        shutil.copy(self.barcodes, project / 'S1' / 'outs' / 'filtered_peak_bc_matrix' / 'barcodes.tsv')
+
+        bams = Files_copy(project).files
+        self.assertEqual(bams, [project / sample / 'outs' / 'possorted_bam.bam' for sample in ['S1', 'S2']])
+        with self.assertRaisesRegex(ValueError, 'S2'):
+            Barcodes(project).pair(bams)
+
+        (project / 'S2' / 'outs' / 'filtered_peak_bc_matrix').mkdir()
+        (project / 'S2' / 'outs' / 'filtered_peak_bc_matrix' / 'barcodes.tsv').write_text('BC1-1\n')
+        with mock.patch('telomemore.samples.walk', wraps=telomemore.samples.walk) as walk:
+            pairs = Barcodes(project).pair(Files_copy(project).files)
+            Files_copy(project)
+        self.assertEqual(walk.call_count, 1)
+        self.assertEqual([bc.parents[2].name for _, bc in pairs], ['S1', 'S2'])
+
+        def run():
+            TeloMemore_copy(pattern='CCCTAA', files=Files_copy(project), program=BarcodeProgramTelomemore_copy(),
+                            barcode=Barcodes(project), output_dir=self.folder / 'counts').run_program()
+            return {path.name: path.stat().st_mtime_ns for path in (self.folder / 'counts').glob('*.csv')}
+
+        written = run()
+        self.assertEqual(sorted(written), ['S1_telomemore_count_CCCTAA.csv', 'S2_telomemore_count_CCCTAA.csv'])
+        self.assertEqual(run(), written)
+        (self.folder / 'counts' / 'S1_telomemore_count_CCCTAA.csv').unlink()
+        self.assertEqual(run()['S2_telomemore_count_CCCTAA.csv'], written['S2_telomemore_count_CCCTAA.csv'])
+        self.assertIn('S1_telomemore_count_CCCTAA.csv', run())
+
+        sheet = self.folder / 'samples.tsv'
+        sheet.write_text('sample\tbam\tbarcodes\nfirst\tproject/S1/outs/possorted_bam.bam\tbarcodes.tsv\n')
+        self.assertEqual(read_sample_sheet(sheet)[0].bam, project / 'S1' / 'outs' / 'possorted_bam.bam')
+        subprocess.run([sys.executable, '-c', 'from telomemore.cli import cli; cli()', 'count-copy', '-i', str(sheet),
+                        '-o', str(self.folder / 'out')], check=True)
+        table = pd.read_csv(self.folder / 'out' / 'first_telomemore_count_CCCTAA.csv')
+        self.assertEqual(table['bc'].tolist(), read_whitelist(self.barcodes))
+
+        # A sample finishing after the folder was searched is found without --force.
+        (project / 'S3' / 'outs').mkdir()
+        shutil.copy(self.bam, project / 'S3' / 'outs' / 'possorted_bam.bam')
+        self.assertEqual(Files_copy(project).files, [project / sample / 'outs' / 'possorted_bam.bam' for sample in ['S1', 'S2', 'S3']])
+
+    def test_cell_stats(self):
+        bed = self.folder / 'ends.bed'
+        bed.write_text('track name=ends\nchr1\t0\t10000\nchr1\t5000\t12000\nchr2\t40000\t50000\n')
+        expected = {}
+        seen = set()
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            for read in sam_file:
+                if not read.has_tag('CB'):
+                    continue
+                stats = expected.setdefault(read.get_tag('CB'), dict.fromkeys(['fragments', 'mapped', 'unmapped', 'gc', 'bases', 'subtelomeric'], 0))
+                stats['gc'] += sum(base in 'GC' for base in read.query_sequence)
+                stats['bases'] += read.query_length
+                if read.is_unmapped:
+                    stats['unmapped'] += 1
+                    continue
+                stats['mapped'] += 1
+                start, stop = {'chr1': (0, 12000), 'chr2': (40000, 50000)}[read.reference_name]
+                stats['subtelomeric'] += read.reference_start < stop and read.reference_end > start
+                fragment = (read.get_tag('CB'), read.reference_id, read.reference_start, read.is_reverse)
+                stats['fragments'] += fragment not in seen
+                seen.add(fragment)
+
+        for threads in [1, 3]:
+            program = NobarcodeProgramTelomemore_copy(threads=threads, subtelomeres=bed)
+            table = program.cell_table(program.telomere_count(self.bam, 3, 'CCCTAA'))
+            self.assertEqual(table['fragments'].tolist(), [expected[cb]['fragments'] for cb in table['bc']])
+            self.assertEqual(table['mapped'].tolist(), [expected[cb]['mapped'] for cb in table['bc']])
+            self.assertEqual(table['unmapped'].tolist(), [expected[cb]['unmapped'] for cb in table['bc']])
+            self.assertEqual(table['subtelomeric'].tolist(), [expected[cb]['subtelomeric'] for cb in table['bc']])
+            self.assertTrue(np.allclose(table['gc'], [expected[cb]['gc'] / expected[cb]['bases'] for cb in table['bc']]))
+
+        program = BarcodeProgramTelomemore_copy(cell_stats=True)
+        table = program.cell_table(program.telomere_count(self.bam, self.barcodes, 3, 'CCCTAA'))
+        self.assertNotIn('subtelomeric', table)
+        self.assertEqual(table['bc'].tolist(), read_whitelist(self.barcodes))
+        self.assertEqual(table['mapped'].tolist(), [expected[cb]['mapped'] if cb in expected else 0 for cb in table['bc']])
+
+    def test_bounded_count(self):
+        telomeres, totals, stats = NobarcodeProgramTelomemore().telomere_count(self.bam, 3, 'CCCTAA')
+        with mock.patch('telomemore.programs.max_barcodes', return_value=4):
+            program = NobarcodeProgramTelomemore(threads=2, max_memory=1)
+            bounded = program.telomere_count(self.bam, 3, 'CCCTAA')
+            self.assertEqual(dict(bounded[0]), dict(telomeres))
+            self.assertEqual(list(bounded[1].items()), sorted(totals.items()))
+            self.assertEqual(bounded[2], stats)
+            self.assertEqual(program.dropped.barcodes, 0)
+
+            program = NobarcodeProgramTelomemore(max_memory=1, min_reads=100)
+            _, kept, kept_stats = program.telomere_count(self.bam, 3, 'CCCTAA')
+            self.assertEqual(kept, {cb: total for cb, total in totals.items() if total >= 100})
+            self.assertEqual(kept_stats.dropped, sum(total for total in totals.values() if total < 100))
+            self.assertEqual(program.dropped.telomeric, sum(telomeres[cb] for cb, total in totals.items() if total < 100))
+
+            _, top, _ = NobarcodeProgramTelomemore(max_memory=1, top_barcodes=5).telomere_count(self.bam, 3, 'CCCTAA')
+            self.assertEqual(sorted(top), sorted(sorted(totals, key=lambda cb: (-totals[cb], cb))[:5]))
+
+        # Many more runs than files merged at once are merged in passes, with at most fan_in runs open.
+        read_run, merge_runs, opened = telomemore.spill.read_run, telomemore.spill.merge_runs, []
+
+        def counting_runs(path):
+            opened.append(1)
+            try:
+                yield from read_run(path)
+            finally:
+                opened.append(-1)
+
+        def most_open():
+            return max(itertools.accumulate(opened), default=0)
+
+        with mock.patch('telomemore.programs.max_barcodes', return_value=2), \
+                mock.patch('telomemore.programs.merge_runs', side_effect=lambda runs: merge_runs(runs, fan_in=3)) as merge, \
+                mock.patch('telomemore.spill.read_run', side_effect=counting_runs):
+            bounded = NobarcodeProgramTelomemore(threads=3, max_memory=1).telomere_count(self.bam, 3, 'CCCTAA')
+        self.assertGreater(len(merge.call_args[0][0]), 9)
+        self.assertEqual(most_open(), 3)
+        self.assertEqual(dict(bounded[0]), dict(telomeres))
+        self.assertEqual(list(bounded[1].items()), sorted(totals.items()))
+        self.assertEqual(bounded[2], stats)
+
+    def test_api(self):
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            reads = [(read.get_tag('CB') if read.has_tag('CB') else None, read.query_sequence) for read in sam_file]
+        expected = NobarcodeProgramTelomemore_copy().telomere_count(self.bam, 3, 'CCCTAA').to_frame()
+        expected.index = pd.Index(expected.pop('bc'), name='bc')
+        with redirect_stdout(io.StringIO()) as output:
+            frames = [count_bam(self.bam, threads=2), count_reads(reads)]
+        self.assertEqual(output.getvalue(), '')
+        for frame in frames:
+            self.assertEqual(frame[['count', 'total']].reset_index().values.tolist(), expected.reset_index().values.tolist())
+            self.assertEqual(frame.attrs['read_stats']['missing'], sum(cb is None for cb, _ in reads))
+
+        with redirect_stdout(io.StringIO()) as output:
+            whitelisted = count_bam(self.bam, 'CC[CT]TAA', barcodes=self.barcodes, both_strands=False,
+                                    reads_file=str(self.folder / 'cells.bam'), verbose=True)
+        self.assertIn(f'Reads of {self.bam}', output.getvalue())
+        self.assertEqual(int(pysam.view('-c', str(self.folder / 'cells.bam'))), whitelisted['count'].sum())
+        self.assertTrue(whitelisted.equals(count_reads(reads, 'CC[CT]TAA', barcodes=read_whitelist(self.barcodes), both_strands=False)))
+        self.assertEqual(whitelisted.attrs, count_reads(reads, 'CC[CT]TAA', barcodes=self.barcodes, both_strands=False).attrs)
+
+        cells = ['BC2-1', 'BC4-1', 'NOREADS-1']
+        adata = SimpleNamespace(obs=pd.DataFrame(index=cells), obs_names=pd.Index(cells))
+        frame = count_bam(self.bam, adata=adata)
+        self.assertEqual(list(frame.index), cells)
+        self.assertEqual(adata.obs['telomere_total'].tolist(), frame['total'].tolist())
+        self.assertEqual(adata.obs.loc['NOREADS-1', 'telomere_count'], 0)
+
+    def test_fastq(self):
+        rng = random.Random(2)
+        sequences = {f'BC{i}-1': ''.join(rng.choice('ACGT') for _ in range(16)) for i in range(30)}
+        with pysam.AlignmentFile(self.bam, 'rb') as sam_file:
+            reads = [(read.get_tag('CB'), read.query_sequence) for read in sam_file if read.has_tag('CB')]
+        # Two lanes of the reads as R1 and their reverse complement as R3, with the barcodes read in the other
+        # orientation and an N in one barcode read of ten.
+        folder = self.folder / 'fastqs'
+        folder.mkdir()
+        for lane, part in enumerate([reads[::2], reads[1::2]], 1):
+            files = {read: gzip.open(folder / f'lib_S1_L00{lane}_{read}_001.fastq.gz', 'wt') for read in ['R1', 'R2', 'R3']}
+            for i, (cb, seq) in enumerate(part):
+                barcode = reverse_comp(sequences[cb])
+                records = {'R1': seq, 'R2': 'N' + barcode[1:] if i % 10 == 0 else barcode, 'R3': reverse_comp(seq)}
+                for read, handle in files.items():
+                    print(f'@L{lane}.{i} {read}\n{records[read]}\n+\n{"I" * len(records[read])}', file=handle)
+            for handle in files.values():
+                handle.close()
+        whitelist = self.folder / 'whitelist.txt'
+        whitelist.write_text(''.join(f'{barcode}\n' for barcode in sequences.values()))
+        cells = self.folder / 'cells.tsv'
+        cells.write_text(''.join(f'{sequences[f"BC{i}-1"]}-1\n' for i in range(0, 30, 3)))
+        fastq = folder / 'lib_S1_L001_R2_001.fastq.gz'
+
+        expected = count_reads([(sequences[cb], read) for cb, seq in reads for read in [seq, reverse_comp(seq)]], both_strands=False)
+        for program in [NobarcodeFastqProgramTelomemore(whitelist=whitelist), NobarcodeFastqProgramTelomemore(whitelist=whitelist, threads=2, prefetch=50)]:
+            telomeres, totals, stats = program.telomere_count(fastq, 3, 'CCCTAA')
+            self.assertEqual(dict(totals), expected['total'].to_dict())
+            self.assertEqual(dict(telomeres), expected['count'][expected['count'] > 0].to_dict())
+            self.assertEqual(stats.off_whitelist, 0)
+
+        telomeres, totals, stats = BarcodeFastqProgramTelomemore().telomere_count(fastq, cells, 3, 'CCCTAA')
+        kept = expected.loc[[barcode.split('-')[0] for barcode in read_whitelist(cells)]]
+        self.assertEqual(list(totals.values()), kept['total'].tolist())
+        self.assertEqual(list(telomeres.values()), kept['count'].tolist())
+        self.assertEqual(stats.off_whitelist, 2 * len(reads) - kept['total'].sum())
+
+        _, totals, stats = NobarcodeFastqProgramTelomemore().telomere_count(fastq, 3, 'CCCTAA')
+        self.assertEqual(sum(totals.values()), 2 * len(reads))
+        self.assertGreater(len(totals), len(sequences))
+
+        with self.assertRaises(ValueError):
+            list(paired_reads([('@a 2', 'ACGT')], [('@b 1', 'CCCTAA')]))
+        with self.assertRaises(ValueError):
+            list(paired_reads([('@a 2', 'ACGT'), ('@b 2', 'ACGT')], [('@a 1', 'CCCTAA')]))
+
+    def test_lazy_imports(self):
+        def imported(*args):
+            code = ('import sys; from telomemore.cli import cli; cli(list(sys.argv[1:]), standalone_mode=False); '
+                    'print(*[name for name in ["numpy", "pysam", "pandas"] if name in sys.modules], sep=",")')
+            result = subprocess.run([sys.executable, '-c', code, *args], check=True, capture_output=True, text=True)
+            return result.stdout.splitlines()[-1].split(',')
+
+        self.assertEqual(imported('--help'), [''])
+        self.assertEqual(imported('count-copy', '--help'), [''])
+        output = self.folder / 'out'
+        self.assertEqual(imported('count-copy', '-i', str(self.bam), '-bc', str(self.barcodes), '-o', str(output), '--cell-stats'), ['numpy', 'pysam'])
+
+        program = BarcodeProgramTelomemore_copy(cell_stats=True)
+        expected = program.cell_table(program.telomere_count(self.bam, self.barcodes, 3, 'CCCTAA')).assign(pattern='CCCTAA', file=self.bam)
+        self.assertTrue(expected['fraction'].isna().any())
+        self.assertEqual((output / 'sample_telomemore_count_CCCTAA.csv').read_text(), expected.to_csv(index=False))